@@ -110,6 +110,7 @@ CONFIGURATION_FILE = os.path.join(SETUP_INSTALL_DIR, 'INSTALL_SUBMITTY.sh')
 CONFIGURATION_JSON = os.path.join(SETUP_INSTALL_DIR, 'submitty_conf.json')
 SITE_CONFIG_DIR  = os.path.join(SUBMITTY_INSTALL_DIR, "site", "config")
 WORKERS_JSON = os.path.join(SETUP_INSTALL_DIR, "autograding_workers.json")
+SCHEDULER_JSON = os.path.join(SETUP_INSTALL_DIR, "grading_scheduler.json")
 
 ##############################################################################
 
@@ -211,6 +212,16 @@ else:
     worker_dict["primary"] = {"capabilities" : ["default"], "address" : "", "username" : "",
         "num_autograding_workers" : NUM_GRADING_SCHEDULER_WORKERS}
 
+scheduler_dict = {}
+
+if os.path.isfile(SCHEDULER_JSON):
+    with open(SCHEDULER_JSON, 'r') as f:
+        scheduler_dict = json.load(f)
+else:
+    scheduler_dict["batch_starvation_limit"] = 0
+    scheduler_dict["batch_policy"] = "fifo"
+    scheduler_dict["batch_order"] = "fifo"
+
 if os.path.isdir(SETUP_INSTALL_DIR):
     shutil.rmtree(SETUP_INSTALL_DIR)
 os.makedirs(SETUP_INSTALL_DIR, exist_ok=True)
@@ -220,6 +231,9 @@ os.chmod(SETUP_INSTALL_DIR, 0o751)
 with open(WORKERS_JSON, 'w') as workers_file:
     json.dump(worker_dict, workers_file, indent=4)
 
+with open(SCHEDULER_JSON, 'w') as scheduler_file:
+    json.dump(scheduler_dict, scheduler_file, indent=4)
+
 
 ##############################################################################
 # WRITE THE VARIABLES TO A FILE
@@ -139,6 +139,7 @@ mkdir -p ${SUBMITTY_DATA_DIR}/courses
 mkdir -p ${SUBMITTY_DATA_DIR}/vcs
 mkdir -p ${SUBMITTY_DATA_DIR}/logs
 mkdir -p ${SUBMITTY_DATA_DIR}/logs/autograding
+mkdir -p ${SUBMITTY_DATA_DIR}/logs/autograding_metrics
 mkdir -p ${SUBMITTY_DATA_DIR}/logs/site_errors
 mkdir -p ${SUBMITTY_DATA_DIR}/logs/access
 
@@ -154,11 +155,15 @@ chown  -R ${HWPHP_USER}:${COURSE_BUILDERS_GROUP}  ${SUBMITTY_DATA_DIR}/logs
 chmod  -R u+rwx,g+rxs,o+x                         ${SUBMITTY_DATA_DIR}/logs
 chown  -R ${HWCRON_USER}:${COURSE_BUILDERS_GROUP} ${SUBMITTY_DATA_DIR}/logs/autograding
 chmod  -R u+rwx,g+rxs                             ${SUBMITTY_DATA_DIR}/logs/autograding
+chown  -R ${HWCRON_USER}:${COURSE_BUILDERS_GROUP} ${SUBMITTY_DATA_DIR}/logs/autograding_metrics
+chmod  -R u+rwx,g+rxs                             ${SUBMITTY_DATA_DIR}/logs/autograding_metrics
 
 # if the to_be_graded directories do not exist, then make them
 mkdir -p $SUBMITTY_DATA_DIR/to_be_graded_interactive
 mkdir -p $SUBMITTY_DATA_DIR/to_be_graded_batch
 mkdir -p $SUBMITTY_DATA_DIR/to_be_built
+mkdir -p $SUBMITTY_DATA_DIR/grading_index
+mkdir -p $SUBMITTY_DATA_DIR/grading_spool
 
 # set the permissions of these directories
 
@@ -173,6 +178,14 @@ chmod  770                                      $SUBMITTY_DATA_DIR/to_be_graded_
 chown  ${HWCRON_USER}:${HWCRONPHP_GROUP}        $SUBMITTY_DATA_DIR/to_be_built
 chmod  770                                      $SUBMITTY_DATA_DIR/to_be_built
 
+#hwcron maintains the job index, course builders update it (regrade.py) & read it (grading_done.py)
+chown  ${HWCRON_USER}:${COURSE_BUILDERS_GROUP}  $SUBMITTY_DATA_DIR/grading_index
+chmod  2770                                     $SUBMITTY_DATA_DIR/grading_index
+
+#only hwcron keeps the grades waiting to be written to the course databases (grading_result_sink.py)
+chown  ${HWCRON_USER}:${HWCRON_USER}            $SUBMITTY_DATA_DIR/grading_spool
+chmod  700                                      $SUBMITTY_DATA_DIR/grading_spool
+
 
 
 ########################################################################################################################
@@ -285,7 +298,12 @@ replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/generate_repos.py
 replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/grade_item.py
 replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/submitty_grading_scheduler.py
 replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/grade_items_logging.py
+replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/grade_time_estimates.py
+replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/grading_hosts.py
+replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/grade_remote_job.py
+replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/grading_result_sink.py
 replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/grading_done.py
+replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/grading_job_index.py
 replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/regrade.py
 replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/check_everything.py
 replace_fillin_variables ${SUBMITTY_INSTALL_DIR}/bin/build_homework_function.sh
@@ -316,6 +334,10 @@ chown ${HWCRON_USER}:${COURSE_BUILDERS_GROUP} ${SUBMITTY_INSTALL_DIR}/bin/make_a
 chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/build_homework_function.sh
 chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/make_assignments_txt_file.py
 
+# the job index is used by the scheduler (hwcron) and by regrade.py & grading_done.py (course builders)
+chown ${HWCRON_USER}:${COURSE_BUILDERS_GROUP} ${SUBMITTY_INSTALL_DIR}/bin/grading_job_index.py
+chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grading_job_index.py
+
 # everyone needs to run this script
 chmod 555 ${SUBMITTY_INSTALL_DIR}/bin/killall.py
 
@@ -330,6 +352,16 @@ chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grade_item.py
 chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/clang.Dockerfile
 chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/submitty_grading_scheduler.py
 chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grade_items_logging.py
+chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grading_dispatcher.py
+chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grade_time_estimates.py
+chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grading_hosts.py
+chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grading_staging_cache.py
+chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grading_manifest.py
+chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grade_remote_job.py
+chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grading_result_sink.py
+chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grading_result_cache.py
+chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grading_vcs_cache.py
+chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/grading_trash.py
 chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/write_grade_history.py
 chown root:${HWCRON_USER} ${SUBMITTY_INSTALL_DIR}/bin/build_config_upload.py
 chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/insert_database_version_data.py
@@ -337,6 +369,16 @@ chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grade_item.py
 chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/clang.Dockerfile
 chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/submitty_grading_scheduler.py
 chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grade_items_logging.py
+chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grading_dispatcher.py
+chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grade_time_estimates.py
+chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grading_hosts.py
+chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grading_staging_cache.py
+chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grading_manifest.py
+chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grade_remote_job.py
+chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grading_result_sink.py
+chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grading_result_cache.py
+chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grading_vcs_cache.py
+chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/grading_trash.py
 chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/write_grade_history.py
 chmod 550 ${SUBMITTY_INSTALL_DIR}/bin/build_config_upload.py
 
@@ -602,7 +644,12 @@ chown -R hwcron:hwcron /etc/systemd/system/submitty_grading_scheduler.service
 chmod 444 /etc/systemd/system/submitty_grading_scheduler.service
 
 
-# delete the autograding tmp directories
+# delete the autograding tmp directories (unmounting the tmpfs scratch directories first)
+for mnt in /var/local/submitty/autograding_tmp/untrusted*/ram; do
+    if mountpoint -q $mnt; then
+        umount $mnt
+    fi
+done
 rm -rf /var/local/submitty/autograding_tmp
 
 # recreate the top level autograding tmp directory
@@ -615,10 +662,47 @@ for ((i=0;i<$NUM_UNTRUSTED;i++));
 do
     myuser=`printf "untrusted%02d" $i`
     mydir=`printf "/var/local/submitty/autograding_tmp/untrusted%02d" $i`
+    # (the untrusted user may only enter it: a pipelined worker archives the last
+    # job from its tmp directory here while the untrusted user runs the next one)
     mkdir $mydir
     chown hwcron:$myuser $mydir
-    chmod 770 $mydir
+    chmod 750 $mydir
+    # the grading tmp directories go on a tmpfs mounted here if there is one, e.g., in /etc/fstab:
+    #   tmpfs /var/local/submitty/autograding_tmp/untrusted00/ram tmpfs size=1g,mode=0750,uid=hwcron,gid=untrusted00 0 0
+    # (the size is the quota, a job that is not expected to fit is graded on disk, see grade_item.py)
+    mkdir $mydir/ram
+    chown hwcron:$myuser $mydir/ram
+    chmod 750 $mydir/ram
+    # the old tmp directories & results waiting to be removed (see grading_trash.py)
+    mkdir $mydir/trash
+    chown hwcron:hwcron $mydir/trash
+    chmod 700 $mydir/trash
 done
+# (mount the tmpfs scratch directories listed in /etc/fstab again)
+mount -a -t tmpfs
+
+# the workers that send their jobs to other grading machines prepare them here
+mkdir /var/local/submitty/autograding_tmp/remote
+chown hwcron:hwcron /var/local/submitty/autograding_tmp/remote
+chmod 700 /var/local/submitty/autograding_tmp/remote
+mkdir /var/local/submitty/autograding_tmp/remote/trash
+chown hwcron:hwcron /var/local/submitty/autograding_tmp/remote/trash
+chmod 700 /var/local/submitty/autograding_tmp/remote/trash
+
+# the instructor files cached by each worker, in a directory named by its untrusted user (see grading_staging_cache.py)
+mkdir /var/local/submitty/autograding_tmp/staging_cache
+chown hwcron:hwcron /var/local/submitty/autograding_tmp/staging_cache
+chmod 700 /var/local/submitty/autograding_tmp/staging_cache
+
+# the results shared by the workers (see grading_result_cache.py)
+mkdir /var/local/submitty/autograding_tmp/result_cache
+chown hwcron:hwcron /var/local/submitty/autograding_tmp/result_cache
+chmod 700 /var/local/submitty/autograding_tmp/result_cache
+
+# the local mirrors of the student repositories (see grading_vcs_cache.py)
+mkdir /var/local/submitty/autograding_tmp/vcs_mirrors
+chown hwcron:hwcron /var/local/submitty/autograding_tmp/vcs_mirrors
+chmod 700 /var/local/submitty/autograding_tmp/vcs_mirrors
 
 
 # start the scheduler (if it was running)
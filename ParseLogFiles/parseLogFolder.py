@@ -14,8 +14,10 @@
 # throughout Batch
 
 # FIXES: when there is not a full week the is a division by 0 error
-import os
 from __future__ import division, print_function
+import json
+import os
+from datetime import datetime
 # import numpy as np
 
 print("lets parse some files!! ")
@@ -44,6 +46,59 @@ def num_to_weekday(num):
         6: "Sat"
     }[num]
 
+def daily_logs(path):
+    # the log file of each day: the json lines log (YYYYMMDD.jsonl) if
+    # there is one, otherwise the text log (YYYYMMDD.txt)
+    days = {}
+    for filename in os.listdir(path):
+        day, extension = os.path.splitext(filename)
+        if extension == ".jsonl" or (extension == ".txt" and day not in days):
+            days[day] = filename
+    return [days[day] for day in sorted(days)]
+
+
+def read_text_log(filename):
+    # the interactive submissions in a fixed width text log
+    for line in open(filename):
+        if (line[40:45] == "BATCH"):
+            continue
+
+        info = ((line[48:99]).strip()).split("__")
+
+        if (len(info) < 3):
+            print(filename)
+            print(info)
+            continue
+
+        phase = ""
+        elapsed = 0
+        if (line[101:105] == "wait"):
+            phase = "wait"
+            elapsed = int(line[106:114])
+        elif (line[101:106] == "grade"):
+            phase = "grade"
+            elapsed = int(line[107:114])
+
+        yield {"weekday": weekday_to_num(line[0:3]), "date": line[4:10], "hour": int(line[11:13]),
+               "course": info[1], "who": info[3], "phase": phase, "elapsed": elapsed}
+
+
+def read_json_log(filename):
+    # the interactive submissions in a json lines log (see bin/grade_items_logging.py)
+    for line in open(filename):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if (record["queue"] != "INTERACTIVE"):
+            continue
+
+        when = datetime.strptime(record["time"][:19], "%Y-%m-%d %H:%M:%S")
+        yield {"weekday": when.isoweekday() % 7, "date": when.strftime("%b %d"), "hour": when.hour,
+               "course": record["course"], "who": record["who"], "phase": record["phase"],
+               "elapsed": record["elapsed"]}
+
+
 path = '/var/local/submitty/logs/autograding/'
 submissions_per_hour = [0]*24
 avg_hours_ot_week = [[0]*24 for _ in range(7)]
@@ -69,67 +124,64 @@ num_days = 0
 full_week = 0
 f3 = open('BARsubmissions_per_week.csv', 'w+')
 f3.write(" , CS 1, Data Structures, FOCS, Principle of Software, Programming Languages, Operating Systems\n")
-for filename in os.listdir(path):
+for filename in daily_logs(path):
     # hack to skip first (badly formatted log file)
     if (filename == "20150916.txt"):
         continue
 
     num_days += 1
-    contents = open(path + '/' + filename)
+    if filename.endswith(".jsonl"):
+        records = read_json_log(path + '/' + filename)
+    else:
+        records = read_text_log(path + '/' + filename)
     new_day = True
     full_week += 1
 
-    for line in contents.readlines():
-        if (line[40:45] != "BATCH"):
-            num_of_sumbissions += 1
-
-            info = ((line[48:99]).strip()).split("__")
+    for record in records:
+        num_of_sumbissions += 1
 
-            if (len(info) < 3):
-                print(filename)
-                print(info)
-                continue
+        course = record["course"]
 
-            all_students.add(info[3])
+        all_students.add(record["who"])
 
-            all_courses.add(info[1])  # class
+        all_courses.add(course)  # class
 
-            if new_day:
-                day_of_week = weekday_to_num(line[0:3])
-                number_of_weekdays[day_of_week] += 1
+        if new_day:
+            day_of_week = record["weekday"]
+            number_of_weekdays[day_of_week] += 1
 
-            hour = int(line[11:13])
+        hour = record["hour"]
 
-            if (line[101:105] == "wait"):
-                waitsec = int(line[106:114])
-                if (waitsec > 1000):
-                    print("Anomoly %s %d  %d" % (filename, hour, waitsec))
-                avg_waittime_ot_week[day_of_week][hour] += int(line[106:114])
+        if (record["phase"] == "wait"):
+            waitsec = record["elapsed"]
+            if (waitsec > 1000):
+                print("Anomoly %s %d  %d" % (filename, hour, waitsec))
+            avg_waittime_ot_week[day_of_week][hour] += waitsec
 
-            elif (line[101:106] == "grade"):
-                avg_gradingtime_ot_week[day_of_week][hour] += int(line[107:114])
+        elif (record["phase"] == "grade"):
+            avg_gradingtime_ot_week[day_of_week][hour] += record["elapsed"]
 
-            if (info[1] == "datastructures"):  # Data Structures
-                submission_temp_cs1200 += 1
-                avg_hours_ot_week_datastructures[day_of_week][hour] += 1
-            elif (info[1] == "csci2600"):  # Principles of Software
-                submission_temp_cs2600 += 1
-            elif (info[1] == "csci1100"):  # cs1
-                submission_temp_cs1100 += 1
-            elif (info[1] == "csci4430"):  # prog lang
-                submission_temp_cs4430 += 1
-            elif (info[1] == "csci2200"):  # focs
-                submission_temp_cs2200 += 1
-            elif (info[1] == "csci4380"):  # opsys
-                submission_temp_cs4380 += 1
+        if (course == "datastructures"):  # Data Structures
+            submission_temp_cs1200 += 1
+            avg_hours_ot_week_datastructures[day_of_week][hour] += 1
+        elif (course == "csci2600"):  # Principles of Software
+            submission_temp_cs2600 += 1
+        elif (course == "csci1100"):  # cs1
+            submission_temp_cs1100 += 1
+        elif (course == "csci4430"):  # prog lang
+            submission_temp_cs4430 += 1
+        elif (course == "csci2200"):  # focs
+            submission_temp_cs2200 += 1
+        elif (course == "csci4380"):  # opsys
+            submission_temp_cs4380 += 1
 
-            avg_hours_ot_week[day_of_week][hour] += 1
-            submissions_per_hour[hour] += 1
-            new_day = False
+        avg_hours_ot_week[day_of_week][hour] += 1
+        submissions_per_hour[hour] += 1
+        new_day = False
 
     if (full_week == 7):
         print(filename[5:9])
-        f3.write("%s %s, " % (line[4:10], filename[5:9]))
+        f3.write("%s %s, " % (record["date"], filename[5:9]))
         submission_temp_cs1200 //= 2
         submission_temp_cs2600 //= 2
         submission_temp_cs1100 //= 2
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """
 This script will anonymize a directory of autograding logs
+(both the YYYYMMDD.txt logs and the YYYYMMDD.jsonl json lines logs)
 
 usage example:
 python3 /usr/local/submitty/GIT_CHECKOUT_Submitty/bin/anonymize_autograding_logs.py /var/local/submitty/logs/autograding/ ~/anon_logs/ something_random
@@ -9,6 +10,7 @@ The final argument is a random seed/offset string to prevent simple de-anonymiza
 
 """
 
+import json
 import random
 import sys
 import os
@@ -83,13 +85,36 @@ def anon_log(in_filename,out_filename,offset):
                               .format(timestamp,process,batch,untrusted,anon_which,waitgrade,result))
                 
 
+# same for the json lines log (see grade_items_logging.json_log_record)
+def anon_json_log(in_filename,out_filename,offset):
+    with open(in_filename,'r') as infile:
+        with open (out_filename,'w') as outfile:
+            for line in infile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # discard lines with bad format
+                    continue
+                if record["who"] is None:
+                    # discard messages that are not about a submission (only errors)
+                    continue
+                hash = random_string(record["semester"]+record["course"]+record["who"]+offset)
+                record["who"] = hash
+                record["job"] = "/".join([record["semester"],record["course"],"submissions",
+                                          record["gradeable"],hash,str(record["version"])])
+                outfile.write(json.dumps(record,separators=(',',':'))+"\n")
+
+
 def anon_dir(indir,outdir,offset):
     if indir==outdir:
         print("ERROR! directories cannot match!")
         exit();
     for file in os.listdir(indir):
         print("processing... "+file)
-        anon_log(indir+"/"+file,outdir+"/"+file,offset)
+        if file.endswith(".jsonl"):
+            anon_json_log(indir+"/"+file,outdir+"/"+file,offset)
+        else:
+            anon_log(indir+"/"+file,outdir+"/"+file,offset)
 
         
 if len(sys.argv) != 4:
@@ -18,6 +18,8 @@ from datetime import datetime
 import json
 import os
 
+from submitty_utils import config_cache
+
 DATA_PATH = os.path.join("__INSTALL__FILLIN__SUBMITTY_DATA_DIR__", "courses")
 
 
@@ -46,14 +48,13 @@ def get_all_versions(semester, course):
         testcases = []
         buildfile = os.path.join(build_path, "build_" + homework + ".json")
         if os.path.isfile(buildfile):
-            with open(buildfile) as open_file:
-                parsed = json.load(open_file)
-                if parsed['testcases']:
-                    for testcase in parsed['testcases']:
-                        testcases.append({"title": testcase['title'],
-                                          "points": testcase['points'],
-                                          "extra_credit": testcase['extra_credit'],
-                                          "hidden": testcase['hidden']})
+            parsed = config_cache.load_json(buildfile)
+            if parsed['testcases']:
+                for testcase in parsed['testcases']:
+                    testcases.append({"title": testcase['title'],
+                                      "points": testcase['points'],
+                                      "extra_credit": testcase['extra_credit'],
+                                      "hidden": testcase['hidden']})
         homework_path = os.path.join(submission_path, homework)
         for student in os.listdir(homework_path):
             if student not in versions:
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
-import configparser
+import collections
 import json
 import os
 import tempfile
@@ -13,10 +13,15 @@ import dateutil
 import dateutil.parser
 import urllib.parse
 
-from submitty_utils import dateutils, glob
+from submitty_utils import config_cache, dateutils, glob, permissions
 import grade_items_logging
 import write_grade_history
-import insert_database_version_data
+import grading_result_sink
+import grading_hosts
+import grading_manifest
+import grading_result_cache
+import grading_staging_cache
+import grading_trash
 
 # these variables will be replaced by INSTALL_SUBMITTY.sh
 SUBMITTY_INSTALL_DIR = "__INSTALL__FILLIN__SUBMITTY_INSTALL_DIR__"
@@ -24,9 +29,15 @@ SUBMITTY_DATA_DIR = "__INSTALL__FILLIN__SUBMITTY_DATA_DIR__"
 HWCRON_UID = "__INSTALL__FILLIN__HWCRON_UID__"
 INTERACTIVE_QUEUE = os.path.join(SUBMITTY_DATA_DIR, "to_be_graded_interactive")
 BATCH_QUEUE = os.path.join(SUBMITTY_DATA_DIR, "to_be_graded_batch")
+AUTOGRADING_TMP_DIR = "/var/local/submitty/autograding_tmp"
 
 USE_DOCKER = False
 WRITE_DATABASE = True
+# also record a hash of every file in the manifests written to tmp_logs (slower)
+MANIFEST_HASHES = False
+# (before a job has been graded, its tmp directory is expected to use this many
+# times the size of its inputs, see choose_scratch)
+SCRATCH_INPUT_FACTOR = 2
 
 # ==================================================================================
 def parse_args():
@@ -53,10 +64,9 @@ def get_submission_path(next_directory,next_to_grade):
     return obj
 
 
-def add_permissions(item,perms):
-    if os.getuid() == os.stat(item).st_uid:
-        os.chmod(item,os.stat(item).st_mode | perms)
-    # else, can't change permissions on this file/directory!
+# the mode of the files hard linked from the staging cache is never changed (protect_links)
+def add_permissions(item,perms,counts=None):
+    permissions.add_permissions(item,perms,protect_links=True,counts=counts)
 
 
 def touch(my_file):
@@ -64,24 +74,16 @@ def touch(my_file):
         os.utime(my_file, None)
 
                 
-def add_permissions_recursive(top_dir,root_perms,dir_perms,file_perms):
-    for root, dirs, files in os.walk(top_dir):
-        add_permissions(root,root_perms)
-        for d in dirs:
-            add_permissions(os.path.join(root, d),dir_perms)
-        for f in files:
-            add_permissions(os.path.join(root, f),file_perms)
+def add_permissions_recursive(top_dir,root_perms,dir_perms,file_perms,counts=None):
+    permissions.add_permissions_recursive(top_dir,root_perms,dir_perms,file_perms,protect_links=True,counts=counts)
 
 
 def get_vcs_info(top_dir, semester, course, gradeable, userid,  teamid):
     form_json_file = os.path.join(top_dir, 'courses', semester, course, 'config', 'form', 'form_'+gradeable+'.json')
-    with open(form_json_file, 'r') as fj:
-        form_json = json.load(fj)
+    form_json = config_cache.load_json(form_json_file)
 
     course_ini_file = os.path.join(top_dir, 'courses', semester, course, 'config', 'config.ini')
-    with open(course_ini_file, 'r') as open_file:
-        course_ini = configparser.ConfigParser()
-        course_ini.read_file(open_file)
+    course_ini = config_cache.load_ini(course_ini_file)
 
     is_vcs = form_json["upload_type"] == "repository"
 
@@ -96,10 +98,45 @@ def get_vcs_info(top_dir, semester, course, gradeable, userid,  teamid):
     return is_vcs, vcs_type, vcs_base_url, vcs_subdirectory
 
 
+# the expected size of the tmp directory of a job: from the manifests of the last
+# grading of this version (compilation & work directories), if it was graded before
+def expected_scratch_bytes(results_path,input_paths):
+    logs = os.path.join(results_path,"logs")
+    compilation = grading_manifest.read_total_bytes(logs,"compilation")
+    archiving = grading_manifest.read_total_bytes(logs,"archiving")
+    if compilation is not None and archiving is not None:
+        return compilation + archiving
+    return SCRATCH_INPUT_FACTOR * sum(grading_staging_cache.directory_size(path)
+                                      for path in input_paths if os.path.isdir(path))
+
+
+# the directory to make the tmp directory of a job in: the tmpfs of the
+# untrusted user if one is mounted (see INSTALL_SUBMITTY_HELPER.sh) & the
+# job is expected to use at most scratch_fill of its free space, otherwise
+# the disk.  (the staging cache stays on disk, so on the tmpfs the staged
+# files are copied rather than cloned or linked: the trade-off is logged)
+def choose_scratch(which_untrusted,expected_bytes,scratch_fill):
+    disk = os.path.join(AUTOGRADING_TMP_DIR,which_untrusted)
+    ram = os.path.join(disk,"ram")
+    # (not if the untrusted user could rename the tmp directories in it, see just_grade_item)
+    if scratch_fill > 0 and os.path.ismount(ram) and not os.stat(ram).st_mode & (stat.S_IWGRP|stat.S_IWOTH):
+        info = os.statvfs(ram)
+        if expected_bytes <= info.f_bavail * info.f_frsize * scratch_fill:
+            return ram
+    return disk
+
+
+# remove a tmp directory tree (if it exists): it is moved into the trash
+# directory next to it right away, & removed later (see grading_trash.py)
+def remove_directory(path):
+    grading_trash.discard(path,[os.path.join(os.path.dirname(path),grading_trash.TRASH_NAME)])
+
+
 # copy the files & directories from source to target
 # it will create directories as needed
 # it's ok if the target directory or subdirectories already exist
 # it will overwrite files with the same name if they exist
+# the files are cloned rather than copied where possible (see grading_staging_cache.stage_file)
 def copy_contents_into(source,target,tmp_logs):
     if not os.path.isdir(target):
         grade_items_logging.log_message("ERROR: the target directory does not exist " + target)
@@ -115,7 +152,7 @@ def copy_contents_into(source,target,tmp_logs):
                     raise SystemExit("ERROR: the target subpath is a file not a directory '", os.path.join(target,item), "'")
                 else:
                     # copy entire subtree
-                    shutil.copytree(os.path.join(source,item),os.path.join(target,item))
+                    shutil.copytree(os.path.join(source,item),os.path.join(target,item),copy_function=grading_staging_cache.stage_file)
             else:
                 if os.path.exists(os.path.join(target,item)):
                     with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
@@ -123,13 +160,14 @@ def copy_contents_into(source,target,tmp_logs):
                                " THEN OVERWRITING: ", os.path.join(source,item), "\n", file=f)
                     os.remove(os.path.join(target,item))
                 try:
-                    shutil.copy(os.path.join(source,item),target)
+                    grading_staging_cache.stage_file(os.path.join(source,item),os.path.join(target,item))
                 except:
                     raise SystemExit("ERROR COPYING FILE: " +  os.path.join(source,item) + " -> " + os.path.join(target,item))
 
 
 # copy files that match one of the patterns from the source directory
-# to the target directory.  
+# to the target directory.  the files are cloned rather than copied where
+# possible (see grading_staging_cache.stage_file)
 def pattern_copy(what,patterns,source,target,tmp_logs):
     with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
         print (what," pattern copy ", patterns, " from ", source, " -> ", target, file=f)
@@ -140,13 +178,16 @@ def pattern_copy(what,patterns,source,target,tmp_logs):
                 # make the necessary directories leading to the file
                 os.makedirs(os.path.join(target,os.path.dirname(relpath)),exist_ok=True)
                 # copy the file
-                shutil.copy(my_file,os.path.join(target,relpath))
+                grading_staging_cache.stage_file(my_file,os.path.join(target,relpath))
                 print ("    COPY ",my_file,
                        " -> ",os.path.join(target,relpath), file=f)
             
 
 # give permissions to all created files to the hwcron user
-def untrusted_grant_rwx_access(which_untrusted,my_dir):
+# (find runs chmod on as many files at once as possible)
+def untrusted_grant_rwx_access(which_untrusted,my_dir,counts=None):
+    if counts is not None:
+        counts["untrusted chmod"] = counts.get("untrusted chmod",0) + 1
     subprocess.call([os.path.join(SUBMITTY_INSTALL_DIR,"bin","untrusted_execute"),
                      which_untrusted,
                      "/usr/bin/find",
@@ -157,133 +198,237 @@ def untrusted_grant_rwx_access(which_untrusted,my_dir):
                      "/bin/chmod",
                      "o+rwx",
                      "{}",
-                     ";"])
+                     "+"])
 
 
-# ==================================================================================
-# ==================================================================================
-def just_grade_item(next_directory,next_to_grade,which_untrusted):
+# the wall clock time spent in each phase of a job, e.g.:
+#     timer.begin("compile")   (ends the current phase, if any)
+#     ...
+#     timer.end()
+# a phase that is begun again adds to its time
+class PhaseTimer(object):
 
-    my_pid = os.getpid()
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.current = None
+        self.started = None
 
-    # verify the hwcron user is running this script
-    if not int(os.getuid()) == int(HWCRON_UID):
-        grade_items_logging.log_message("ERROR: must be run by hwcron")
-        raise SystemExit("ERROR: the grade_item.py script must be run by the hwcron user")
+    def begin(self,name):
+        self.end()
+        self.current = name
+        self.started = time.time()
 
-    # --------------------------------------------------------
-    # figure out what we're supposed to grade & error checking
-    obj = get_submission_path(next_directory,next_to_grade)
-    submission_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],
-                                   "submissions",obj["gradeable"],obj["who"],str(obj["version"]))
-    if not os.path.isdir(submission_path):
-        grade_items_logging.log_message("ERROR: the submission directory does not exist" + submission_path)
-        raise SystemExit("ERROR: the submission directory does not exist",submission_path)
-    print("pid", my_pid, "GRADE THIS", submission_path)
-
-    is_vcs, vcs_type, vcs_base_url, vcs_subdirectory = get_vcs_info(SUBMITTY_DATA_DIR,
-                                                                    obj["semester"],
-                                                                    obj["course"],
-                                                                    obj["gradeable"],
-                                                                    obj["who"],
-                                                                    obj["team"])
+    def end(self):
+        if self.current is not None:
+            elapsed = self.phases.get(self.current,0) + time.time() - self.started
+            self.phases[self.current] = round(elapsed,3)
+        self.current = None
 
-    is_batch_job = next_directory == BATCH_QUEUE
-    is_batch_job_string = "BATCH" if is_batch_job else "INTERACTIVE"
-
-    queue_time = get_queue_time(next_directory,next_to_grade)
-    queue_time_longstring = dateutils.write_submitty_date(queue_time)
-    grading_began = dateutils.get_current_time()
-    waittime = int((grading_began-queue_time).total_seconds())
-    grade_items_logging.log_message(is_batch_job,which_untrusted,submission_path,"wait:",waittime,"")
 
-    # --------------------------------------------------------
-    # various paths
-    provided_code_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"provided_code",obj["gradeable"])
-    test_input_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"test_input",obj["gradeable"])
-    test_output_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"test_output",obj["gradeable"])
-    custom_validation_code_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"custom_validation_code",obj["gradeable"])
-    bin_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"bin")
-
-    checkout_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"checkout",obj["gradeable"],obj["who"],str(obj["version"]))
-    results_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"results",obj["gradeable"],obj["who"],str(obj["version"]))
+# ==================================================================================
+def testcase_shards(testcases,untrusted_users):
+    """
+    Split the testcases that run.out executes into (at most) one shard per
+    untrusted user, keeping the testcases of each shard consecutive.
+
+    :param testcases: the "testcases" of the complete config of the gradeable
+    :param untrusted_users: the untrusted users available to run them
+    :return: list of (untrusted user, list of testcase numbers (from 1))
+    """
+    numbers = [i+1 for i,testcase in enumerate(testcases)
+               if testcase.get("type","Execution") not in ["FileCheck","Compilation"]]
+    num_shards = max(1,min(len(untrusted_users),len(numbers)))
+    shards = []
+    for i in range(num_shards):
+        shard = numbers[i*len(numbers)//num_shards:(i+1)*len(numbers)//num_shards]
+        shards.append((untrusted_users[i],shard))
+    return shards
+
+
+def open_directory_beneath(top,relative,create=False):
+    """
+    Open a directory under top without following a symlink below top: an
+    untrusted user could have replaced any directory of the path by a
+    symlink to somewhere else.
+
+    :param relative: path of the directory from top ("" for top itself)
+    :param create: make the missing directories of the path
+    :return: file descriptor of the directory, or None if a directory of
+             the path is missing, a symlink or not a directory
+    """
+    fd = os.open(top,os.O_RDONLY|os.O_DIRECTORY)
+    try:
+        for name in relative.split(os.sep) if relative else []:
+            if create:
+                try:
+                    os.mkdir(name,dir_fd=fd)
+                except FileExistsError:
+                    pass
+            next_fd = os.open(name,os.O_RDONLY|os.O_DIRECTORY|os.O_NOFOLLOW,dir_fd=fd)
+            os.close(fd)
+            fd = next_fd
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def merge_shard_file(work,tmp_work,path):
+    """
+    Copy a file a testcase shard wrote from its runner directory into
+    TMP_WORK.  Both directories were writable by untrusted users, so no
+    symlink is followed on either side, and only a regular file is copied,
+    as a new file (a staged file hard linked at the target is replaced,
+    not written through).
+
+    :param path: path of the file from the runner directory
+    :return: False if the file was skipped
+    """
+    directory,name = os.path.split(path)
+    source_dir = open_directory_beneath(work,directory)
+    if source_dir is None:
+        return False
+    try:
+        target_dir = open_directory_beneath(tmp_work,directory,create=True)
+        if target_dir is None:
+            return False
+        try:
+            # (non blocking, so opening a fifo doesn't wait for a writer)
+            with os.fdopen(os.open(name,os.O_RDONLY|os.O_NOFOLLOW|os.O_NONBLOCK,dir_fd=source_dir),'rb') as infile:
+                info = os.fstat(infile.fileno())
+                if not stat.S_ISREG(info.st_mode):
+                    return False
+                try:
+                    os.unlink(name,dir_fd=target_dir)
+                except FileNotFoundError:
+                    pass
+                target = os.open(name,os.O_WRONLY|os.O_CREAT|os.O_EXCL|os.O_NOFOLLOW,0o600,dir_fd=target_dir)
+                with os.fdopen(target,'wb') as outfile:
+                    os.fchmod(outfile.fileno(),stat.S_IMODE(info.st_mode))
+                    grading_staging_cache.copy_contents(infile,outfile)
+        except OSError:
+            # e.g., a symlink, or a directory at the target
+            return False
+        finally:
+            os.close(target_dir)
+    finally:
+        os.close(source_dir)
+    return True
+
+
+def run_testcase_shards(tmp_work,tmp_logs,job,shards,log_function,timer,counts):
+    """
+    Run the shards of the testcases at the same time, each as its own
+    untrusted user in its own copy of the runner directory (the first one
+    in tmp_work itself).  Then bring the files made or changed by each
+    shard back into tmp_work, in testcase order, so a file written by
+    several testcases ends up as if they had run one after another.
+    Only for gradeables whose testcases don't depend on each other.
+
+    :param shards: list of (untrusted user, list of testcase numbers), see testcase_shards
+    :return: the exit code of run.out (0 if it succeeded for every shard)
+    """
+    my_pid = os.getpid()
+    shard_work = [tmp_work]
+    before = [None]
+    for which_untrusted,testcases in shards[1:]:
+        # (in the tmp directory of the other untrusted user, which we can't
+        # share with the first one)
+        shard_tmp = os.path.join(AUTOGRADING_TMP_DIR,which_untrusted,"tmp")
+        remove_directory(shard_tmp)
+        os.makedirs(shard_tmp)
+        shard_work.append(os.path.join(shard_tmp,"TMP_WORK"))
+        shutil.copytree(tmp_work,shard_work[-1],symlinks=True,copy_function=grading_staging_cache.stage_file)
+        before.append(grading_manifest.scan(shard_work[-1],mtimes=True))
 
-    # grab a copy of the current history.json file (if it exists)
-    history_file = os.path.join(results_path,"history.json")
-    history_file_tmp = ""
-    if os.path.isfile(history_file):
-        filehandle,history_file_tmp = tempfile.mkstemp()
-        shutil.copy(history_file,history_file_tmp)
+    with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
+        for (which_untrusted,testcases),work in zip(shards,shard_work):
+            print ("RUNNER SHARD",which_untrusted,"testcases",testcases,"in",work,file=f)
+
+    runners = []
+    for (which_untrusted,testcases),work in zip(shards,shard_work):
+        logfile = open(os.path.join(tmp_logs,"runner_log.txt" if work == tmp_work else
+                                    "runner_log_" + which_untrusted + ".txt"), 'w')
+        print ("LOGGING BEGIN my_runner.out testcases",testcases,file=logfile)
+        logfile.flush()
+        runner = subprocess.Popen([os.path.join(SUBMITTY_INSTALL_DIR,"bin","untrusted_execute"),
+                                   which_untrusted,
+                                   os.path.join(work,"my_runner.out"),
+                                   job["gradeable"],
+                                   job["who"],
+                                   str(job["version"]),
+                                   job["submission_string"],
+                                   ",".join(str(number) for number in testcases)],
+                                  cwd=work,stdout=logfile)
+        runners.append((which_untrusted,runner,logfile))
+
+    runner_success = 0
+    for which_untrusted,runner,logfile in runners:
+        if runner.wait() != 0:
+            runner_success = runner.returncode
+        print ("LOGGING END my_runner.out",file=logfile)
+        logfile.flush()
 
-    # get info from the gradeable config file
-    json_config = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"config","form","form_"+obj["gradeable"]+".json")
-    with open(json_config, 'r') as infile:
-        gradeable_config_obj = json.load(infile)
+    timer.begin("killall")
+    for which_untrusted,runner,logfile in runners:
+        killall_success = subprocess.call([os.path.join(SUBMITTY_INSTALL_DIR,"bin","untrusted_execute"),
+                                           which_untrusted,
+                                           os.path.join(SUBMITTY_INSTALL_DIR,"bin","killall.py")],
+                                          stdout=logfile)
+        print ("KILLALL COMPLETE my_runner.out",file=logfile)
+        logfile.close()
+        if killall_success != 0:
+            msg='RUNNER ERROR: had to kill {} process(es) of {}'.format(killall_success,which_untrusted)
+            print ("pid",my_pid,msg)
+            log_function(msg)
 
-    # get info from the gradeable config file
-    complete_config = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"config","complete_config","complete_config_"+obj["gradeable"]+".json")
-    with open(complete_config, 'r') as infile:
-        complete_config_obj = json.load(infile)
+    timer.begin("shard merge")
+    for (which_untrusted,testcases),work,files in zip(shards[1:],shard_work[1:],before[1:]):
+        untrusted_grant_rwx_access(which_untrusted,work,counts)
+        changes = grading_manifest.diff(files,grading_manifest.scan(work,mtimes=True))
+        for path in changes["added"] + changes["changed"]:
+            if not merge_shard_file(work,tmp_work,path):
+                with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
+                    print ("SHARD MERGE SKIPPED",os.path.join(work,path),file=f)
+        remove_directory(os.path.dirname(work))
+    return runner_success
 
-    checkout_subdirectory = complete_config_obj["autograding"].get("use_checkout_subdirectory","")
-    checkout_subdir_path = os.path.join(checkout_path,checkout_subdirectory)
 
-    # --------------------------------------------------------------------
-    # MAKE TEMPORARY DIRECTORY & COPY THE NECESSARY FILES THERE
-    tmp = os.path.join("/var/local/submitty/autograding_tmp/",which_untrusted,"tmp")
-    shutil.rmtree(tmp,ignore_errors=True)
-    os.makedirs(tmp)
-    
-    # switch to tmp directory
-    os.chdir(tmp)
+# ==================================================================================
+# ==================================================================================
+def grade_staged_job(tmp,which_untrusted,job,inputs,log_function,timer=None,shards=None):
+    """
+    Run the compile.out / run.out / validate.out pipeline of one job as an
+    untrusted user.  This runs on the machine that does the grading, either
+    from just_grade_item or from grade_remote_job.py on a remote grading
+    machine, so everything it needs is passed in.
+
+    :param tmp: the tmp directory of the job, which already contains tmp_logs
+    :param which_untrusted: the untrusted user that runs the student code
+    :param job: dictionary with the gradeable, who, version, submission_string and
+                the autograding section of the complete config of the gradeable
+    :param inputs: dictionary with the paths of the "submission", "checkout" (None if
+                   this is not a vcs gradeable), "provided_code", "test_input",
+                   "test_output" & "custom_validation_code" directories and of the "bin"
+                   directory with the compile.out, run.out & validate.out of the gradeable
+    :param log_function: called with the messages for the autograding log
+    :param timer: PhaseTimer for the time spent in each phase (optional); the
+                  "archive" phase is still running when this returns
+    :param shards: None, or the testcases to run in parallel (see testcase_shards),
+                   the first shard must be run by which_untrusted
+    """
 
-    # make the logs directory
+    my_pid = os.getpid()
+    if timer is None:
+        timer = PhaseTimer()
     tmp_logs = os.path.join(tmp,"tmp_logs")
-    os.makedirs(tmp_logs)
-
-    # grab the submission time
-    with open (os.path.join(submission_path,".submit.timestamp")) as submission_time_file:
-        submission_string = submission_time_file.read().rstrip()
-    
-    submission_datetime = dateutils.read_submitty_date(submission_string)
-
-    # --------------------------------------------------------------------
-    # CHECKOUT THE STUDENT's REPO
-    if is_vcs:
-        # is vcs_subdirectory standalone or should it be combined with base_url?
-        if vcs_subdirectory[0] == '/' or '://' in vcs_subdirectory:
-            vcs_path = vcs_subdirectory
-        else:
-            if '://' in vcs_base_url:
-                vcs_path = urllib.parse.urljoin(vcs_base_url, vcs_subdirectory)
-            else:
-                vcs_path = os.path.join(vcs_base_url, vcs_subdirectory)
-
-        with open(os.path.join(tmp_logs, "overall.txt"), 'a') as f:
-            print("====================================\nVCS CHECKOUT", file=f)
-            print('vcs_base_url', vcs_base_url, file=f)
-            print('vcs_subdirectory', vcs_subdirectory, file=f)
-            print('vcs_path', vcs_path, file=f)
-            print(['/usr/bin/git', 'clone', vcs_path, checkout_path], file=f)
-
-        # cleanup the previous checkout (if it exists)
-        shutil.rmtree(checkout_path,ignore_errors=True)
-        os.makedirs(checkout_path, exist_ok=True)
-        subprocess.call(['/usr/bin/git', 'clone', vcs_path, checkout_path])
-        os.chdir(checkout_path)
-
-        # determine which version we need to checkout
-        what_version = subprocess.check_output(['git', 'rev-list', '-n', '1', '--before="'+submission_string+'"', 'master'])
-        what_version = str(what_version.decode('utf-8')).rstrip()
-        if what_version == "":
-            # oops, pressed the grade button before a valid commit
-            shutil.rmtree(checkout_path, ignore_errors=True)
-        else:
-            # and check out the right version
-            subprocess.call(['git', 'checkout', '-b', 'grade', what_version])
-        os.chdir(tmp)
-        subprocess.call(['ls', '-lR', checkout_path], stdout=open(tmp_logs + "/overall.txt", 'a'))
-
+    submission_path = inputs["submission"]
+    is_vcs = inputs["checkout"] is not None
+    checkout_subdir_path = inputs["checkout"]
+    submission_string = job["submission_string"]
+    autograding = job["autograding"]
+    # the # of files checked & chmod calls to set up the permissions
+    counts = {}
 
     # --------------------------------------------------------------------
     # START DOCKER
@@ -297,6 +442,7 @@ def just_grade_item(next_directory,next_to_grade,which_untrusted):
     # --------------------------------------------------------------------
     # COMPILE THE SUBMITTED CODE
 
+    timer.begin("compile staging")
     with open(os.path.join(tmp_logs, "overall.txt"), 'a') as f:
         print("====================================\nCOMPILATION STARTS", file=f)
     
@@ -305,42 +451,43 @@ def just_grade_item(next_directory,next_to_grade,which_untrusted):
     os.mkdir(tmp_compilation)
     os.chdir(tmp_compilation)
     
-    gradeable_deadline_string = gradeable_config_obj["date_due"]
-    
-    patterns_submission_to_compilation = complete_config_obj["autograding"]["submission_to_compilation"]
+    patterns_submission_to_compilation = autograding["submission_to_compilation"]
     pattern_copy("submission_to_compilation",patterns_submission_to_compilation,submission_path,tmp_compilation,tmp_logs)
     if is_vcs:
         pattern_copy("checkout_to_compilation",patterns_submission_to_compilation,checkout_subdir_path,tmp_compilation,tmp_logs)
     
     # copy any instructor provided code files to tmp compilation directory
-    copy_contents_into(provided_code_path,tmp_compilation,tmp_logs)
+    copy_contents_into(inputs["provided_code"],tmp_compilation,tmp_logs)
 
-    subprocess.call(['ls', '-lR', '.'], stdout=open(tmp_logs + "/overall.txt", 'a'))
+    grading_manifest.write_manifest(tmp_logs,"compilation",tmp_compilation,hashes=MANIFEST_HASHES)
 
     # copy compile.out to the current directory
-    shutil.copy (os.path.join(bin_path,obj["gradeable"],"compile.out"),os.path.join(tmp_compilation,"my_compile.out"))
+    grading_staging_cache.stage_file(os.path.join(inputs["bin"],"compile.out"),os.path.join(tmp_compilation,"my_compile.out"),
+                                     stat.S_IRGRP | stat.S_IXGRP)
 
     # give the untrusted user read/write/execute permissions on the tmp directory & files
     add_permissions_recursive(tmp_compilation,
                               stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP,
                               stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP,
-                              stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP)
+                              stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP,
+                              counts)
 
-    add_permissions(tmp,stat.S_IROTH | stat.S_IXOTH)
-    add_permissions(tmp_logs,stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+    add_permissions(tmp,stat.S_IROTH | stat.S_IXOTH,counts)
+    add_permissions(tmp_logs,stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR,counts)
 
+    timer.begin("compile")
     with open(os.path.join(tmp_logs,"compilation_log.txt"), 'w') as logfile:
         if USE_DOCKER:
             compile_success = subprocess.call(['docker', 'exec', '-w', tmp_compilation, container,
-                                               os.path.join(tmp_compilation, 'my_compile.out'), obj['gradeable'],
-                                               obj['who'], str(obj['version']), submission_string], stdout=logfile)
+                                               os.path.join(tmp_compilation, 'my_compile.out'), job['gradeable'],
+                                               job['who'], str(job['version']), submission_string], stdout=logfile)
         else:
             compile_success = subprocess.call([os.path.join(SUBMITTY_INSTALL_DIR,"bin","untrusted_execute"),
                                                which_untrusted,
                                                os.path.join(tmp_compilation,"my_compile.out"),
-                                               obj["gradeable"],
-                                               obj["who"],
-                                               str(obj["version"]),
+                                               job["gradeable"],
+                                               job["who"],
+                                               str(job["version"]),
                                                submission_string],
                                               stdout=logfile)
 
@@ -348,10 +495,10 @@ def just_grade_item(next_directory,next_to_grade,which_untrusted):
         print ("pid",my_pid,"COMPILATION OK")
     else:
         print ("pid",my_pid,"COMPILATION FAILURE")
-        grade_items_logging.log_message(is_batch_job,which_untrusted,submission_path,"","","COMPILATION FAILURE")
+        log_function("COMPILATION FAILURE")
     #raise SystemExit()
 
-    untrusted_grant_rwx_access(which_untrusted,tmp_compilation)
+    untrusted_grant_rwx_access(which_untrusted,tmp_compilation,counts)
         
     # remove the compilation program
     os.remove(os.path.join(tmp_compilation,"my_compile.out"))
@@ -363,6 +510,7 @@ def just_grade_item(next_directory,next_to_grade,which_untrusted):
     # --------------------------------------------------------------------
     # make the runner directory
 
+    timer.begin("runner staging")
     with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
         print ("====================================\nRUNNER STARTS", file=f)
         
@@ -373,129 +521,141 @@ def just_grade_item(next_directory,next_to_grade,which_untrusted):
     # move all executable files from the compilation directory to the main tmp directory
     # Note: Must preserve the directory structure of compiled files (esp for Java)
 
-    patterns_submission_to_runner = complete_config_obj["autograding"]["submission_to_runner"]
+    patterns_submission_to_runner = autograding["submission_to_runner"]
     pattern_copy("submission_to_runner",patterns_submission_to_runner,submission_path,tmp_work,tmp_logs)
     if is_vcs:
         pattern_copy("checkout_to_runner",patterns_submission_to_runner,checkout_subdir_path,tmp_work,tmp_logs)
 
-    patterns_compilation_to_runner = complete_config_obj["autograding"]["compilation_to_runner"]
+    patterns_compilation_to_runner = autograding["compilation_to_runner"]
     pattern_copy("compilation_to_runner",patterns_compilation_to_runner,tmp_compilation,tmp_work,tmp_logs)
         
     # copy input files to tmp_work directory
-    copy_contents_into(test_input_path,tmp_work,tmp_logs)
+    copy_contents_into(inputs["test_input"],tmp_work,tmp_logs)
 
-    subprocess.call(['ls', '-lR', '.'], stdout=open(tmp_logs + "/overall.txt", 'a'))
+    manifest = grading_manifest.write_manifest(tmp_logs,"runner",tmp_work,hashes=MANIFEST_HASHES)
 
     # copy runner.out to the current directory
-    shutil.copy (os.path.join(bin_path,obj["gradeable"],"run.out"),os.path.join(tmp_work,"my_runner.out"))
+    grading_staging_cache.stage_file(os.path.join(inputs["bin"],"run.out"),os.path.join(tmp_work,"my_runner.out"),
+                                     stat.S_IROTH | stat.S_IXOTH)
 
     # give the untrusted user read/write/execute permissions on the tmp directory & files
     add_permissions_recursive(tmp_work,
                               stat.S_IROTH | stat.S_IWOTH | stat.S_IXOTH,
                               stat.S_IROTH | stat.S_IWOTH | stat.S_IXOTH,
-                              stat.S_IROTH | stat.S_IWOTH | stat.S_IXOTH)
+                              stat.S_IROTH | stat.S_IWOTH | stat.S_IXOTH,
+                              counts)
 
 
 
     # raise SystemExit()
     # run the run.out as the untrusted user
-    with open(os.path.join(tmp_logs,"runner_log.txt"), 'w') as logfile:
-        print ("LOGGING BEGIN my_runner.out",file=logfile)
-        logfile.flush()
-
-        try:
-            if USE_DOCKER:
-                runner_success = subprocess.call(['docker', 'exec', '-w', tmp_work, container,
-                                                  os.path.join(tmp_work, 'my_runner.out'), obj['gradeable'],
-                                                  obj['who'], str(obj['version']), submission_string], stdout=logfile)
-            else:
-                runner_success = subprocess.call([os.path.join(SUBMITTY_INSTALL_DIR,"bin","untrusted_execute"),
-                                                  which_untrusted,
-                                                  os.path.join(tmp_work,"my_runner.out"),
-                                                  obj["gradeable"],
-                                                  obj["who"],
-                                                  str(obj["version"]),
-                                                  submission_string],
-                                                 stdout=logfile)
-            logfile.flush()
-        except Exception as e:
-            print ("ERROR caught runner.out exception={0}".format(str(e.args[0])).encode("utf-8"),file=logfile)
+    timer.begin("run")
+    if shards is not None and len(shards) > 1 and not USE_DOCKER:
+        runner_success = run_testcase_shards(tmp_work,tmp_logs,job,shards,log_function,timer,counts)
+    else:
+        with open(os.path.join(tmp_logs,"runner_log.txt"), 'w') as logfile:
+            print ("LOGGING BEGIN my_runner.out",file=logfile)
             logfile.flush()
 
-        print ("LOGGING END my_runner.out",file=logfile)
-        logfile.flush()
+            try:
+                if USE_DOCKER:
+                    runner_success = subprocess.call(['docker', 'exec', '-w', tmp_work, container,
+                                                      os.path.join(tmp_work, 'my_runner.out'), job['gradeable'],
+                                                      job['who'], str(job['version']), submission_string], stdout=logfile)
+                else:
+                    runner_success = subprocess.call([os.path.join(SUBMITTY_INSTALL_DIR,"bin","untrusted_execute"),
+                                                      which_untrusted,
+                                                      os.path.join(tmp_work,"my_runner.out"),
+                                                      job["gradeable"],
+                                                      job["who"],
+                                                      str(job["version"]),
+                                                      submission_string],
+                                                     stdout=logfile)
+                logfile.flush()
+            except Exception as e:
+                print ("ERROR caught runner.out exception={0}".format(str(e.args[0])).encode("utf-8"),file=logfile)
+                logfile.flush()
+
+            print ("LOGGING END my_runner.out",file=logfile)
+            logfile.flush()
 
-        killall_success = subprocess.call([os.path.join(SUBMITTY_INSTALL_DIR,"bin","untrusted_execute"),
-                                           which_untrusted,
-                                           os.path.join(SUBMITTY_INSTALL_DIR,"bin","killall.py")],
-                                          stdout=logfile)
+            timer.begin("killall")
+            killall_success = subprocess.call([os.path.join(SUBMITTY_INSTALL_DIR,"bin","untrusted_execute"),
+                                               which_untrusted,
+                                               os.path.join(SUBMITTY_INSTALL_DIR,"bin","killall.py")],
+                                              stdout=logfile)
 
-        print ("KILLALL COMPLETE my_runner.out",file=logfile)
-        logfile.flush()
+            print ("KILLALL COMPLETE my_runner.out",file=logfile)
+            logfile.flush()
 
-        if killall_success != 0:
-            msg='RUNNER ERROR: had to kill {} process(es)'.format(killall_success)
-            print ("pid",my_pid,msg)
-            grade_items_logging.log_message(is_batch_job,which_untrusted,submission_path,"","",msg)
+            if killall_success != 0:
+                msg='RUNNER ERROR: had to kill {} process(es)'.format(killall_success)
+                print ("pid",my_pid,msg)
+                log_function(msg)
 
     if runner_success == 0:
         print ("pid",my_pid,"RUNNER OK")
     else:
         print ("pid",my_pid,"RUNNER FAILURE")
-        grade_items_logging.log_message(is_batch_job,which_untrusted,submission_path,"","","RUNNER FAILURE")
+        log_function("RUNNER FAILURE")
 
-    untrusted_grant_rwx_access(which_untrusted,tmp_work)
-    untrusted_grant_rwx_access(which_untrusted,tmp_compilation)
+    untrusted_grant_rwx_access(which_untrusted,tmp_work,counts)
+    untrusted_grant_rwx_access(which_untrusted,tmp_compilation,counts)
 
     # --------------------------------------------------------------------
     # RUN VALIDATOR
 
+    timer.begin("validation staging")
     with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
         print ("====================================\nVALIDATION STARTS", file=f)
 
     # copy results files from compilation...
-    patterns_submission_to_validation = complete_config_obj["autograding"]["submission_to_validation"]
+    patterns_submission_to_validation = autograding["submission_to_validation"]
     pattern_copy("submission_to_validation",patterns_submission_to_validation,submission_path,tmp_work,tmp_logs)
     if is_vcs:
         pattern_copy("checkout_to_validation",patterns_submission_to_validation,checkout_subdir_path,tmp_work,tmp_logs)
-    patterns_compilation_to_validation = complete_config_obj["autograding"]["compilation_to_validation"]
+    patterns_compilation_to_validation = autograding["compilation_to_validation"]
     pattern_copy("compilation_to_validation",patterns_compilation_to_validation,tmp_compilation,tmp_work,tmp_logs)
 
     # remove the compilation directory
     shutil.rmtree(tmp_compilation)
 
     # copy output files to tmp_work directory
-    copy_contents_into(test_output_path,tmp_work,tmp_logs)
+    copy_contents_into(inputs["test_output"],tmp_work,tmp_logs)
 
     # copy any instructor custom validation code into the tmp work directory
-    copy_contents_into(custom_validation_code_path,tmp_work,tmp_logs)
+    copy_contents_into(inputs["custom_validation_code"],tmp_work,tmp_logs)
 
-    subprocess.call(['ls', '-lR', '.'], stdout=open(tmp_logs + "/overall.txt", 'a'))
+    # (the diff against the runner phase shows what the run produced)
+    manifest = grading_manifest.write_manifest(tmp_logs,"validation",tmp_work,manifest,MANIFEST_HASHES)
 
     # copy validator.out to the current directory
-    shutil.copy (os.path.join(bin_path,obj["gradeable"],"validate.out"),os.path.join(tmp_work,"my_validator.out"))
+    grading_staging_cache.stage_file(os.path.join(inputs["bin"],"validate.out"),os.path.join(tmp_work,"my_validator.out"),
+                                     stat.S_IROTH | stat.S_IXOTH)
 
     # give the untrusted user read/write/execute permissions on the tmp directory & files
     add_permissions_recursive(tmp_work,
                               stat.S_IROTH | stat.S_IWOTH | stat.S_IXOTH,
                               stat.S_IROTH | stat.S_IWOTH | stat.S_IXOTH,
-                              stat.S_IROTH | stat.S_IWOTH | stat.S_IXOTH)
+                              stat.S_IROTH | stat.S_IWOTH | stat.S_IXOTH,
+                              counts)
 
-    add_permissions(os.path.join(tmp_work,"my_validator.out"),stat.S_IROTH | stat.S_IXOTH)
+    add_permissions(os.path.join(tmp_work,"my_validator.out"),stat.S_IROTH | stat.S_IXOTH,counts)
 
     # validator the validator.out as the untrusted user
+    timer.begin("validate")
     with open(os.path.join(tmp_logs,"validator_log.txt"), 'w') as logfile:
         if USE_DOCKER:
             validator_success = subprocess.call(['docker', 'exec', '-w', tmp_work, container,
-                                                 os.path.join(tmp_work, 'my_validator.out'), obj['gradeable'],
-                                                 obj['who'], str(obj['version']), submission_string], stdout=logfile)
+                                                 os.path.join(tmp_work, 'my_validator.out'), job['gradeable'],
+                                                 job['who'], str(job['version']), submission_string], stdout=logfile)
         else:
             validator_success = subprocess.call([os.path.join(SUBMITTY_INSTALL_DIR,"bin","untrusted_execute"),
                                                  which_untrusted,
                                                  os.path.join(tmp_work,"my_validator.out"),
-                                                 obj["gradeable"],
-                                                 obj["who"],
-                                                 str(obj["version"]),
+                                                 job["gradeable"],
+                                                 job["who"],
+                                                 str(job["version"]),
                                                  submission_string],
                                                 stdout=logfile)
 
@@ -503,120 +663,454 @@ def just_grade_item(next_directory,next_to_grade,which_untrusted):
         print ("pid",my_pid,"VALIDATOR OK")
     else:
         print ("pid",my_pid,"VALIDATOR FAILURE")
-        grade_items_logging.log_message(is_batch_job,which_untrusted,submission_path,"","","VALIDATION FAILURE")
+        log_function("VALIDATION FAILURE")
 
-    untrusted_grant_rwx_access(which_untrusted,tmp_work)
+    timer.begin("archive")
+    untrusted_grant_rwx_access(which_untrusted,tmp_work,counts)
 
-    # grab the result of autograding
-    grade_result = ""
-    with open(os.path.join(tmp_work,"grade.txt")) as f:
-        lines = f.readlines()
-        for line in lines:
-            line = line.rstrip('\n')
-            if line.startswith("Automatic grading total:"):
-                grade_result = line
+    with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
+        print ("PERMISSIONS: checked {} files, {} chmod calls, {} untrusted chmod helper runs".format(
+            counts.get("entries",0),counts.get("chmod",0),counts.get("untrusted chmod",0)), file=f)
+        print ("====================================\nARCHIVING STARTS", file=f)
+
+    grading_manifest.write_manifest(tmp_logs,"archiving",tmp_work,manifest,MANIFEST_HASHES)
+
+    os.chdir(tmp)
 
     # --------------------------------------------------------------------
-    # MAKE RESULTS DIRECTORY & COPY ALL THE FILES THERE
+    # CLEAN UP DOCKER
+    if USE_DOCKER:
+        subprocess.call(['docker', 'rm', '-f', container])
 
-    with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
-        print ("====================================\nARCHIVING STARTS", file=f)
 
-    subprocess.call(['ls', '-lR', '.'], stdout=open(tmp_logs + "/overall.txt", 'a'))
+# ==================================================================================
+# ==================================================================================
+def just_grade_item(next_directory,next_to_grade,which_untrusted,host=None,staging_cache=None,result_cache=None,
+                    shard_untrusted=None,tmp_suffix="",archive=None,vcs_mirrors=None,scratch_fill=0):
+    """
+    Grade one job from a queue and store the results.  The compile / run /
+    validate pipeline runs on this machine, or, if a host is given, on that
+    remote grading machine (see grading_hosts.py).
+
+    :param next_directory: the queue directory
+    :param next_to_grade: the queue file
+    :param which_untrusted: the untrusted user (of the grading machine) to use
+    :param host: None, or the autograding_workers.json entry of the grading machine
+    :param staging_cache: grading_staging_cache.StagingCache of the worker (optional)
+    :param result_cache: grading_result_cache.ResultCache (optional), if it has the results
+                         of a job with the same inputs, they are used instead of grading
+    :param shard_untrusted: more untrusted users (of this machine) the testcases may be run
+                            by in parallel, if the gradeable allows it (optional)
+    :param tmp_suffix: added to the name of the tmp directory of the job (so a pipelined
+                       worker can use two tmp directories in turn)
+    :param archive: None to archive the results before returning, or a function that is
+                    given a function that archives them (e.g., to call it in a thread);
+                    the tmp directory of the job is used until that function returns
+    :param vcs_mirrors: grading_vcs_cache.VcsMirrorCache (optional), to check out the
+                        vcs submissions from instead of cloning the repository every time
+    :param scratch_fill: grade in the tmpfs of the untrusted user (if there is one) the jobs
+                         expected to use at most this fraction of its free space (0 = never)
+    """
 
-    os.chdir(bin_path)
+    my_pid = os.getpid()
 
-    # save the old results path!
-    if os.path.isdir(os.path.join(results_path,"OLD")):
-        shutil.move(os.path.join(results_path,"OLD"),
-                    os.path.join(tmp,"OLD_RESULTS"))
+    # verify the hwcron user is running this script
+    if not int(os.getuid()) == int(HWCRON_UID):
+        grade_items_logging.log_message("ERROR: must be run by hwcron")
+        raise SystemExit("ERROR: the grade_item.py script must be run by the hwcron user")
 
-    # clean out all of the old files if this is a re-run
-    shutil.rmtree(results_path,ignore_errors=True)
+    timer = PhaseTimer()
+    timer.begin("config")
 
-    # create the directory (and the full path if it doesn't already exist)
-    os.makedirs(results_path)
+    # --------------------------------------------------------
+    # figure out what we're supposed to grade & error checking
+    obj = get_submission_path(next_directory,next_to_grade)
+    submission_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],
+                                   "submissions",obj["gradeable"],obj["who"],str(obj["version"]))
+    if not os.path.isdir(submission_path):
+        grade_items_logging.log_message("ERROR: the submission directory does not exist" + submission_path)
+        raise SystemExit("ERROR: the submission directory does not exist",submission_path)
+    print("pid", my_pid, "GRADE THIS", submission_path)
 
-    # bring back the old results!
-    if os.path.isdir(os.path.join(tmp,"OLD_RESULTS")):
-        shutil.move(os.path.join(tmp,"OLD_RESULTS"),
-                    os.path.join(results_path,"OLD"))
+    is_vcs, vcs_type, vcs_base_url, vcs_subdirectory = get_vcs_info(SUBMITTY_DATA_DIR,
+                                                                    obj["semester"],
+                                                                    obj["course"],
+                                                                    obj["gradeable"],
+                                                                    obj["who"],
+                                                                    obj["team"])
 
-    os.makedirs(os.path.join(results_path,"details"))
+    is_batch_job = next_directory == BATCH_QUEUE
+    is_batch_job_string = "BATCH" if is_batch_job else "INTERACTIVE"
 
-    patterns_work_to_details = complete_config_obj["autograding"]["work_to_details"]
-    pattern_copy("work_to_details",patterns_work_to_details,tmp_work,os.path.join(results_path,"details"),tmp_logs)
-
-    if not history_file_tmp == "":
-        shutil.move(history_file_tmp,history_file)
-        # fix permissions
-        ta_group_id = os.stat(results_path).st_gid
-        os.chown(history_file,int(HWCRON_UID),ta_group_id)
-        add_permissions(history_file,stat.S_IRGRP)
-        
-    grading_finished = dateutils.get_current_time()
+    queue_time = get_queue_time(next_directory,next_to_grade)
+    queue_time_longstring = dateutils.write_submitty_date(queue_time)
+    grading_began = dateutils.get_current_time()
+    waittime = int((grading_began-queue_time).total_seconds())
+    grade_items_logging.log_message(is_batch_job,which_untrusted,submission_path,"wait:",waittime,"")
+
+    # --------------------------------------------------------
+    # various paths
+    provided_code_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"provided_code",obj["gradeable"])
+    test_input_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"test_input",obj["gradeable"])
+    test_output_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"test_output",obj["gradeable"])
+    custom_validation_code_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"custom_validation_code",obj["gradeable"])
+    bin_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"bin")
 
-    shutil.copy(os.path.join(tmp_work,"results.json"),results_path)
-    shutil.copy(os.path.join(tmp_work,"grade.txt"),results_path)
+    checkout_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"checkout",obj["gradeable"],obj["who"],str(obj["version"]))
+    results_path = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"results",obj["gradeable"],obj["who"],str(obj["version"]))
+
+    # grab a copy of the current history.json file (if it exists)
+    history_file = os.path.join(results_path,"history.json")
+    history_file_tmp = ""
+    if os.path.isfile(history_file):
+        filehandle,history_file_tmp = tempfile.mkstemp()
+        shutil.copy(history_file,history_file_tmp)
 
-    # -------------------------------------------------------------
-    # create/append to the results history
+    # get info from the gradeable config file
+    json_config = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"config","form","form_"+obj["gradeable"]+".json")
+    gradeable_config_obj = config_cache.load_json(json_config)
 
-    gradeable_deadline_datetime = dateutils.read_submitty_date(gradeable_deadline_string)
-    gradeable_deadline_longstring = dateutils.write_submitty_date(gradeable_deadline_datetime)
-    submission_longstring = dateutils.write_submitty_date(submission_datetime)
+    # get info from the gradeable config file
+    complete_config = os.path.join(SUBMITTY_DATA_DIR,"courses",obj["semester"],obj["course"],"config","complete_config","complete_config_"+obj["gradeable"]+".json")
+    complete_config_obj = config_cache.load_json(complete_config)
+
+    checkout_subdirectory = complete_config_obj["autograding"].get("use_checkout_subdirectory","")
+    checkout_subdir_path = os.path.join(checkout_path,checkout_subdirectory)
+
+    # --------------------------------------------------------------------
+    # MAKE TEMPORARY DIRECTORY & COPY THE NECESSARY FILES THERE
+    if host is None:
+        # in RAM, unless the job is too big for the tmpfs (or there is none)
+        expected_bytes = expected_scratch_bytes(results_path,[submission_path,checkout_path,provided_code_path,
+                                                              test_input_path,test_output_path])
+        scratch = choose_scratch(which_untrusted,expected_bytes,scratch_fill)
+        for other in set([os.path.join(AUTOGRADING_TMP_DIR,which_untrusted),
+                          os.path.join(AUTOGRADING_TMP_DIR,which_untrusted,"ram")]) - set([scratch]):
+            # (what is left from the last job that used the other one)
+            remove_directory(os.path.join(other,"tmp"+tmp_suffix))
+        tmp = os.path.join(scratch,"tmp"+tmp_suffix)
+    else:
+        # the untrusted user belongs to the grading machine, the job is prepared in our own directory
+        tmp = os.path.join(AUTOGRADING_TMP_DIR,"remote",host["name"]+"_"+which_untrusted+tmp_suffix)
+    remove_directory(tmp)
+    os.makedirs(tmp)
+
+    # the trash directory of the worker, for the old checkout & results (see grading_trash.py)
+    worker_trash = os.path.join(AUTOGRADING_TMP_DIR,which_untrusted if host is None else "remote",
+                                grading_trash.TRASH_NAME)
     
-    seconds_late = int((submission_datetime-gradeable_deadline_datetime).total_seconds())
-    # note: negative = not late
-
-    grading_began_longstring = dateutils.write_submitty_date(grading_began)
-    grading_finished_longstring = dateutils.write_submitty_date(grading_finished)
-
-    gradingtime = int((grading_finished-grading_began).total_seconds())
-
-    write_grade_history.just_write_grade_history(history_file,
-                                                 gradeable_deadline_longstring,
-                                                 submission_longstring,
-                                                 seconds_late,
-                                                 queue_time_longstring,
-                                                 is_batch_job_string,
-                                                 grading_began_longstring,
-                                                 waittime,
-                                                 grading_finished_longstring,
-                                                 gradingtime,
-                                                 grade_result)
-
-    #---------------------------------------------------------------------
-    # WRITE OUT VERSION DETAILS
-    if WRITE_DATABASE:
-        insert_database_version_data.insert_to_database(
-            obj["semester"],
-            obj["course"],
-            obj["gradeable"],
-            obj["user"],
-            obj["team"],
-            obj["who"],
-            True if obj["is_team"] else False,
-            str(obj["version"]))
-
-    print ("pid",my_pid,"finished grading ", next_to_grade, " in ", gradingtime, " seconds")
-
-    grade_items_logging.log_message(is_batch_job,which_untrusted,submission_path,"grade:",gradingtime,grade_result)
+    # switch to tmp directory
+    os.chdir(tmp)
 
-    with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
-        f.write("FINISHED GRADING!")
+    # make the logs directory
+    tmp_logs = os.path.join(tmp,"tmp_logs")
+    os.makedirs(tmp_logs)
+    if host is None:
+        with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
+            print ("SCRATCH", tmp, "expected", expected_bytes, "bytes", file=f)
+            if staging_cache is not None and scratch != os.path.join(AUTOGRADING_TMP_DIR,which_untrusted):
+                print ("SCRATCH on tmpfs: the files of the staging cache (on disk) are copied, not linked", file=f)
+
+    # grab the submission time
+    with open (os.path.join(submission_path,".submit.timestamp")) as submission_time_file:
+        submission_string = submission_time_file.read().rstrip()
+    
+    submission_datetime = dateutils.read_submitty_date(submission_string)
+
+    # --------------------------------------------------------------------
+    # CHECKOUT THE STUDENT's REPO
+    vcs_commit = None
+    if is_vcs:
+        timer.begin("vcs checkout")
+        # is vcs_subdirectory standalone or should it be combined with base_url?
+        if vcs_subdirectory[0] == '/' or '://' in vcs_subdirectory:
+            vcs_path = vcs_subdirectory
+        else:
+            if '://' in vcs_base_url:
+                vcs_path = urllib.parse.urljoin(vcs_base_url, vcs_subdirectory)
+            else:
+                vcs_path = os.path.join(vcs_base_url, vcs_subdirectory)
+
+        with open(os.path.join(tmp_logs, "overall.txt"), 'a') as f:
+            print("====================================\nVCS CHECKOUT", file=f)
+            print('vcs_base_url', vcs_base_url, file=f)
+            print('vcs_subdirectory', vcs_subdirectory, file=f)
+            print('vcs_path', vcs_path, file=f)
+
+        # fetch into the local mirror of the repository & check out from there
+        what_version = None
+        if vcs_mirrors is not None:
+            try:
+                with open(os.path.join(tmp_logs, "overall.txt"), 'a') as f:
+                    what_version = vcs_mirrors.checkout(vcs_path,checkout_path,submission_string,f)
+            except (OSError, subprocess.CalledProcessError) as e:
+                grade_items_logging.log_message(is_batch_job,which_untrusted,submission_path,"","",
+                                                "WARNING: could not use the vcs mirror " + repr(e))
+
+        if what_version is None:
+            with open(os.path.join(tmp_logs, "overall.txt"), 'a') as f:
+                print(['/usr/bin/git', 'clone', vcs_path, checkout_path], file=f)
+
+            # cleanup the previous checkout (if it exists)
+            grading_trash.discard(checkout_path,[worker_trash])
+            os.makedirs(checkout_path, exist_ok=True)
+            subprocess.call(['/usr/bin/git', 'clone', vcs_path, checkout_path])
+            os.chdir(checkout_path)
+
+            # determine which version we need to checkout
+            what_version = subprocess.check_output(['git', 'rev-list', '-n', '1', '--before="'+submission_string+'"', 'master'])
+            what_version = str(what_version.decode('utf-8')).rstrip()
+            if what_version == "":
+                # oops, pressed the grade button before a valid commit
+                shutil.rmtree(checkout_path, ignore_errors=True)
+            else:
+                # and check out the right version
+                subprocess.call(['git', 'checkout', '-b', 'grade', what_version])
+        if what_version != "":
+            vcs_commit = what_version
+        os.chdir(tmp)
+        grading_manifest.write_manifest(tmp_logs,"checkout",checkout_path,hashes=MANIFEST_HASHES)
+
+
+    # --------------------------------------------------------------------
+    # COMPILE, RUN & VALIDATE
+
+    job = { "gradeable" : obj["gradeable"],
+            "who" : obj["who"],
+            "version" : obj["version"],
+            "submission_string" : submission_string,
+            "autograding" : complete_config_obj["autograding"] }
+    inputs = { "submission" : submission_path,
+               "checkout" : checkout_subdir_path if is_vcs else None,
+               "provided_code" : provided_code_path,
+               "test_input" : test_input_path,
+               "test_output" : test_output_path,
+               "custom_validation_code" : custom_validation_code_path,
+               "bin" : os.path.join(bin_path,obj["gradeable"]) }
+    log_function = lambda msg: grade_items_logging.log_message(is_batch_job,which_untrusted,submission_path,"","",msg)
+
+    timer.begin("compile staging")
+    if host is None and staging_cache is not None:
+        try:
+            inputs.update(staging_cache.stage((obj["semester"],obj["course"],obj["gradeable"]),inputs))
+        except OSError as e:
+            log_function("WARNING: could not use the staging cache " + repr(e))
+
+    tmp_work = os.path.join(tmp,"TMP_WORK")
+
+    # has a job with exactly the same inputs been graded before?
+    digest = None
+    cache_hit = False
+    if result_cache is not None:
+        timer.begin("result cache")
+        try:
+            if vcs_commit is not None:
+                # (the same commit as an earlier graded version of the student is a hit)
+                digest = grading_result_cache.commit_digest(job,inputs,vcs_commit,
+                                                            complete_config_obj.get("testcases",[]))
+            else:
+                digest = grading_result_cache.job_digest(job,inputs,complete_config_obj.get("testcases",[]))
+            cache_hit = result_cache.restore(digest,tmp_work)
+        except OSError as e:
+            log_function("WARNING: could not use the result cache " + repr(e))
+        with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
+            print ("RESULT CACHE", digest, "HIT" if cache_hit else "MISS", file=f)
+
+    remote_phases = None
+    if cache_hit:
+        log_function("RESULT CACHE HIT")
+        timer.begin("archive")
+    elif host is None:
+        # a gradeable whose testcases don't depend on each other can have them run in parallel
+        shards = None
+        if shard_untrusted and complete_config_obj["autograding"].get("parallel_testcases",False):
+            shards = testcase_shards(complete_config_obj.get("testcases",[]),[which_untrusted]+list(shard_untrusted))
+        grade_staged_job(tmp,which_untrusted,job,inputs,log_function,timer,shards)
+    else:
+        # the phases on the grading machine are in remote_timing.json, this
+        # phase is the whole round trip (including sending the job & results)
+        timer.begin("remote grading")
+        grading_hosts.grade_remotely(host,which_untrusted,tmp,job,inputs,log_function)
+        try:
+            with open(os.path.join(tmp_logs,"remote_timing.json"), 'r') as infile:
+                remote_phases = json.load(infile)
+        except (OSError, ValueError):
+            pass
+        timer.begin("archive")
 
-    # save the logs!
-    shutil.copytree(tmp_logs,os.path.join(results_path,"logs"))
+    patterns_work_to_details = complete_config_obj["autograding"]["work_to_details"]
 
     # --------------------------------------------------------------------
-    # REMOVE TEMP DIRECTORY
-    shutil.rmtree(tmp)
+    # CLOSE THE TMP DIRECTORY
+    # (a pipelined worker archives the job while the untrusted user runs its
+    # next job: the tmp directory is closed to everyone else, & the results
+    # are archived from copies of our own, so the next job can neither read
+    # nor change anything of this one.  the untrusted user can't write to
+    # the directory the tmp directory is in either, so it can't be renamed
+    # & replaced by another one, see INSTALL_SUBMITTY_HELPER.sh)
+    results_work = tmp_work
+    if archive is not None:
+        os.chmod(tmp,0o700)
+        if host is None and not cache_hit and not USE_DOCKER:
+            # (no process of the untrusted user may keep a file of the job open)
+            with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
+                subprocess.call([os.path.join(SUBMITTY_INSTALL_DIR,"bin","untrusted_execute"),
+                                 which_untrusted,
+                                 os.path.join(SUBMITTY_INSTALL_DIR,"bin","killall.py")],
+                                stdout=f)
+        results_work = os.path.join(tmp,"TMP_RESULTS")
+        os.mkdir(results_work)
+        pattern_copy("work_to_results",["grade.txt","results.json"]+patterns_work_to_details,
+                     tmp_work,results_work,tmp_logs)
 
     # --------------------------------------------------------------------
-    # CLEAN UP DOCKER
-    if USE_DOCKER:
-        subprocess.call(['docker', 'rm', '-f', container])
+    # ARCHIVE THE RESULTS
+    # (the untrusted user is done with the job, so a pipelined worker does
+    # this while it grades its next job, see the archive parameter)
+    def archive_job():
+        # grab the result of autograding
+        grade_result = ""
+        with open(os.path.join(results_work,"grade.txt")) as f:
+            lines = f.readlines()
+            for line in lines:
+                line = line.rstrip('\n')
+                if line.startswith("Automatic grading total:"):
+                    grade_result = line
+
+        if digest is not None and not cache_hit and grade_result != "":
+            try:
+                result_cache.store(digest,results_work,patterns_work_to_details)
+            except OSError as e:
+                log_function("WARNING: could not store the results in the result cache " + repr(e))
+
+        # --------------------------------------------------------------------
+        # MAKE RESULTS DIRECTORY & COPY ALL THE FILES THERE
+        # (only absolute paths from here on, this may run in a thread while the
+        # next job changes the working directory)
+
+        # save the old results path!
+        if os.path.isdir(os.path.join(results_path,"OLD")):
+            shutil.move(os.path.join(results_path,"OLD"),
+                        os.path.join(tmp,"OLD_RESULTS"))
+
+        # clean out all of the old files if this is a re-run
+        grading_trash.discard(results_path,[worker_trash])
+
+        # create the directory (and the full path if it doesn't already exist)
+        os.makedirs(results_path)
+
+        # bring back the old results!
+        if os.path.isdir(os.path.join(tmp,"OLD_RESULTS")):
+            shutil.move(os.path.join(tmp,"OLD_RESULTS"),
+                        os.path.join(results_path,"OLD"))
+
+        os.makedirs(os.path.join(results_path,"details"))
+
+        pattern_copy("work_to_details",patterns_work_to_details,results_work,os.path.join(results_path,"details"),tmp_logs)
+
+        if not history_file_tmp == "":
+            shutil.move(history_file_tmp,history_file)
+            # fix permissions
+            ta_group_id = os.stat(results_path).st_gid
+            os.chown(history_file,int(HWCRON_UID),ta_group_id)
+            add_permissions(history_file,stat.S_IRGRP)
+        
+        grading_finished = dateutils.get_current_time()
+
+        shutil.copy(os.path.join(results_work,"results.json"),results_path)
+        shutil.copy(os.path.join(results_work,"grade.txt"),results_path)
+
+        # -------------------------------------------------------------
+        # create/append to the results history
+
+        gradeable_deadline_string = gradeable_config_obj["date_due"]
+        gradeable_deadline_datetime = dateutils.read_submitty_date(gradeable_deadline_string)
+        gradeable_deadline_longstring = dateutils.write_submitty_date(gradeable_deadline_datetime)
+        submission_longstring = dateutils.write_submitty_date(submission_datetime)
+    
+        seconds_late = int((submission_datetime-gradeable_deadline_datetime).total_seconds())
+        # note: negative = not late
+
+        grading_began_longstring = dateutils.write_submitty_date(grading_began)
+        grading_finished_longstring = dateutils.write_submitty_date(grading_finished)
+
+        gradingtime = int((grading_finished-grading_began).total_seconds())
+
+        write_grade_history.just_write_grade_history(history_file,
+                                                     gradeable_deadline_longstring,
+                                                     submission_longstring,
+                                                     seconds_late,
+                                                     queue_time_longstring,
+                                                     is_batch_job_string,
+                                                     grading_began_longstring,
+                                                     waittime,
+                                                     grading_finished_longstring,
+                                                     gradingtime,
+                                                     grade_result,
+                                                     cache_hit,
+                                                     vcs_commit)
+
+        #---------------------------------------------------------------------
+        # WRITE OUT VERSION DETAILS
+        timer.begin("db write")
+        # (in the scheduler, the result sink writes the rows of many jobs together,
+        # the row of an interactive job right away)
+        if WRITE_DATABASE:
+            grading_result_sink.submit(
+                obj["semester"],
+                obj["course"],
+                obj["gradeable"],
+                obj["user"],
+                obj["team"],
+                obj["who"],
+                True if obj["is_team"] else False,
+                str(obj["version"]),
+                urgent=not is_batch_job)
+
+        timer.end()
+
+        print ("pid",my_pid,"finished grading ", next_to_grade, " in ", gradingtime, " seconds")
+
+        grade_items_logging.log_message(is_batch_job,which_untrusted,submission_path,"grade:",gradingtime,grade_result)
+
+        # which phase of the job took the time?  (also in the daily metrics log)
+        timing = { "semester" : obj["semester"],
+                   "course" : obj["course"],
+                   "gradeable" : obj["gradeable"],
+                   "who" : obj["who"],
+                   "version" : obj["version"],
+                   "queue" : is_batch_job_string,
+                   "untrusted" : which_untrusted,
+                   "host" : None if host is None else host["name"],
+                   "pid" : my_pid,
+                   "grading_began" : grading_began_longstring,
+                   "wait" : waittime,
+                   "grade" : gradingtime,
+                   "result" : grade_result,
+                   "result_cache_hit" : cache_hit,
+                   "vcs_commit" : vcs_commit,
+                   "tmp" : tmp,
+                   "phases" : timer.phases }
+        if remote_phases is not None:
+            timing["remote_phases"] = remote_phases
+        with open(os.path.join(tmp_logs,"timing.json"),'w') as outfile:
+            json.dump(timing,outfile,indent=4)
+        grade_items_logging.log_metrics(timing)
+
+        with open(os.path.join(tmp_logs,"overall.txt"),'a') as f:
+            f.write("FINISHED GRADING!")
+
+        # save the logs!
+        shutil.copytree(tmp_logs,os.path.join(results_path,"logs"))
+
+        # --------------------------------------------------------------------
+        # REMOVE TEMP DIRECTORY
+        remove_directory(tmp)
+
+    if archive is None:
+        archive_job()
+    else:
+        archive(archive_job)
 
 
 # ==================================================================================
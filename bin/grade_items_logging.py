@@ -2,7 +2,12 @@
 
 import sys
 from datetime import datetime
+import json
+import multiprocessing
 import os
+import queue
+import signal
+import time
 from submitty_utils import dateutils
 import fcntl
 
@@ -10,6 +15,195 @@ import fcntl
 # these variables will be replaced by INSTALL_SUBMITTY.sh
 AUTOGRADING_LOG_PATH="__INSTALL__FILLIN__AUTOGRADING_LOG_PATH__"
 SUBMITTY_DATA_DIR = "__INSTALL__FILLIN__SUBMITTY_DATA_DIR__"
+AUTOGRADING_METRICS_PATH = os.path.join(SUBMITTY_DATA_DIR,"logs","autograding_metrics")
+
+
+# also write each message, with typed fields, to the json lines log
+# (YYYYMMDD.jsonl next to the YYYYMMDD.txt log, see json_log_record)
+WRITE_JSON_LOG = True
+
+# the log writer process (see start_log_writer) writes what was sent to it
+# at least every LOG_FLUSH_INTERVAL seconds or LOG_BATCH_SIZE lines
+LOG_FLUSH_INTERVAL = 1.0
+LOG_BATCH_SIZE = 200
+LOG_QUEUE_SIZE = 10000
+
+_log_queue = None
+_log_writer = None
+
+
+# ==================================================================================
+def write_lines(path,lines,open_files=None):
+    """
+    Append lines to a log file (locked, in case another process appends to
+    it at the same time).
+
+    :param open_files: dictionary path -> open file of the log writer process
+                       (None: open & close the file here)
+    """
+    if open_files is not None and path in open_files:
+        myfile = open_files[path]
+    else:
+        myfile = open(path,'a')
+    try:
+        fcntl.flock(myfile,fcntl.LOCK_EX)
+        myfile.write("".join(lines))
+        myfile.flush()
+        fcntl.flock(myfile,fcntl.LOCK_UN)
+    finally:
+        if open_files is None:
+            myfile.close()
+        else:
+            open_files[path] = myfile
+
+
+def append_line(path,line):
+    """
+    Append one line to a log file: send it to the log writer process if
+    there is one, otherwise write it here.  A problem with the log never
+    raises, the line is printed to stderr instead.
+    """
+    if _log_queue is not None:
+        try:
+            _log_queue.put_nowait((path,line))
+            return
+        except queue.Full:
+            # the log writer is behind, write it ourselves
+            pass
+    try:
+        write_lines(path,[line])
+    except OSError as e:
+        print ("ERROR: could not write to the log",path,e,line,file=sys.stderr,end="")
+
+
+def sync_and_close(myfile):
+    try:
+        myfile.flush()
+        os.fsync(myfile.fileno())
+    except OSError as e:
+        print ("ERROR: the log writer could not sync",myfile.name,e,file=sys.stderr)
+    myfile.close()
+
+
+def rotate(open_files,path):
+    # the files in a log directory are named by day: when a new day starts, the
+    # file of the previous day will not be written again, sync & close it
+    for old_path in list(open_files.keys()):
+        if os.path.dirname(old_path) == os.path.dirname(path) and \
+           os.path.splitext(old_path)[1] == os.path.splitext(path)[1]:
+            sync_and_close(open_files.pop(old_path))
+
+
+def flush(pending,open_files):
+    for path, lines in pending.items():
+        if path not in open_files:
+            rotate(open_files,path)
+        try:
+            write_lines(path,lines,open_files)
+        except OSError as e:
+            print ("ERROR: the log writer could not write to",path,e,file=sys.stderr)
+    pending.clear()
+
+
+def log_writer(log_queue):
+    """
+    The log writer process: appends the lines sent by all the processes of
+    the scheduler to the log files, in batches, until it gets None.
+    """
+    global _log_queue
+    _log_queue = None
+    # a keyboard interrupt of the scheduler is sent to us too, but we keep
+    # going until the scheduler sends None (see stop_log_writer)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pending = {}
+    open_files = {}
+    count = 0
+    last_flush = time.time()
+    while True:
+        try:
+            item = log_queue.get(timeout=LOG_FLUSH_INTERVAL)
+        except queue.Empty:
+            item = ()
+        if item is None:
+            break
+        if item:
+            path, line = item
+            pending.setdefault(path,[]).append(line)
+            count += 1
+        if count >= LOG_BATCH_SIZE or time.time() - last_flush >= LOG_FLUSH_INTERVAL:
+            flush(pending,open_files)
+            count = 0
+            last_flush = time.time()
+    flush(pending,open_files)
+    for myfile in open_files.values():
+        sync_and_close(myfile)
+
+
+def start_log_writer():
+    """
+    Start the log writer process.  The processes started after this (e.g.,
+    the grading workers) send their log lines to it, so that no worker waits
+    for (or fails because of) the log files.
+    """
+    global _log_queue, _log_writer
+    _log_queue = multiprocessing.Queue(LOG_QUEUE_SIZE)
+    _log_writer = multiprocessing.Process(target=log_writer,args=(_log_queue,))
+    _log_writer.start()
+
+
+def stop_log_writer(timeout=10):
+    """
+    Write everything that was sent to the log writer process & stop it.
+    """
+    global _log_queue, _log_writer
+    if _log_writer is None:
+        return
+    log_queue = _log_queue
+    _log_queue = None
+    log_queue.put(None)
+    _log_writer.join(timeout)
+    _log_writer = None
+
+
+# ==================================================================================
+
+
+def json_log_record(now,is_batch,which_untrusted,abbrev_jobname,timelabel,elapsed_time,message):
+    """
+    The fields of a log message as a dictionary, e.g.
+
+    {"time": "2017-09-05 14:03:22-0400", "pid": 1234, "queue": "INTERACTIVE",
+     "untrusted": "untrusted00", "semester": "f17", "course": "csci1200",
+     "gradeable": "hw01", "who": "smithj", "version": 2, "phase": "grade",
+     "elapsed": 12, "result": "Automatic grading total: 10 / 10", "job": "f17/csci1200/..."}
+
+    The job fields (and queue) are null if the message is not about a
+    submission (e.g., a message of the scheduler), elapsed is null if
+    there is no elapsed time.
+    """
+    record = { "time" : dateutils.write_submitty_date(now),
+               "pid" : os.getpid(),
+               "queue" : None,
+               "untrusted" : which_untrusted if which_untrusted != "" else None,
+               "semester" : None,
+               "course" : None,
+               "gradeable" : None,
+               "who" : None,
+               "version" : None,
+               "phase" : timelabel.rstrip(":") if timelabel != "" else None,
+               "elapsed" : elapsed_time if elapsed_time != "" else None,
+               "result" : message,
+               "job" : abbrev_jobname if abbrev_jobname != "" else None }
+    # semester/course/submissions/gradeable/who/version
+    things = abbrev_jobname.split("/")
+    if len(things) == 6 and things[2] == "submissions":
+        record["queue"] = "BATCH" if is_batch else "INTERACTIVE"
+        record["semester"] = things[0]
+        record["course"] = things[1]
+        record["gradeable"] = things[3]
+        record["who"] = things[4]
+        record["version"] = int(things[5]) if things[5].isdigit() else things[5]
+    return record
 
 
 def log_message(is_batch,which_untrusted,jobname,timelabel,elapsed_time,message):
@@ -22,15 +216,28 @@ def log_message(is_batch,which_untrusted,jobname,timelabel,elapsed_time,message)
     batch_string = "BATCH" if is_batch else ""
     abbrev_jobname = jobname[len(SUBMITTY_DATA_DIR+"/courses/"):]
     time_unit = "" if elapsed_time=="" else "sec"
-    with open(autograding_log_file,'a') as myfile:
-        fcntl.flock(myfile,fcntl.LOCK_EX | fcntl.LOCK_NB)
-        print ("%s | %6s | %5s | %11s | %-75s | %-6s %5s %3s | %s"
-               % (easy_to_read_date,my_pid,batch_string,which_untrusted,
-                  abbrev_jobname,timelabel,elapsed_time,time_unit,message),
-               file=myfile)
-        fcntl.flock(myfile,fcntl.LOCK_UN)
+    append_line(autograding_log_file,
+                "%s | %6s | %5s | %11s | %-75s | %-6s %5s %3s | %s\n"
+                % (easy_to_read_date,my_pid,batch_string,which_untrusted,
+                   abbrev_jobname,timelabel,elapsed_time,time_unit,message))
+
+    if WRITE_JSON_LOG:
+        record = json_log_record(now,is_batch,which_untrusted,abbrev_jobname,timelabel,elapsed_time,message)
+        append_line(os.path.join(AUTOGRADING_LOG_PATH,datetime.strftime(now,"%Y%m%d")+".jsonl"),
+                    json.dumps(record,separators=(',',':'))+"\n")
+
+
+def log_metrics(record):
+    """
+    Append a record (e.g., the phase timings of a graded job) as one json
+    line to the daily metrics log, YYYYMMDD.jsonl in AUTOGRADING_METRICS_PATH.
+    """
+    now = dateutils.get_current_time()
+    datefile=datetime.strftime(now,"%Y%m%d")+".jsonl"
+    metrics_file=os.path.join(AUTOGRADING_METRICS_PATH,datefile)
+    append_line(metrics_file,json.dumps(record,sort_keys=True,separators=(',',':'))+"\n")
+
 
-    
 def log_error(jobname,message):
     log_message("","",jobname,"","","ERROR: "+message)
     print ("ERROR :",jobname,":",message)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+Grades one job sent by the grading scheduler of another machine (see
+grading_hosts.py).  The job is read as a tar stream from stdin and the
+results are written as a tar stream to stdout, so the scheduler runs:
+
+    ssh hwcron@<grading machine> .../bin/grade_remote_job.py untrustedNN
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+
+import grade_item
+import grading_hosts
+
+# these variables will be replaced by INSTALL_SUBMITTY.sh
+HWCRON_UID = "__INSTALL__FILLIN__HWCRON_UID__"
+
+
+# ==================================================================================
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("which_untrusted")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # verify the hwcron user is running this script
+    if not int(os.getuid()) == int(HWCRON_UID):
+        raise SystemExit("ERROR: the grade_remote_job.py script must be run by the hwcron user")
+
+    # stdout is reserved for the results, everything else that is printed
+    # (by us or the programs we run) goes to stderr
+    results_stream = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    tmp = os.path.join(grade_item.AUTOGRADING_TMP_DIR, args.which_untrusted, "tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    os.chdir(tmp)
+
+    # the untrusted user can read tmp, but must not see the inputs (e.g., the expected output)
+    # the job also brings the tmp_logs of the scheduler machine (e.g., the vcs checkout)
+    tmp_inputs = os.path.join(tmp, "TMP_INPUTS")
+    os.mkdir(tmp_inputs, 0o700)
+    job, inputs = grading_hosts.unpack_job(sys.stdin.buffer, tmp_inputs)
+    os.rename(os.path.join(tmp_inputs, "tmp_logs"), os.path.join(tmp, "tmp_logs"))
+
+    messages = []
+    timer = grade_item.PhaseTimer()
+    grade_item.grade_staged_job(tmp, args.which_untrusted, job, inputs, messages.append, timer)
+    shutil.rmtree(tmp_inputs)
+    timer.end()
+    with open(os.path.join(tmp, "tmp_logs", "remote_timing.json"), 'w') as outfile:
+        json.dump(timer.phases, outfile, indent=4)
+
+    with results_stream:
+        grading_hosts.pack_results(results_stream, tmp, job["autograding"]["work_to_details"], messages)
+
+    os.chdir(grade_item.AUTOGRADING_TMP_DIR)
+    shutil.rmtree(tmp)
+
+
+# ==================================================================================
+if __name__ == "__main__":
+    main()
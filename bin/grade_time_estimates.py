@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""
+Estimates of how long a submission to each gradeable takes to grade,
+used by the scheduler to order the batch queue shortest expected job
+first.
+
+The estimates are learned from (in order of preference):
+  - the grading time of the jobs the scheduler has dispatched since it
+    started (a running average),
+  - the "grade" records of the recent json lines autograding logs,
+  - the grade_time of a sample of the history.json files of the gradeable,
+and if none of those are available, the max_possible_grading_time from
+the queue file (written from the build_<gradeable>.json file).
+
+The history.json files are read by a background thread (the first job of
+a gradeable that is not in the logs gets the fallback estimate), so the
+dispatcher thread never waits on the course directories.
+"""
+
+import json
+import os
+import queue
+import threading
+
+# these variables will be replaced by INSTALL_SUBMITTY.sh
+AUTOGRADING_LOG_PATH = "__INSTALL__FILLIN__AUTOGRADING_LOG_PATH__"
+SUBMITTY_DATA_DIR = "__INSTALL__FILLIN__SUBMITTY_DATA_DIR__"
+
+
+def parse_log_line(line):
+    """
+    Extract the gradeable & grading time from a "grade" record of the json
+    lines autograding log (see grade_items_logging.json_log_record).
+
+    :return: tuple ("semester/course/gradeable", seconds), or None for other records
+    """
+    try:
+        record = json.loads(line)
+        if record["phase"] != "grade" or record["gradeable"] is None:
+            return None
+        seconds = int(record["elapsed"])
+        return "/".join([record["semester"], record["course"], record["gradeable"]]), seconds
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class GradeTimeEstimator(object):
+
+    def __init__(self, default_time=60, history_samples=20, smoothing=0.2):
+        """
+        :param default_time: estimate (in seconds) when nothing is known about a gradeable
+        :param history_samples: max # of history.json files read per gradeable
+        :param smoothing: weight of each new observation in the running average
+        """
+        self.default_time = default_time
+        self.history_samples = history_samples
+        self.smoothing = smoothing
+        self.estimates = {}
+        self.sampled = set()
+        self.lock = threading.Lock()
+        self.to_sample = queue.Queue()
+        self.sampler = None
+
+    def load_logs(self, days=14):
+        """
+        Average the grading times in the most recent daily json lines autograding logs.
+        """
+        totals = {}
+        if not os.path.isdir(AUTOGRADING_LOG_PATH):
+            return
+        log_files = sorted(f for f in os.listdir(AUTOGRADING_LOG_PATH) if f.endswith(".jsonl"))
+        for log_file in log_files[-days:]:
+            with open(os.path.join(AUTOGRADING_LOG_PATH, log_file), 'r', errors='replace') as infile:
+                for line in infile:
+                    parsed = parse_log_line(line)
+                    if parsed is None:
+                        continue
+                    total = totals.setdefault(parsed[0], [0, 0])
+                    total[0] += parsed[1]
+                    total[1] += 1
+        with self.lock:
+            for key, (seconds, count) in totals.items():
+                self.estimates[key] = seconds / count
+
+    def sample_history(self, key):
+        """
+        Average the grade_time of the latest grading of one version from
+        each of (up to) history_samples submitters to the gradeable.
+        """
+        semester, course, gradeable = key.split("/")
+        results_path = os.path.join(SUBMITTY_DATA_DIR, "courses", semester, course, "results", gradeable)
+        times = []
+        try:
+            for who in os.scandir(results_path):
+                if len(times) >= self.history_samples:
+                    break
+                if not who.is_dir():
+                    continue
+                for version in os.scandir(who.path):
+                    history_file = os.path.join(version.path, "history.json")
+                    try:
+                        with open(history_file, 'r') as infile:
+                            history = json.load(infile)
+                        times.append(int(history[-1]["grade_time"]))
+                        break
+                    except (OSError, ValueError, KeyError, IndexError, TypeError):
+                        continue
+        except OSError:
+            return
+        if times:
+            with self.lock:
+                # (unless a job of the gradeable finished in the meantime)
+                self.estimates.setdefault(key, sum(times) / len(times))
+
+    def sample_in_background(self, key):
+        self.sampled.add(key)
+        if self.sampler is None:
+            self.sampler = threading.Thread(target=self.sample_loop, name="history sampler", daemon=True)
+            self.sampler.start()
+        self.to_sample.put(key)
+
+    def sample_loop(self):
+        while True:
+            key = self.to_sample.get()
+            try:
+                self.sample_history(key)
+            except Exception:
+                # (keep sampling the other gradeables, this one gets the fallback estimate)
+                continue
+
+    def estimate(self, job):
+        """
+        :param job: grading_dispatcher.Job
+        :return: the expected # of seconds to grade the job
+        """
+        key = job.gradeable_key()
+        estimate = self.estimates.get(key)
+        if estimate is not None:
+            return estimate
+        if key not in self.sampled:
+            self.sample_in_background(key)
+        try:
+            max_time = int(job.get("max_possible_grading_time", -1))
+        except (TypeError, ValueError):
+            max_time = -1
+        if max_time > 0:
+            return max_time
+        return self.default_time
+
+    def observe(self, job, seconds):
+        """
+        Fold the measured grading time of a finished job into the estimate.
+        """
+        key = job.gradeable_key()
+        with self.lock:
+            if key in self.estimates:
+                self.estimates[key] += self.smoothing * (seconds - self.estimates[key])
+            else:
+                self.estimates[key] = seconds
@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+
+"""
+The dispatcher used by submitty_grading_scheduler.py.
+
+A single thread in the scheduler process owns the interactive & batch
+queues and hands each job to an idle worker over that worker's own
+pipe.  The workers never touch the queues or any shared lock: they
+block on their pipe until a job arrives, grade it, and send the queue
+file back to report that they are idle again.  New jobs (from the
+watchdog observer) arrive on another pipe, so the dispatcher wakes up
+as soon as a queue file appears or a worker finishes.
+
+Interactive jobs have priority over batch jobs.  To keep a steady
+stream of interactive submissions from starving the batch queue, at
+most batch_starvation_limit interactive jobs are dispatched in a row
+while batch jobs are waiting (0 disables this protection).
+
+The batch queue is either a single FIFO (the default) or a weighted
+fair queue with one flow per course (or per gradeable), so that a large
+regrade for one course does not hold up the batch work of the others.
+
+There is a pair of interactive & batch queues for each capability
+required by the gradeables (e.g., "default", "cpp", "java", "matlab"),
+and a worker only grades the jobs of the capabilities it provides.
+"""
+
+import heapq
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+from collections import deque
+from multiprocessing import Pipe
+from multiprocessing.connection import wait
+
+import grading_job_index
+
+# how often (in seconds) the dispatcher tries again to read the queue files
+# that were not completely written when they appeared, & how long (in
+# seconds) before it queues them anyway
+UNREADABLE_RETRY_INTERVAL = 1
+UNREADABLE_TIMEOUT = 60
+
+
+# ==================================================================================
+class Job(object):
+    """
+    A queue file waiting in (or handed out from) the dispatcher.  The
+    contents of the queue file are loaded lazily, as the file may not be
+    completely written when the watchdog observer first reports it (the
+    contents given when the job is made may also be partial, e.g., the
+    fields recorded in the job index).
+    """
+
+    def __init__(self, path, is_batch, queue_time, obj=None):
+        self.path = path
+        self.is_batch = is_batch
+        self.queue_time = queue_time
+        self._obj = obj
+        self._loaded = False
+        self.dispatched = None
+        self._capability = None
+
+    def load(self):
+        """
+        :return: True if the queue file has been read
+        """
+        if not self._loaded:
+            obj = grading_job_index.read_queue_file(self.path)
+            if obj is not None:
+                self._obj = obj
+                self._loaded = True
+        return self._loaded
+
+    def readable(self):
+        """
+        :return: True if the capability required by the job is known
+        """
+        if self._obj is not None and self._obj.get("required_capabilities") is not None:
+            return True
+        return self.load()
+
+    def get(self, field, default=None):
+        if self._obj is None or self._obj.get(field) is None:
+            self.load()
+        if self._obj is not None and self._obj.get(field) is not None:
+            return self._obj[field]
+        return grading_job_index.parse_queue_file_name(self.path).get(field, default)
+
+    def course_key(self):
+        return "{}/{}".format(self.get("semester", ""), self.get("course", ""))
+
+    def capability(self):
+        # the capability is fixed once the job is queued (see fix_capability),
+        # the "default" of a queue file that can't be read yet is not remembered
+        if self._capability is not None:
+            return self._capability
+        return str(self.get("required_capabilities", "default"))
+
+    def fix_capability(self):
+        self._capability = self.capability()
+        return self._capability
+
+    def gradeable_key(self):
+        return "{}/{}".format(self.course_key(), self.get("gradeable", ""))
+
+
+class FifoQueue(object):
+    """
+    Jobs ordered by the time they entered the queue.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, job):
+        heapq.heappush(self.heap, (job.queue_time, next(self.sequence), job))
+
+    def pop(self):
+        """
+        :return: the next job, or None if no job can be started right now
+        """
+        if not self.heap:
+            return None
+        return heapq.heappop(self.heap)[2]
+
+    def started(self, job):
+        pass
+
+    def finished(self, job):
+        pass
+
+
+class ShortestExpectedFirstQueue(object):
+    """
+    Jobs ordered by their expected grading time (shortest first), which
+    minimizes the mean turnaround of a bulk regrade.  To bound the wait
+    of the long jobs, a job that has been waiting for more than max_wait
+    seconds is taken before any other (oldest first).
+    """
+
+    def __init__(self, estimator, max_wait=0):
+        """
+        :param estimator: grade_time_estimates.GradeTimeEstimator
+        :param max_wait: seconds after which a job is graded regardless of its
+                         expected time (0 = never)
+        """
+        self.estimator = estimator
+        self.max_wait = max_wait
+        self.by_expected_time = []
+        self.by_queue_time = []
+        self.taken = set()
+        self.sequence = itertools.count()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, job):
+        sequence = next(self.sequence)
+        heapq.heappush(self.by_expected_time, (self.estimator.estimate(job), job.queue_time, sequence, job))
+        heapq.heappush(self.by_queue_time, (job.queue_time, sequence, job))
+        self.count += 1
+
+    def _pop_from(self, heap):
+        # each job is in both heaps, skip the ones already taken from the other heap
+        while heap:
+            entry = heapq.heappop(heap)
+            sequence = entry[-2]
+            if sequence in self.taken:
+                self.taken.remove(sequence)
+                continue
+            self.taken.add(sequence)
+            self.count -= 1
+            return entry[-1]
+        return None
+
+    def pop(self):
+        while self.by_queue_time and self.by_queue_time[0][1] in self.taken:
+            self.taken.remove(heapq.heappop(self.by_queue_time)[1])
+        if self.max_wait > 0 and self.by_queue_time and \
+           time.time() - self.by_queue_time[0][0] > self.max_wait:
+            return self._pop_from(self.by_queue_time)
+        return self._pop_from(self.by_expected_time)
+
+    def started(self, job):
+        pass
+
+    def finished(self, job):
+        pass
+
+
+class FairShareQueue(object):
+    """
+    Weighted fair queuing across flows (one flow per course, or per
+    gradeable).  Each flow keeps its own FIFO; every time a job is taken
+    from a flow, the flow's virtual time advances by 1/weight, and the
+    next job comes from the eligible flow with the smallest virtual time.
+    A flow that was empty restarts at the current virtual time so it
+    cannot bank credit while idle.  A course that has reached its
+    concurrency cap is not eligible until one of its jobs finishes.
+    """
+
+    def __init__(self, key="course", weights=None, default_weight=1,
+                 max_running=None, default_max_running=0, make_flow=FifoQueue, running=None):
+        """
+        :param key: "course" or "gradeable", what the flows are keyed on
+        :param weights: dictionary of "semester/course" (or "semester/course/gradeable")
+                        to relative weight
+        :param default_weight: weight of the flows not in weights
+        :param max_running: dictionary of "semester/course" to the maximum # of batch
+                            jobs of that course graded at the same time
+        :param default_max_running: cap for the courses not in max_running (0 = no cap)
+        :param make_flow: creates the queue used for the jobs of each flow
+        :param running: dictionary of "semester/course" to # of running jobs (may be
+                        shared between several queues)
+        """
+        self.make_flow = make_flow
+        self.key = key
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.max_running = max_running or {}
+        self.default_max_running = default_max_running
+        self.flows = {}
+        self.virtual_time = {}
+        self.running = {} if running is None else running
+        self.now = 0.0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def flow_key(self, job):
+        return job.gradeable_key() if self.key == "gradeable" else job.course_key()
+
+    def weight(self, flow):
+        if flow in self.weights:
+            return float(self.weights[flow])
+        course = "/".join(flow.split("/")[0:2])
+        return float(self.weights.get(course, self.default_weight))
+
+    def cap(self, course):
+        return self.max_running.get(course, self.default_max_running)
+
+    def push(self, job):
+        flow = self.flow_key(job)
+        if flow not in self.flows:
+            self.flows[flow] = self.make_flow()
+        if len(self.flows[flow]) == 0:
+            self.virtual_time[flow] = max(self.virtual_time.get(flow, 0.0), self.now)
+        self.flows[flow].push(job)
+        self.count += 1
+
+    def pop(self):
+        best = None
+        for flow, queue in self.flows.items():
+            if len(queue) == 0:
+                continue
+            course = "/".join(flow.split("/")[0:2])
+            cap = self.cap(course)
+            if cap > 0 and self.running.get(course, 0) >= cap:
+                continue
+            finish = self.virtual_time[flow] + 1.0/self.weight(flow)
+            if best is None or finish < best[0]:
+                best = (finish, flow)
+        if best is None:
+            return None
+        finish, flow = best
+        self.now = self.virtual_time[flow]
+        self.virtual_time[flow] = finish
+        self.count -= 1
+        return self.flows[flow].pop()
+
+    def started(self, job):
+        course = job.course_key()
+        self.running[course] = self.running.get(course, 0) + 1
+
+    def finished(self, job):
+        course = job.course_key()
+        self.running[course] = max(0, self.running.get(course, 0) - 1)
+
+
+def batch_queue_factory(config, estimator=None):
+    """
+    Prepare a function that builds the batch queue described by the
+    scheduler configuration (there is one batch queue per capability).
+
+    :param config: the scheduler configuration
+    :param estimator: grade_time_estimates.GradeTimeEstimator (required for the
+                      "shortest_expected_first" batch order)
+    """
+    if config.get("batch_order", "fifo") == "shortest_expected_first":
+        make_flow = lambda: ShortestExpectedFirstQueue(estimator, config.get("max_batch_wait", 0))
+    else:
+        make_flow = FifoQueue
+    if config.get("batch_policy", "fifo") == "fair_share":
+        fair_share = config.get("fair_share", {})
+        # the concurrency caps are per course, across all the capabilities
+        running = {}
+        return lambda: FairShareQueue(key=fair_share.get("key", "course"),
+                                      weights=fair_share.get("weights"),
+                                      default_weight=fair_share.get("default_weight", 1),
+                                      max_running=fair_share.get("max_running"),
+                                      default_max_running=fair_share.get("default_max_running", 0),
+                                      make_flow=make_flow,
+                                      running=running)
+    return make_flow
+
+
+# ==================================================================================
+class WaitTimeMetrics(object):
+    """
+    Per course (and queue) statistics on how long jobs waited before
+    being handed to a worker, periodically written out as json.
+    """
+
+    def __init__(self, metrics_file=None, interval=60):
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.stats = {}
+        self.last_write = time.time()
+
+    def record(self, job, now):
+        which = "batch" if job.is_batch else "interactive"
+        stats = self.stats.setdefault(job.course_key(), {}).setdefault(
+            which, {"graded": 0, "total_wait": 0.0, "max_wait": 0.0})
+        waited = max(0.0, now-job.queue_time)
+        stats["graded"] += 1
+        stats["total_wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+
+    def write_if_due(self, dispatcher):
+        if self.metrics_file is None or time.time()-self.last_write < self.interval:
+            return
+        self.last_write = time.time()
+        pending = {}
+        for job in dispatcher.pending_jobs():
+            which = "batch" if job.is_batch else "interactive"
+            key = (job.course_key(), which)
+            pending[key] = pending.get(key, 0) + 1
+        courses = {}
+        for course, queues in self.stats.items():
+            for which, stats in queues.items():
+                courses.setdefault(course, {})[which] = {
+                    "graded": stats["graded"],
+                    "mean_wait": round(stats["total_wait"]/stats["graded"], 1),
+                    "max_wait": round(stats["max_wait"], 1),
+                    "pending": pending.pop((course, which), 0)}
+        for (course, which), count in pending.items():
+            courses.setdefault(course, {})[which] = {"graded": 0, "mean_wait": 0, "max_wait": 0,
+                                                     "pending": count}
+        # write a temporary file & rename, so readers never see a partial file
+        directory = os.path.dirname(self.metrics_file)
+        fd, tmp_name = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as outfile:
+            json.dump({"updated": time.strftime("%Y-%m-%d %H:%M:%S"), "courses": courses},
+                      outfile, indent=4, sort_keys=True)
+        os.chmod(tmp_name, 0o640)
+        os.rename(tmp_name, self.metrics_file)
+
+
+# ==================================================================================
+class Dispatcher(object):
+    """
+    Workers are registered with the set of capabilities they provide, and
+    each job goes to the queues of the capability it requires (the
+    required_capabilities of the gradeable, "default" if unspecified).
+    An idle worker only takes jobs from the queues of its capabilities,
+    looking first at its rarest capability, so that the workers reserved
+    for an expensive capability are not tied up by jobs any worker could
+    grade (and vice versa).
+    """
+
+    def __init__(self, batch_starvation_limit=0, make_batch_queue=FifoQueue, metrics=None,
+                 estimator=None, log_function=print):
+        """
+        :param batch_starvation_limit: maximum # of interactive jobs dispatched in a row
+                                       while batch jobs are waiting (0 = no limit)
+        :param make_batch_queue: creates the batch queue of each capability
+        :param metrics: WaitTimeMetrics to record the wait times in (optional)
+        :param estimator: GradeTimeEstimator to report the grading times to (optional)
+        :param log_function: called with a message string for errors
+        """
+        self.batch_starvation_limit = batch_starvation_limit
+        self.make_batch_queue = make_batch_queue
+        self.log = log_function
+        self.interactive = {}
+        self.batch = {}
+        self.metrics = metrics
+        self.estimator = estimator
+        self.consecutive_interactive = 0
+        self.workers = {}
+        self.capabilities = {}
+        self.unsupported = set()
+        self.idle = deque()
+        self.busy = {}
+        self.unreadable = []
+        self._incoming, self._submit_end = Pipe(duplex=False)
+        self._submit_lock = threading.Lock()
+        self._thread = None
+
+    # ------------------------------------------------------------------
+    # called from the other threads of the scheduler process
+
+    def submit(self, path, is_batch, obj=None):
+        """
+        Hand a new queue file to the dispatcher thread.  Safe to call
+        from any thread (e.g., the watchdog observer).
+        """
+        with self._submit_lock:
+            self._submit_end.send((path, is_batch, obj))
+
+    def wake(self):
+        """
+        Let the dispatcher look again at the queue files it could not read
+        yet (e.g., one of them was just modified).  Safe to call from any thread.
+        """
+        with self._submit_lock:
+            self._submit_end.send(None)
+
+    def add_worker(self, name, connection, capabilities=("default",)):
+        """
+        Register the dispatcher's end of a worker's pipe.  Must be called
+        before start().
+        """
+        self.workers[connection] = name
+        self.capabilities[connection] = list(capabilities)
+        self.idle.append(connection)
+
+    def start(self):
+        # each worker looks at its rarest capabilities first
+        providers = {}
+        for capabilities in self.capabilities.values():
+            for capability in capabilities:
+                providers[capability] = providers.get(capability, 0) + 1
+        for connection in self.capabilities:
+            self.capabilities[connection].sort(key=lambda capability: providers[capability])
+        for capability in self.interactive:
+            self.check_capability(capability)
+        self._thread = threading.Thread(target=self.run, name="dispatcher", daemon=True)
+        self._thread.start()
+
+    def is_alive(self):
+        """
+        :return: True if the dispatcher thread is running (it is started again by start())
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    # ------------------------------------------------------------------
+    # only used by the dispatcher thread (or before it starts)
+
+    def add_job(self, path, is_batch, queue_time=None, obj=None):
+        if queue_time is None:
+            try:
+                queue_time = os.path.getctime(path)
+            except OSError:
+                queue_time = time.time()
+        job = Job(path, is_batch, queue_time, obj)
+        if not job.readable():
+            # not completely written yet (see retry_unreadable)
+            self.unreadable.append((time.time(), job))
+            return
+        self.enqueue(job)
+
+    def retry_unreadable(self):
+        """
+        Queue the jobs whose queue file has become readable.  A job whose
+        queue file still can't be read after UNREADABLE_TIMEOUT seconds is
+        queued with the "default" capability (and its grading fails), and
+        the jobs whose queue file was removed are dropped.
+        """
+        still_unreadable = []
+        for since, job in self.unreadable:
+            if job.readable():
+                self.enqueue(job)
+            elif not os.path.exists(job.path):
+                continue
+            elif time.time()-since > UNREADABLE_TIMEOUT:
+                self.log("ERROR: could not read queue file " + job.path)
+                self.enqueue(job)
+            else:
+                still_unreadable.append((since, job))
+        self.unreadable = still_unreadable
+
+    def enqueue(self, job):
+        capability = job.fix_capability()
+        if capability not in self.interactive:
+            self.interactive[capability] = FifoQueue()
+            self.batch[capability] = self.make_batch_queue()
+        if self._thread is not None:
+            self.check_capability(capability)
+        if job.is_batch:
+            self.batch[capability].push(job)
+        else:
+            self.interactive[capability].push(job)
+
+    def check_capability(self, capability):
+        """
+        Log (once) that some jobs require a capability no worker provides,
+        these jobs wait in their queues until the scheduler is reconfigured.
+        """
+        if capability in self.unsupported:
+            return
+        if not any(capability in capabilities for capabilities in self.capabilities.values()):
+            self.unsupported.add(capability)
+            self.log("ERROR: no worker has the capability '" + capability + "' required by some jobs")
+
+    def pending_jobs(self, queue=None):
+        if queue is None:
+            return [job for queues in [self.interactive, self.batch]
+                    for queue in queues.values() for job in self.pending_jobs(queue)]
+        if isinstance(queue, FairShareQueue):
+            return [job for flow in queue.flows.values() for job in self.pending_jobs(flow)]
+        if isinstance(queue, ShortestExpectedFirstQueue):
+            return [entry[-1] for entry in queue.by_queue_time if entry[-2] not in queue.taken]
+        return [entry[2] for entry in queue.heap]
+
+    def next_job(self, capabilities):
+        """
+        Choose the next job for a worker with the given capabilities,
+        prioritizing interactive jobs over batch jobs (subject to the
+        starvation limit).
+
+        :return: the next job, or None if no job can be started right now
+        """
+        interactive = [self.interactive[c] for c in capabilities
+                       if c in self.interactive and len(self.interactive[c])]
+        batch = [self.batch[c] for c in capabilities if c in self.batch and len(self.batch[c])]
+        if interactive and batch and self.batch_starvation_limit > 0 and \
+           self.consecutive_interactive >= self.batch_starvation_limit:
+            for queue in batch:
+                job = queue.pop()
+                if job is not None:
+                    self.consecutive_interactive = 0
+                    return job
+        if interactive:
+            if batch:
+                self.consecutive_interactive += 1
+            return interactive[0].pop()
+        for queue in batch:
+            job = queue.pop()
+            if job is not None:
+                self.consecutive_interactive = 0
+                return job
+        return None
+
+    def dispatch(self):
+        still_idle = deque()
+        while self.idle:
+            connection = self.idle.popleft()
+            job = self.next_job(self.capabilities[connection])
+            if job is None:
+                still_idle.append(connection)
+                continue
+            try:
+                connection.send(job.path)
+            except (OSError, EOFError):
+                # give the job to someone else
+                self.lost_worker(connection)
+                self.enqueue(job)
+                continue
+            self.busy[connection] = job
+            job.dispatched = time.time()
+            if job.is_batch:
+                self.batch[job.capability()].started(job)
+            if self.metrics is not None:
+                self.metrics.record(job, time.time())
+        self.idle = still_idle
+
+    def job_finished(self, connection, success=True):
+        job = self.busy.pop(connection, None)
+        if job is None:
+            return
+        if job.is_batch:
+            self.batch[job.capability()].finished(job)
+        if success and self.estimator is not None:
+            self.estimator.observe(job, time.time()-job.dispatched)
+
+    def lost_worker(self, connection):
+        self.log("ERROR: lost connection to worker " + self.workers[connection])
+        del self.workers[connection]
+        del self.capabilities[connection]
+        self.job_finished(connection, success=False)
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                # (an unexpected error in one pass must not stop the scheduler
+                # from handing out jobs: log it & go on with the next pass)
+                self.log("ERROR: dispatcher " + traceback.format_exc())
+                time.sleep(1)
+
+    def run_once(self):
+        """
+        Hand out the jobs the idle workers can take, then wait for a new
+        job, a finished job, or the next metrics / retry interval.
+        """
+        self.retry_unreadable()
+        # also hands out the jobs recovered from the queue folders at startup
+        self.dispatch()
+        if self.metrics is not None:
+            try:
+                self.metrics.write_if_due(self)
+            except OSError as e:
+                self.log("ERROR: could not write scheduler metrics " + repr(e))
+        timeout = None if self.metrics is None else self.metrics.interval
+        if self.unreadable:
+            timeout = min(timeout or UNREADABLE_RETRY_INTERVAL, UNREADABLE_RETRY_INTERVAL)
+        for connection in wait([self._incoming] + list(self.workers), timeout):
+            if connection is self._incoming:
+                message = connection.recv()
+                if message is not None:
+                    path, is_batch, obj = message
+                    self.add_job(path, is_batch, obj=obj)
+                continue
+            try:
+                connection.recv()
+            except (OSError, EOFError):
+                self.lost_worker(connection)
+                continue
+            self.job_finished(connection)
+            self.idle.append(connection)
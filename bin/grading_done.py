@@ -15,6 +15,7 @@ import os
 import subprocess
 import time
 import psutil
+import grading_job_index
 
 # these variables will be replaced by INSTALL_SUBMITTY.sh
 SUBMITTY_INSTALL_DIR = "__INSTALL__FILLIN__SUBMITTY_INSTALL_DIR__"
@@ -45,8 +46,28 @@ def parse_args():
     return parser.parse_args()
 
 
+def count_queue(index, queue_name, folder):
+    """
+    Count the jobs waiting in and being graded from one of the queues.
+    Uses the scheduler's job index when available, and otherwise
+    lists the queue directory.
+
+    :return: tuple (total # of jobs in the queue, # currently being graded)
+    """
+    if index is not None:
+        counts = index.counts()
+        todo = counts.get((queue_name, grading_job_index.PENDING), 0)
+        grading = counts.get((queue_name, grading_job_index.GRADING), 0)
+        return todo+grading, grading
+    queue = os.listdir(folder)
+    grading = len(list(filter(lambda x: x.startswith("GRADING"), queue)))
+    # each job being graded has both a queue file and a GRADING_ file
+    return len(queue)-grading, grading
+
+
 def main():
     args = parse_args()
+    index = grading_job_index.open_index_if_available()
     while True:
 
         # count the processes
@@ -72,28 +93,26 @@ def main():
             num_procs = 0
 
         done = True
-        batch_queue = os.listdir(BATCH_QUEUE)
-        grading_batch_queue = list(filter(lambda x: x.startswith("GRADING"), batch_queue))
-        if len(batch_queue) != 0:
+        batch_todo, batch_grading = count_queue(index, "batch", BATCH_QUEUE)
+        if batch_todo != 0:
             done = False
 
         print("GRADING PROCESSES:{:3d}       ".format(num_procs), end="")
 
-        if os.access(INTERACTIVE_QUEUE, os.R_OK):
+        if index is not None or os.access(INTERACTIVE_QUEUE, os.R_OK):
             # most instructors do not have read access to the interactive queue
-            interactive_queue = os.listdir(INTERACTIVE_QUEUE)
-            grading_interactive_queue = list(filter(lambda x: x.startswith("GRADING"), interactive_queue))
-            print("INTERACTIVE todo:{:3d} ".format(len(interactive_queue)-len(grading_interactive_queue)), end="")
-            if len(grading_interactive_queue) == 0:
+            interactive_todo, interactive_grading = count_queue(index, "interactive", INTERACTIVE_QUEUE)
+            print("INTERACTIVE todo:{:3d} ".format(interactive_todo), end="")
+            if interactive_grading == 0:
                 print("                 ", end="")
             else:
-                print("(grading:{:3d})    ".format(len(grading_interactive_queue)), end="")
-            if len(interactive_queue) != 0:
+                print("(grading:{:3d})    ".format(interactive_grading), end="")
+            if interactive_todo != 0:
                 done = False
 
-        print("BATCH todo:{:3d} ".format(len(batch_queue) - len(grading_batch_queue)), end="")
-        if len(grading_batch_queue) != 0:
-            print("(grading:{:3d})".format(len(grading_batch_queue)), end="")
+        print("BATCH todo:{:3d} ".format(batch_todo), end="")
+        if batch_grading != 0:
+            print("(grading:{:3d})".format(batch_grading), end="")
         print()
 
         # quit when the queues are empty
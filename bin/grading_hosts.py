@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+Grading on other machines.
+
+A worker of the grading scheduler can be attached to a grading machine
+listed in autograding_workers.json.  The worker still prepares each job
+on this machine (reading the queue file & configs, checking out the
+student repository, ...), then packs everything the compile / run /
+validate pipeline needs into a tar stream and sends it to
+grade_remote_job.py on the grading machine over ssh.  The grader runs
+the pipeline as one of its own untrusted users and sends back a tar
+stream with TMP_WORK (only the files that go into the results
+directory) and tmp_logs, which the worker unpacks in its tmp directory
+to finish the job as if it had been graded here.
+
+An entry with "transport" : "subprocess" runs grade_remote_job.py on
+this machine instead of over ssh, which exercises the whole round trip
+without a second machine.
+"""
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+
+from submitty_utils import glob
+
+# these variables will be replaced by INSTALL_SUBMITTY.sh
+SUBMITTY_INSTALL_DIR = "__INSTALL__FILLIN__SUBMITTY_INSTALL_DIR__"
+
+INPUT_DIRECTORIES = ["submission", "checkout", "provided_code", "test_input", "test_output",
+                     "custom_validation_code"]
+EXECUTABLES = ["compile.out", "run.out", "validate.out"]
+
+
+# ==================================================================================
+def describe_host(host):
+    if host.get("transport", "ssh") == "subprocess":
+        return host["name"] + " (subprocess)"
+    if host.get("username", "") == "":
+        return host["address"]
+    return host["username"] + "@" + host["address"]
+
+
+def host_command(host, which_untrusted):
+    """
+    :param host: the autograding_workers.json entry of the grading machine (plus its "name")
+    :param which_untrusted: the untrusted user of the grading machine
+    :return: the command that runs grade_remote_job.py on the grading machine
+    """
+    grader = [os.path.join(SUBMITTY_INSTALL_DIR, "bin", "grade_remote_job.py"), which_untrusted]
+    if host.get("transport", "ssh") == "subprocess":
+        return grader
+    return ["/usr/bin/ssh", "-o", "BatchMode=yes", describe_host(host)] + grader
+
+
+# ==================================================================================
+def add_json(archive, name, obj):
+    data = json.dumps(obj).encode('utf-8')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    info.mode = 0o640
+    archive.addfile(info, io.BytesIO(data))
+
+
+def safe_extract(infile, folder):
+    """
+    Extract a tar stream into folder.  Only regular files & directories
+    are extracted, and nothing may land outside of folder.
+    """
+    with tarfile.open(fileobj=infile, mode="r|") as archive:
+        for member in archive:
+            path = os.path.normpath(member.name)
+            if os.path.isabs(path) or path == ".." or path.startswith("../"):
+                raise tarfile.TarError("unexpected archive member " + member.name)
+            if member.isfile() or member.isdir():
+                archive.extract(member, folder)
+
+
+def pack_job(outfile, job, inputs, tmp_logs):
+    """
+    Write the tar stream of a job (see grade_item.grade_staged_job for the
+    job & inputs dictionaries).
+    """
+    with tarfile.open(fileobj=outfile, mode="w|") as archive:
+        add_json(archive, "job.json", job)
+        for name in INPUT_DIRECTORIES:
+            if inputs[name] is not None and os.path.isdir(inputs[name]):
+                archive.add(inputs[name], arcname=name)
+        for name in EXECUTABLES:
+            archive.add(os.path.join(inputs["bin"], name), arcname=os.path.join("bin", name))
+        archive.add(tmp_logs, arcname="tmp_logs")
+
+
+def unpack_job(infile, folder):
+    """
+    Extract the tar stream of a job into folder.
+
+    :return: the job & inputs dictionaries, with the inputs in folder
+    """
+    safe_extract(infile, folder)
+    with open(os.path.join(folder, "job.json"), 'r') as infile:
+        job = json.load(infile)
+    inputs = dict((name, os.path.join(folder, name)) for name in INPUT_DIRECTORIES + ["bin"])
+    if not job["is_vcs"]:
+        inputs["checkout"] = None
+    return job, inputs
+
+
+def pack_results(outfile, tmp, patterns_work_to_details, messages):
+    """
+    Write the tar stream of the results of a job: the messages for the
+    autograding log, and the files of TMP_WORK & tmp_logs that are needed
+    to fill the results directory.
+    """
+    tmp_work = os.path.join(tmp, "TMP_WORK")
+    with tarfile.open(fileobj=outfile, mode="w|") as archive:
+        add_json(archive, "messages.json", messages)
+        archive.add(tmp_work, arcname="TMP_WORK", recursive=False)
+        for name in ["results.json", "grade.txt"]:
+            if os.path.isfile(os.path.join(tmp_work, name)):
+                archive.add(os.path.join(tmp_work, name), arcname=os.path.join("TMP_WORK", name))
+        for pattern in patterns_work_to_details:
+            for my_file in glob.glob(os.path.join(tmp_work, pattern), recursive=True):
+                archive.add(my_file, arcname=os.path.join("TMP_WORK", os.path.relpath(my_file, tmp_work)))
+        archive.add(os.path.join(tmp, "tmp_logs"), arcname="tmp_logs")
+
+
+# ==================================================================================
+def grade_remotely(host, which_untrusted, tmp, job, inputs, log_function):
+    """
+    Grade a prepared job on a grading machine, and leave its TMP_WORK &
+    tmp_logs in tmp as grade_item.grade_staged_job would.
+
+    :raises RuntimeError: if the job could not be sent, graded or received (the
+                          job fails, the worker goes on with its next job)
+    """
+    job = dict(job, is_vcs=inputs["checkout"] is not None)
+    tmp_logs = os.path.join(tmp, "tmp_logs")
+    process = subprocess.Popen(host_command(host, which_untrusted), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # send the job from another thread, the grader starts answering once it has all of it
+    send_errors = []
+    def send_job():
+        try:
+            pack_job(process.stdin, job, inputs, tmp_logs)
+        except (OSError, tarfile.TarError) as e:
+            send_errors.append(e)
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+    sender = threading.Thread(target=send_job, daemon=True)
+    sender.start()
+
+    received = os.path.join(tmp, "TMP_RECEIVED")
+    os.mkdir(received)
+    receive_error = None
+    try:
+        safe_extract(process.stdout, received)
+    except (OSError, tarfile.TarError) as e:
+        receive_error = e
+    process.stdout.close()
+    sender.join()
+    returncode = process.wait()
+    if returncode != 0 or receive_error is not None or send_errors:
+        raise RuntimeError("ERROR: grading on " + describe_host(host) + " failed, exit code " + str(returncode) +
+                           " " + repr(receive_error or send_errors))
+
+    with open(os.path.join(received, "messages.json"), 'r') as infile:
+        for message in json.load(infile):
+            log_function(message)
+    shutil.rmtree(tmp_logs)
+    os.rename(os.path.join(received, "tmp_logs"), tmp_logs)
+    os.rename(os.path.join(received, "TMP_WORK"), os.path.join(tmp, "TMP_WORK"))
+    shutil.rmtree(received)
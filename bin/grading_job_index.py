@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+"""
+Persistent index of the jobs in the two grading queues (interactive & batch).
+
+The grading scheduler records every queue file it learns about (from the
+watchdog observer or from the startup recovery) in a small sqlite
+database, along with the fields of the queue file that are useful for
+scheduling & reporting.  Each job moves through three states:
+
+    pending  ->  grading  ->  done
+
+On restart, the scheduler only needs to list the names in each queue
+folder (which contains only the pending jobs) and stat/parse the queue
+files that the index has not seen yet, instead of stat-ing and sorting
+every file.  Other tools (grading_done.py, regrade.py) can query the
+index for the queue contents instead of listing the queue directories.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# these variables will be replaced by INSTALL_SUBMITTY.sh
+SUBMITTY_DATA_DIR = "__INSTALL__FILLIN__SUBMITTY_DATA_DIR__"
+
+JOB_INDEX_DIR = os.path.join(SUBMITTY_DATA_DIR, "grading_index")
+JOB_INDEX_FILE = os.path.join(JOB_INDEX_DIR, "jobs.sqlite")
+
+PENDING = "pending"
+GRADING = "grading"
+DONE = "done"
+
+# how long the index remembers finished jobs (for reporting)
+DONE_RETENTION_SECONDS = 7*24*60*60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    path                      TEXT PRIMARY KEY,
+    queue                     TEXT NOT NULL,
+    state                     TEXT NOT NULL,
+    queue_time                REAL NOT NULL,
+    semester                  TEXT,
+    course                    TEXT,
+    gradeable                 TEXT,
+    who                       TEXT,
+    version                   TEXT,
+    required_capabilities     TEXT,
+    max_possible_grading_time INTEGER,
+    updated                   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (queue, state, queue_time);
+"""
+
+COLUMNS = ["path", "queue", "state", "queue_time", "semester", "course", "gradeable", "who",
+           "version", "required_capabilities", "max_possible_grading_time", "updated"]
+
+
+def read_queue_file(path):
+    """
+    Load the json contents of a queue file.  The queue file may still be
+    in the process of being written (or may already have been removed),
+    in which case None is returned.
+
+    :param path: path to the queue file
+    :return: dictionary with the contents of the queue file, or None
+    """
+    try:
+        with open(path, 'r') as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+
+def is_queue_file_name(name):
+    """
+    The GRADING_* files mark the jobs being graded, and the hidden files are
+    queue files still being written (see regrade.py), the rest are queue files.
+    """
+    return not name.startswith("GRADING_") and not name.startswith(".")
+
+
+def parse_queue_file_name(path):
+    """
+    Queue files are named <semester>__<course>__<gradeable>__<who>__<version>,
+    which lets us identify a job even before its contents are readable.
+
+    :return: dictionary with the fields encoded in the name (empty if it doesn't match)
+    """
+    parts = os.path.basename(path).split("__")
+    if len(parts) != 5:
+        return {}
+    return dict(zip(["semester", "course", "gradeable", "who", "version"], parts))
+
+
+def make_job_row(queue, path, queue_time=None, obj=None, state=PENDING):
+    """
+    Prepare a row of the jobs table for a queue file.
+
+    :param queue: name of the queue ("interactive" or "batch")
+    :param path: absolute path to the queue file
+    :param queue_time: time the job entered the queue (defaults to the ctime of the file)
+    :param obj: contents of the queue file (read from disk if not provided)
+    :param state: initial state of the job
+    :return: tuple of values, in the order of COLUMNS
+    """
+    if queue_time is None:
+        queue_time = os.path.getctime(path)
+    if obj is None:
+        obj = read_queue_file(path)
+    if obj is None:
+        obj = parse_queue_file_name(path)
+    version = obj.get("version")
+    return (path, queue, state, queue_time,
+            obj.get("semester"), obj.get("course"), obj.get("gradeable"), obj.get("who"),
+            None if version is None else str(version),
+            obj.get("required_capabilities"), obj.get("max_possible_grading_time"),
+            time.time())
+
+
+class JobIndex(object):
+    """
+    Wrapper around the sqlite job index.  Each process (the scheduler, the
+    worker processes, command line tools) and each thread of a process
+    lazily opens its own connection, as sqlite connections must not be
+    shared across a fork or between threads.
+    """
+
+    def __init__(self, path=JOB_INDEX_FILE):
+        self.path = path
+        # the connection & pid of each thread
+        self._local = threading.local()
+
+    def _connect(self):
+        local = self._local
+        if getattr(local, "connection", None) is None or local.pid != os.getpid():
+            is_new = not os.path.isfile(self.path)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            local.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            local.connection.row_factory = sqlite3.Row
+            local.connection.executescript(SCHEMA)
+            local.pid = os.getpid()
+            if is_new and os.getuid() == os.stat(self.path).st_uid:
+                # course builders write to the batch queue (regrade.py) and
+                # need to be able to write to the index as well
+                os.chmod(self.path, 0o660)
+        return local.connection
+
+    def close(self):
+        local = self._local
+        if getattr(local, "connection", None) is not None and local.pid == os.getpid():
+            local.connection.close()
+        local.connection = None
+        local.pid = None
+
+    # ------------------------------------------------------------------
+    # updates
+
+    def add_job(self, queue, path, queue_time=None, obj=None):
+        """
+        Record a new (or re-written) queue file as pending.
+        """
+        self.add_rows([make_job_row(queue, path, queue_time, obj)])
+
+    def add_rows(self, rows):
+        """
+        Record many jobs in a single transaction.
+
+        :param rows: iterable of tuples produced by make_job_row
+        """
+        db = self._connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("INSERT OR REPLACE INTO jobs (" + ",".join(COLUMNS) + ") VALUES (" +
+                           ",".join(["?"]*len(COLUMNS)) + ")", rows)
+
+    def set_state(self, path, state):
+        db = self._connect()
+        db.execute("UPDATE jobs SET state=?, updated=? WHERE path=?", (state, time.time(), path))
+
+    def mark_grading(self, path):
+        self.set_state(path, GRADING)
+
+    def mark_done(self, path):
+        self.set_state(path, DONE)
+
+    def forget_pending(self, path):
+        """
+        A queue file was removed before it was graded (e.g., by hand).
+        """
+        db = self._connect()
+        db.execute("DELETE FROM jobs WHERE path=? AND state=?", (path, PENDING))
+
+    def prune_done(self, retention=DONE_RETENTION_SECONDS):
+        db = self._connect()
+        db.execute("DELETE FROM jobs WHERE state=? AND updated<?", (DONE, time.time()-retention))
+
+    # ------------------------------------------------------------------
+    # queries
+
+    def jobs(self, queue=None, states=(PENDING,)):
+        """
+        List the jobs in the given states, oldest first.
+
+        :param queue: restrict to one queue ("interactive" or "batch"), or None for both
+        :param states: the job states to include
+        :return: list of sqlite3.Row objects
+        """
+        db = self._connect()
+        query = "SELECT * FROM jobs WHERE state IN (" + ",".join(["?"]*len(states)) + ")"
+        params = list(states)
+        if queue is not None:
+            query += " AND queue=?"
+            params.append(queue)
+        query += " ORDER BY queue_time"
+        return db.execute(query, params).fetchall()
+
+    def get_job(self, path):
+        db = self._connect()
+        return db.execute("SELECT * FROM jobs WHERE path=?", (path,)).fetchone()
+
+    def counts(self):
+        """
+        :return: dictionary mapping (queue, state) to the number of jobs
+        """
+        db = self._connect()
+        answer = {}
+        for row in db.execute("SELECT queue, state, COUNT(*) FROM jobs GROUP BY queue, state"):
+            answer[(row[0], row[1])] = row[2]
+        return answer
+
+    # ------------------------------------------------------------------
+    # recovery
+
+    def recover(self, queue, folder):
+        """
+        Bring the index up to date with the contents of a queue folder
+        after a (re)start of the scheduler.  The folder only contains the
+        pending jobs, so this is O(pending): we list the names (no stat),
+        only stat & parse the queue files the index does not know about,
+        and drop index entries whose queue file has disappeared.  Jobs
+        that were being graded when the scheduler stopped go back to
+        pending.
+
+        :param queue: name of the queue ("interactive" or "batch")
+        :param folder: the queue folder
+        :return: list of the pending jobs (sqlite3.Row objects), sorted by queue time
+        """
+        db = self._connect()
+        on_disk = set()
+        for entry in os.scandir(folder):
+            if not is_queue_file_name(entry.name) or not entry.is_file():
+                continue
+            on_disk.add(entry.path)
+
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            known = {}
+            for row in db.execute("SELECT path, state FROM jobs WHERE queue=? AND state IN (?,?)",
+                                  (queue, PENDING, GRADING)):
+                known[row[0]] = row[1]
+            vanished = [(path,) for path in known if path not in on_disk]
+            db.executemany("DELETE FROM jobs WHERE path=?", vanished)
+            db.execute("UPDATE jobs SET state=?, updated=? WHERE queue=? AND state=?",
+                       (PENDING, time.time(), queue, GRADING))
+            rows = []
+            for path in on_disk:
+                if path in known:
+                    continue
+                try:
+                    rows.append(make_job_row(queue, path))
+                except OSError:
+                    # removed while we were looking
+                    pass
+            db.executemany("INSERT OR REPLACE INTO jobs (" + ",".join(COLUMNS) + ") VALUES (" +
+                           ",".join(["?"]*len(COLUMNS)) + ")", rows)
+
+        return self.jobs(queue)
+
+
+def open_index_if_available(path=JOB_INDEX_FILE):
+    """
+    Used by the command line tools: returns a JobIndex if the scheduler has
+    created one that this user can read, otherwise None (and the caller
+    should fall back to listing the queue directories).
+    """
+    if not os.path.isfile(path) or not os.access(path, os.R_OK):
+        return None
+    try:
+        index = JobIndex(path)
+        index.counts()
+        return index
+    except sqlite3.Error:
+        return None
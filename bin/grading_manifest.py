@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+Listings of the grading tmp directories for the logs of each job.
+
+After each staging phase, grade_item.py records what is in the directory
+the next program runs in: for every file & directory its size, mode and
+owner (and optionally a hash of its contents).  Each phase is written as
+a compact json file in tmp_logs (manifest_<phase>.json), along with what
+was added, removed or changed since the previous phase, and a one line
+summary goes into overall.txt.  This replaces forking "ls -lR" into
+overall.txt.
+"""
+
+import hashlib
+import json
+import os
+import stat
+
+
+# ==================================================================================
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def scan(top, hashes=False, mtimes=False):
+    """
+    :param top: directory to list
+    :param hashes: also record the sha1 of the contents of each file
+    :param mtimes: also record the mtime (in ns) of each entry, so that a file
+                   rewritten in place with the same size shows up as changed
+    :return: dictionary of relative path -> [size, mode (as in ls -l), uid (, mtime) (, sha1)]
+    """
+    files = {}
+    if not os.path.isdir(top):
+        return files
+    todo = [""]
+    while todo:
+        relative = todo.pop()
+        for entry in os.scandir(os.path.join(top, relative)):
+            path = os.path.join(relative, entry.name)
+            info = entry.stat(follow_symlinks=False)
+            details = [info.st_size, stat.filemode(info.st_mode), info.st_uid]
+            if mtimes:
+                details.append(info.st_mtime_ns)
+            if entry.is_dir(follow_symlinks=False):
+                todo.append(path)
+            elif hashes and entry.is_file(follow_symlinks=False):
+                try:
+                    details.append(file_hash(entry.path))
+                except OSError:
+                    # e.g., not readable by us
+                    details.append(None)
+            files[path] = details
+    return files
+
+
+def total_bytes(files):
+    """
+    :return: the total size of the files (not directories) of a manifest
+    """
+    return sum(details[0] for details in files.values() if details[1][0] != 'd')
+
+
+def read_total_bytes(logs, phase):
+    """
+    :param logs: a logs directory with the manifests of a job (e.g., of its last grading)
+    :return: the total size of the files of a phase, or None if there is no such manifest
+    """
+    try:
+        with open(os.path.join(logs, "manifest_" + phase + ".json"), 'r') as infile:
+            return total_bytes(json.load(infile)["files"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def diff(previous, current):
+    """
+    :return: dictionary with the sorted lists of the added, removed & changed paths
+    """
+    return {"added": sorted(set(current) - set(previous)),
+            "removed": sorted(set(previous) - set(current)),
+            "changed": sorted(path for path in current if path in previous and current[path] != previous[path])}
+
+
+def write_manifest(tmp_logs, phase, top, previous=None, hashes=False):
+    """
+    Write the manifest of a phase and summarize it in overall.txt.
+
+    :param tmp_logs: the logs directory of the job
+    :param phase: name of the phase (e.g., "compilation")
+    :param top: directory to list
+    :param previous: the files of the previous phase (as returned by this function)
+    :param hashes: also record the sha1 of the contents of each file
+    :return: the files of this phase
+    """
+    files = scan(top, hashes)
+    manifest = {"phase": phase, "directory": top, "files": files}
+    if previous is not None:
+        manifest["diff"] = diff(previous, files)
+    with open(os.path.join(tmp_logs, "manifest_" + phase + ".json"), 'w') as outfile:
+        json.dump(manifest, outfile, separators=(',', ':'), sort_keys=True)
+
+    summary = "MANIFEST {}: {} entries, {} bytes in {}".format(
+        phase, len(files), total_bytes(files), top)
+    if previous is not None:
+        summary += " (+{} -{} ~{} since the previous phase)".format(
+            len(manifest["diff"]["added"]), len(manifest["diff"]["removed"]), len(manifest["diff"]["changed"]))
+    with open(os.path.join(tmp_logs, "overall.txt"), 'a') as f:
+        print(summary, file=f)
+    return files
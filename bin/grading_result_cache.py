@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+"""
+Content addressed cache of grading results, shared by the workers of the
+grading scheduler.
+
+The digest of a job covers everything that the compile / run / validate
+pipeline sees: the files of the submission (and of the vcs checkout), the
+instructor files & compile.out / run.out / validate.out of the gradeable,
+the autograding section of its complete config, and the gradeable & who
+given to the graders (they may customize the testcases for a student).
+The version only matters through the points validate.out takes off for
+excessive submissions, so the digest has the # of excessive submissions
+of each submission limit testcase instead (0 for all the versions under
+the limit), and the submission time (and the hidden .submit.timestamp
+etc. of the submission directory) is left out: a byte identical
+resubmission is not graded again.  A job of a vcs gradeable is identified
+by the commit it grades instead of the files of its checkout (see
+commit_digest).  A job whose digest is in the cache copies the grade.txt,
+results.json & details files from the cache instead of running anything.
+
+Each entry is a directory named by the digest.  The mtime of the entry is
+its last use, and when the cache grows over its budget the least recently
+used entries are removed.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from submitty_utils import glob
+import grading_staging_cache
+
+SIZE_FILE = "size.json"
+
+# (path, tree signature) -> digest of the files of an instructor directory
+_tree_digests = {}
+_tree_digests_lock = threading.Lock()
+
+
+# ==================================================================================
+def hash_tree(sha, path, skip_hidden=False):
+    """
+    Add the relative paths, modes & contents of the files of a directory to a hash.
+
+    :param skip_hidden: leave out the hidden files & directories at the top of the directory
+    """
+    if not os.path.isdir(path):
+        sha.update(b"\0missing\0")
+        return
+    todo = [""]
+    while todo:
+        relative = todo.pop()
+        entries = sorted(os.scandir(os.path.join(path, relative)), key=lambda entry: entry.name)
+        for entry in entries:
+            if skip_hidden and relative == "" and entry.name.startswith("."):
+                continue
+            name = os.path.join(relative, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                sha.update(b"\0dir\0" + name.encode('utf-8', 'surrogateescape'))
+                todo.append(name)
+                continue
+            info = entry.stat(follow_symlinks=False)
+            sha.update(b"\0file\0" + name.encode('utf-8', 'surrogateescape') +
+                       b"\0" + str(info.st_mode & 0o111).encode())
+            if entry.is_symlink():
+                sha.update(os.readlink(entry.path).encode('utf-8', 'surrogateescape'))
+            else:
+                hash_file(sha, entry.path)
+
+
+def hash_file(sha, path):
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            sha.update(block)
+
+
+def tree_digest(path):
+    """
+    Digest of an instructor directory, remembered until any of its files
+    changes size or mtime (these are the same for every job of a gradeable).
+    """
+    key = (path, json.dumps(grading_staging_cache.tree_signature(path)))
+    with _tree_digests_lock:
+        if key in _tree_digests:
+            return _tree_digests[key]
+    sha = hashlib.sha256()
+    hash_tree(sha, path)
+    with _tree_digests_lock:
+        _tree_digests[key] = sha.hexdigest()
+    return _tree_digests[key]
+
+
+def excessive_submissions(testcases, version):
+    """
+    What the grade of a version depends on, of its version number: the
+    # of excessive submissions of each submission limit testcase that
+    takes off points (as in main_validator.cpp, every complete config has
+    one, see AddSubmissionLimitTestCase).
+
+    :param testcases: the testcases of the complete config of the gradeable
+    :param version: the version of the job
+    :return: list of the # of submissions over the limit of each such testcase
+    """
+    answer = []
+    for testcase in testcases:
+        if "max_submissions" not in testcase:
+            continue
+        if testcase.get("points", -5) == 0 or testcase.get("penalty", -0.1) == 0:
+            # no penalty, whatever the version
+            continue
+        answer.append(max(0, int(version) - int(testcase["max_submissions"])))
+    return answer
+
+
+def job_digest(job, inputs, testcases):
+    """
+    :param job: the job, as given to grade_item.grade_staged_job
+    :param inputs: the input directories, as given to grade_item.grade_staged_job
+    :param testcases: the testcases of the complete config of the gradeable
+    :return: hex digest of everything the grading of the job depends on
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps([job["gradeable"], job["who"], job["autograding"],
+                           excessive_submissions(testcases, job["version"])], sort_keys=True).encode())
+    hash_tree(sha, inputs["submission"], skip_hidden=True)
+    if inputs["checkout"] is not None:
+        sha.update(b"\0checkout\0")
+        hash_tree(sha, inputs["checkout"], skip_hidden=True)
+    hash_gradeable(sha, inputs)
+    return sha.hexdigest()
+
+
+def commit_digest(job, inputs, commit, testcases):
+    """
+    Digest of a job of a vcs gradeable, by the commit it grades rather than
+    the files of its checkout (otherwise like job_digest).
+
+    :param commit: the commit checked out for the job
+    :param testcases: the testcases of the complete config of the gradeable
+    :return: hex digest of everything the grading of the job depends on
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps([job["gradeable"], job["who"], commit, job["autograding"],
+                           excessive_submissions(testcases, job["version"])], sort_keys=True).encode())
+    hash_tree(sha, inputs["submission"], skip_hidden=True)
+    hash_gradeable(sha, inputs)
+    return sha.hexdigest()
+
+
+def hash_gradeable(sha, inputs):
+    """
+    Add the instructor files & compile.out / run.out / validate.out of the gradeable to a hash.
+    """
+    for d in grading_staging_cache.CACHED_DIRECTORIES:
+        sha.update(b"\0" + d.encode() + b"\0" + tree_digest(inputs[d]).encode())
+    for e in grading_staging_cache.EXECUTABLES:
+        sha.update(b"\0" + e.encode() + b"\0")
+        executable = os.path.join(inputs["bin"], e)
+        if os.path.isfile(executable):
+            hash_file(sha, executable)
+
+
+# ==================================================================================
+class ResultCache(object):
+
+    def __init__(self, cache_dir, budget_bytes):
+        """
+        :param cache_dir: directory of the cache (shared by the workers)
+        :param budget_bytes: maximum total size of the cached results
+        """
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+
+    def restore(self, digest, tmp_work):
+        """
+        Copy the cached results of a digest (if any) into an empty TMP_WORK directory.
+
+        :return: True if the results were in the cache
+        """
+        entry = os.path.join(self.cache_dir, digest)
+        if not os.path.isdir(entry):
+            return False
+        try:
+            os.utime(entry)
+            shutil.copytree(os.path.join(entry, "work"), tmp_work)
+        except OSError:
+            # e.g., evicted by another worker while we were copying
+            shutil.rmtree(tmp_work, ignore_errors=True)
+            return False
+        return True
+
+    def store(self, digest, tmp_work, patterns_work_to_details):
+        """
+        Keep the results of a graded job: the grade.txt, results.json & the
+        files of TMP_WORK that are copied to the details.
+        """
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        building = tempfile.mkdtemp(prefix="." + digest, dir=self.cache_dir)
+        try:
+            work = os.path.join(building, "work")
+            os.mkdir(work)
+            names = set(["grade.txt", "results.json"])
+            for pattern in patterns_work_to_details:
+                for my_file in glob.glob(os.path.join(tmp_work, pattern), recursive=True):
+                    names.add(os.path.relpath(my_file, tmp_work))
+            size = 0
+            for name in names:
+                if not os.path.isfile(os.path.join(tmp_work, name)):
+                    continue
+                os.makedirs(os.path.join(work, os.path.dirname(name)), exist_ok=True)
+                grading_staging_cache.copy_file(os.path.join(tmp_work, name), os.path.join(work, name))
+                size += os.path.getsize(os.path.join(work, name))
+            with open(os.path.join(building, SIZE_FILE), 'w') as outfile:
+                json.dump(size, outfile)
+            os.rename(building, os.path.join(self.cache_dir, digest))
+        except OSError:
+            # e.g., another worker just stored the same digest
+            shutil.rmtree(building, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith("."):
+                continue
+            try:
+                with open(os.path.join(entry.path, SIZE_FILE), 'r') as infile:
+                    size = json.load(infile)
+                entries.append((entry.stat().st_mtime, entry.path, size))
+                total += size
+            except (OSError, ValueError):
+                continue
+        entries.sort()
+        for last_use, path, size in entries:
+            if total <= self.budget_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+"""
+Writes the grades of the finished jobs to the course databases in batches.
+
+The scheduler starts the result sink process before the workers.  After
+grading a job, a worker sends the row of the graded version (see
+insert_database_version_data.get_version_row) to the sink instead of
+writing it to the database itself.  The sink writes the rows of each
+course database together (in one multi-row statement), when it has
+collected result_batch_size rows or every result_flush_interval seconds.
+The row of an interactive job is written right away (with whatever else is
+waiting for that course).
+
+Every row the sink receives is appended to a spool file first, and the
+spool file is rewritten with only the rows that are still waiting after
+each write to the databases.  So if a database is down (or the scheduler
+is stopped) the rows are kept, and are written when the sink is started
+again.
+"""
+
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+
+import grade_items_logging
+import insert_database_version_data
+
+# these variables will be replaced by INSTALL_SUBMITTY.sh
+SUBMITTY_DATA_DIR = "__INSTALL__FILLIN__SUBMITTY_DATA_DIR__"
+# (in a directory only hwcron can read or write: the rows are the grades of every course)
+SPOOL_FILE = os.path.join(SUBMITTY_DATA_DIR, "grading_spool", "result_spool.jsonl")
+
+SINK_QUEUE_SIZE = 10000
+# after a failed write, wait this long (in seconds) before trying that database again
+RETRY_INTERVAL = 30
+
+_sink_queue = None
+_sink = None
+
+
+# ==================================================================================
+def log(message):
+    grade_items_logging.log_message(False, "", "", "", "", message)
+
+
+def submit(semester, course, gradeable_id, user_id, team_id, who_id, is_team, version, urgent):
+    """
+    Write the data of a graded version to the course database: by the
+    result sink process if there is one, otherwise right now.
+
+    :param urgent: write it as soon as possible (e.g., for an interactive job)
+    """
+    if _sink_queue is not None:
+        row = insert_database_version_data.get_version_row(semester, course, gradeable_id, user_id,
+                                                           team_id, who_id, is_team, version)
+        try:
+            _sink_queue.put_nowait((semester, course, row, urgent))
+            return
+        except queue.Full:
+            # the sink is behind, write it ourselves
+            pass
+    insert_database_version_data.insert_to_database(semester, course, gradeable_id, user_id,
+                                                    team_id, who_id, is_team, version)
+
+
+# ==================================================================================
+class ResultSink(object):
+
+    def __init__(self, spool_file, batch_size, flush_interval):
+        self.spool_file = spool_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # (semester, course) -> list of rows waiting to be written
+        self.pending = {}
+        # (semester, course) -> time of the last failed write
+        self.failed = {}
+        self.last_flush = time.time()
+        self.spool = None
+
+    def count(self):
+        return sum(len(rows) for rows in self.pending.values())
+
+    def load_spool(self):
+        """
+        Pick up the rows that were not written when the sink stopped.
+        """
+        if os.path.isfile(self.spool_file):
+            with open(self.spool_file, 'r') as infile:
+                for line in infile:
+                    try:
+                        semester, course, row = json.loads(line)
+                    except ValueError:
+                        # e.g., the last line, if we were killed while appending it
+                        continue
+                    self.pending.setdefault((semester, course), []).append(row)
+            if self.count() > 0:
+                log("result sink: " + str(self.count()) + " spooled rows to write")
+        self.rewrite_spool()
+
+    def rewrite_spool(self):
+        if self.spool is not None:
+            self.spool.close()
+        tmp_file = self.spool_file + ".tmp"
+        if os.path.lexists(tmp_file):
+            # (left by a sink that was killed while rewriting the spool)
+            os.remove(tmp_file)
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'w') as outfile:
+            for (semester, course), rows in self.pending.items():
+                for row in rows:
+                    print(json.dumps([semester, course, row]), file=outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(tmp_file, self.spool_file)
+        self.spool = open(self.spool_file, 'a')
+
+    def add(self, semester, course, row, urgent):
+        print(json.dumps([semester, course, row]), file=self.spool)
+        self.spool.flush()
+        self.pending.setdefault((semester, course), []).append(row)
+        if urgent:
+            self.flush([(semester, course)])
+        elif self.count() >= self.batch_size:
+            self.flush()
+
+    def tick(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self, keys=None):
+        """
+        Write the waiting rows (of the given (semester, course) keys, or of
+        all the courses) to the databases.
+        """
+        if keys is None:
+            keys = list(self.pending.keys())
+            self.last_flush = time.time()
+        written = False
+        for key in keys:
+            if len(self.pending.get(key, [])) == 0:
+                continue
+            if time.time() - self.failed.get(key, 0) < RETRY_INTERVAL:
+                continue
+            try:
+                insert_database_version_data.insert_rows(key[0], key[1], self.pending[key])
+            except Exception as e:
+                self.failed[key] = time.time()
+                log("result sink: ERROR writing " + str(len(self.pending[key])) + " rows to the " +
+                    "/".join(key) + " database, will try again " + repr(e))
+                continue
+            self.failed.pop(key, None)
+            del self.pending[key]
+            written = True
+        if written:
+            self.rewrite_spool()
+
+    def close(self):
+        # try the databases that failed recently one more time
+        self.failed.clear()
+        self.flush()
+        self.spool.close()
+        insert_database_version_data.dispose_engines()
+
+
+def result_sink(sink_queue, spool_file, batch_size, flush_interval):
+    """
+    The result sink process: writes the rows sent by the workers until it gets None.
+    """
+    global _sink_queue
+    _sink_queue = None
+    # a keyboard interrupt of the scheduler is sent to us too, but we keep
+    # going until the scheduler sends None (see stop_result_sink)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sink = ResultSink(spool_file, batch_size, flush_interval)
+    sink.load_spool()
+    while True:
+        try:
+            item = sink_queue.get(timeout=flush_interval)
+        except queue.Empty:
+            item = ()
+        if item is None:
+            break
+        try:
+            if item:
+                sink.add(*item)
+            sink.tick()
+        except OSError as e:
+            # e.g., could not write the spool file
+            print("ERROR: result sink", e, file=sys.stderr)
+    sink.close()
+
+
+def start_result_sink(batch_size, flush_interval, spool_file=SPOOL_FILE):
+    """
+    Start the result sink process.  The processes started after this (e.g.,
+    the grading workers) send their rows to it (see submit).
+    """
+    global _sink_queue, _sink
+    _sink_queue = multiprocessing.Queue(SINK_QUEUE_SIZE)
+    _sink = multiprocessing.Process(target=result_sink,
+                                    args=(_sink_queue, spool_file, batch_size, flush_interval))
+    _sink.start()
+
+
+def stop_result_sink(timeout=30):
+    """
+    Write the waiting rows (those that can't be written stay in the spool
+    file) & stop the result sink process.
+    """
+    global _sink_queue, _sink
+    if _sink is None:
+        return
+    sink_queue = _sink_queue
+    _sink_queue = None
+    sink_queue.put(None)
+    _sink.join(timeout)
+    _sink = None
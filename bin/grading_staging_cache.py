@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""
+Per worker cache of the instructor files of the recently graded gradeables.
+
+Grading a job copies the provided_code, test_input, test_output &
+custom_validation_code directories and the compile.out / run.out /
+validate.out programs of the gradeable into the tmp directory.  Each
+worker keeps a private copy of these files for the gradeables it graded
+recently, and grade_item.py clones them into the tmp directory (a reflink
+where the filesystem supports it, see stage_file) instead of copying them
+from the course directory.
+
+An entry is only used if the size & mtime of every file & directory of
+the sources are unchanged since it was made, so a rebuild of the
+gradeable is picked up by the next job.  The cached files are read only,
+and only the compile.out / run.out / validate.out programs (which no one
+writes) are hard linked into the tmp directory: the mode of a hard linked
+file is never changed (see grade_item.add_permissions), as that would
+change the cached file.  When the cache grows over its budget, the least
+recently used gradeables are dropped.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+# the names of the cached directories (see grade_item.grade_staged_job)
+CACHED_DIRECTORIES = ["provided_code", "test_input", "test_output", "custom_validation_code"]
+EXECUTABLES = ["compile.out", "run.out", "validate.out"]
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+SIGNATURE_FILE = "signature.json"
+
+
+# ==================================================================================
+def tree_signature(path):
+    """
+    :return: sorted list of [relative path, size, mtime] of everything in path,
+             or None if path does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    answer = []
+    todo = [""]
+    while todo:
+        relative = todo.pop()
+        for entry in os.scandir(os.path.join(path, relative)):
+            info = entry.stat(follow_symlinks=False)
+            answer.append([os.path.join(relative, entry.name), info.st_size, info.st_mtime_ns])
+            if entry.is_dir(follow_symlinks=False):
+                todo.append(os.path.join(relative, entry.name))
+    answer.sort()
+    return answer
+
+
+def file_signature(path):
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [info.st_size, info.st_mtime_ns]
+
+
+def make_read_only(path):
+    """
+    Everyone may read (and execute, if it was executable) the cached
+    files, but no one may change them.  (So the programs already have the
+    mode they need in the tmp directory, & can be hard linked there.)
+    """
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            my_file = os.path.join(root, f)
+            mode = os.lstat(my_file).st_mode
+            if stat.S_ISLNK(mode):
+                # (chmod would change the file it points to)
+                continue
+            mode |= stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+            if mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
+                mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+            os.chmod(my_file, mode & ~WRITE_BITS & 0o7777)
+
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            total += os.lstat(os.path.join(root, f)).st_size
+    return total
+
+
+# ==================================================================================
+# the devices (filesystems) that can't make reflinks
+_no_reflink_devices = set()
+
+def reflink(source, target):
+    """
+    Make target a copy on write clone of source (btrfs, xfs, ...).
+
+    :return: True if it worked, False if the filesystem can't do it
+    """
+    device = os.stat(os.path.dirname(os.path.abspath(target))).st_dev
+    if device in _no_reflink_devices:
+        return False
+    try:
+        with open(source, 'rb') as infile:
+            fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                fcntl.ioctl(fd, FICLONE, infile.fileno())
+            finally:
+                os.close(fd)
+    except OSError as e:
+        if os.path.lexists(target):
+            os.remove(target)
+        if e.errno == errno.EXDEV:
+            return False
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+            raise
+        # don't try again on this filesystem (e.g., a tmpfs, see grade_item.choose_scratch)
+        _no_reflink_devices.add(device)
+        return False
+    return True
+
+
+def copy_file(source, target):
+    """
+    Copy the contents & mode bits of a file, like shutil.copy, as a copy
+    on write clone if possible, otherwise inside the kernel (with
+    copy_file_range, if this python has it).  The target is always a new
+    file of our own, so changing it never affects the source.
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+    if not reflink(source, target):
+        with open(source, 'rb') as infile, open(target, 'wb') as outfile:
+            copy_contents(infile, outfile)
+    shutil.copymode(source, target)
+    return target
+
+
+def copy_contents(infile, outfile):
+    """
+    Copy the rest of an open file into another, inside the kernel (with
+    copy_file_range) if this python has it.
+    """
+    if hasattr(os, "copy_file_range"):
+        while os.copy_file_range(infile.fileno(), outfile.fileno(), 1 << 30) > 0:
+            pass
+    else:
+        shutil.copyfileobj(infile, outfile)
+
+
+def can_share(info, link_mode):
+    """
+    A file can be hard linked into a tmp directory if we own it, no one
+    can write to it, and it already has the permission bits link_mode it
+    needs there: grade_item.add_permissions never changes the mode of a
+    hard linked file, as that would change the original too.
+    """
+    return info.st_uid == os.getuid() and stat.S_ISREG(info.st_mode) and \
+        not info.st_mode & WRITE_BITS and stat.S_IMODE(info.st_mode) & link_mode == link_mode
+
+
+def stage_file(source, target, link_mode=None):
+    """
+    Put a copy of the source file at target, as cheaply as possible: a
+    copy on write clone, a hard link, or a copy.  Only a file that stays
+    read only is hard linked: if link_mode (the permission bits the target
+    needs) is given & the source already has them (see can_share).
+    Otherwise the target is a file of our own that can be made writable.
+    Can be used as the copy_function of shutil.copytree.
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+    if reflink(source, target):
+        shutil.copymode(source, target)
+        return target
+    if link_mode is not None and can_share(os.stat(source), link_mode):
+        try:
+            os.link(source, target)
+            return target
+        except OSError:
+            # e.g., on another filesystem
+            pass
+    return copy_file(source, target)
+
+
+# ==================================================================================
+class StagingCache(object):
+
+    def __init__(self, cache_dir, budget_bytes):
+        """
+        :param cache_dir: private directory of the worker for the cache
+        :param budget_bytes: maximum total size of the cached files
+        """
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+        self.entries = None
+
+    def _load(self):
+        # entries: name -> [size, last use], the mtime of each entry directory is its last use
+        self.entries = {}
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        for entry in os.scandir(self.cache_dir):
+            try:
+                with open(os.path.join(entry.path, SIGNATURE_FILE), 'r') as infile:
+                    size = json.load(infile)["size"]
+                self.entries[entry.name] = [size, entry.stat().st_mtime]
+            except (OSError, ValueError, KeyError):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def stage(self, key, sources):
+        """
+        Find (or make) the cache entry of a gradeable.
+
+        :param key: tuple (semester, course, gradeable)
+        :param sources: dictionary with the paths of the CACHED_DIRECTORIES and of the
+                        "bin" directory (with the EXECUTABLES) of the gradeable
+        :return: dictionary with the same keys, pointing into the cache entry
+        """
+        if self.entries is None:
+            self._load()
+        name = "__".join(key)
+        entry_dir = os.path.join(self.cache_dir, name)
+        signature = dict((d, tree_signature(sources[d])) for d in CACHED_DIRECTORIES)
+        signature.update((e, file_signature(os.path.join(sources["bin"], e))) for e in EXECUTABLES)
+
+        cached = None
+        if name in self.entries:
+            try:
+                with open(os.path.join(entry_dir, SIGNATURE_FILE), 'r') as infile:
+                    cached = json.load(infile)
+            except (OSError, ValueError):
+                pass
+        if cached is None or cached["signature"] != signature:
+            self._forget(name)
+            self._make_entry(name, sources, signature)
+        self.entries[name][1] = time.time()
+        os.utime(entry_dir)
+        self._evict(keep=name)
+
+        answer = dict((d, os.path.join(entry_dir, d)) for d in CACHED_DIRECTORIES)
+        answer["bin"] = os.path.join(entry_dir, "bin")
+        return answer
+
+    def _make_entry(self, name, sources, signature):
+        building = tempfile.mkdtemp(prefix=name + ".", dir=self.cache_dir)
+        for d in CACHED_DIRECTORIES:
+            if signature[d] is not None:
+                shutil.copytree(sources[d], os.path.join(building, d))
+        os.mkdir(os.path.join(building, "bin"))
+        for e in EXECUTABLES:
+            if signature[e] is not None:
+                shutil.copy2(os.path.join(sources["bin"], e), os.path.join(building, "bin", e))
+        make_read_only(building)
+        size = directory_size(building)
+        with open(os.path.join(building, SIGNATURE_FILE), 'w') as outfile:
+            json.dump({"signature": signature, "size": size}, outfile)
+        os.rename(building, os.path.join(self.cache_dir, name))
+        self.entries[name] = [size, time.time()]
+
+    def _forget(self, name):
+        self.entries.pop(name, None)
+        shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+    def _evict(self, keep):
+        total = sum(size for size, last_use in self.entries.values())
+        for name in sorted(self.entries, key=lambda n: self.entries[n][1]):
+            if total <= self.budget_bytes:
+                break
+            if name == keep:
+                continue
+            total -= self.entries[name][0]
+            self._forget(name)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Deferred removal of the grading tmp directories & of the old results.
+
+Removing a big directory tree (e.g., a submission with thousands of
+files) takes seconds, so the workers don't do it while grading: discard
+renames the tree into a trash directory on the same filesystem, and the
+reaper process started by the grading scheduler removes what is in the
+trash directories in the background, at the lowest cpu & io priority.
+
+The trash directories are private to hwcron (the old results of a student
+must not be readable by the untrusted users).  Without a reaper (e.g.,
+when grade_item.py is run by hand), the trash is removed the next time
+the scheduler runs.
+"""
+
+import glob
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+
+# (as in grade_item.py)
+AUTOGRADING_TMP_DIR = "/var/local/submitty/autograding_tmp"
+
+TRASH_NAME = "trash"
+# the trash directories of the workers: of each untrusted user (on disk & on its tmpfs) & of the remote jobs
+TRASH_PATTERNS = [os.path.join(AUTOGRADING_TMP_DIR, "*", TRASH_NAME),
+                  os.path.join(AUTOGRADING_TMP_DIR, "*", "ram", TRASH_NAME)]
+# how often (in seconds) the reaper looks for something to remove
+REAP_INTERVAL = 5
+
+_reaper = None
+_reaper_stop = None
+
+
+# ==================================================================================
+def discard(path, trash_dirs):
+    """
+    Move a directory tree (if it exists) into the first of the trash
+    directories that is on the same filesystem, or remove it right away if
+    there is none.
+
+    :param trash_dirs: list of trash directories (made if needed)
+    """
+    if not os.path.lexists(path):
+        return
+    for trash in trash_dirs:
+        try:
+            os.makedirs(trash, mode=0o700, exist_ok=True)
+            holder = tempfile.mkdtemp(dir=trash)
+        except OSError:
+            continue
+        try:
+            os.rename(path, os.path.join(holder, os.path.basename(path)))
+            return
+        except OSError:
+            # e.g., on another filesystem (or the reaper just removed the empty holder)
+            shutil.rmtree(holder, ignore_errors=True)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def reap():
+    """
+    Remove everything in the trash directories.
+    """
+    for pattern in TRASH_PATTERNS:
+        for trash in glob.glob(pattern):
+            for entry in os.scandir(trash):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+# ==================================================================================
+def reaper(stop, interval):
+    """
+    The reaper process: empties the trash directories every interval
+    seconds until stop is set.
+    """
+    # a keyboard interrupt of the scheduler is sent to us too, see stop_reaper
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.nice(19)
+    try:
+        subprocess.call(["ionice", "-c", "3", "-p", str(os.getpid())])
+    except OSError:
+        # no ionice, only the cpu priority is lowered
+        pass
+    while not stop.is_set():
+        try:
+            reap()
+        except OSError as e:
+            print("ERROR: trash reaper", e)
+        stop.wait(interval)
+
+
+def start_reaper(interval=REAP_INTERVAL):
+    global _reaper, _reaper_stop
+    _reaper_stop = multiprocessing.Event()
+    _reaper = multiprocessing.Process(target=reaper, args=(_reaper_stop, interval))
+    _reaper.start()
+
+
+def stop_reaper(timeout=10):
+    """
+    Stop the reaper process (what is left in the trash is removed by the next one).
+    """
+    global _reaper, _reaper_stop
+    if _reaper is None:
+        return
+    _reaper_stop.set()
+    _reaper.join(timeout)
+    if _reaper.is_alive():
+        _reaper.terminate()
+    _reaper = None
+    _reaper_stop = None
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+Local mirrors of the student repositories of the vcs gradeables, shared
+by the workers of this machine.
+
+Instead of a full "git clone" of the student repository for every job,
+grade_item.py asks the mirror cache for the checkout: the first job of a
+repository makes a bare mirror of it, later jobs only fetch what is new.
+The commit to grade is found in the mirror, and the files of each commit
+are exported only once (into the exports directory of the mirror, read
+only): the checkout directory of every job that resolves to the same
+commit is made of hard links to (or clones of) the exported files, see
+grading_staging_cache.stage_file.  (So the checkout directory has no .git
+directory.)
+
+Each mirror is locked while it is fetched & exported from.  After a fetch,
+"git gc --auto" keeps the mirror packed, only the MAX_EXPORTS most recently
+used exports of each mirror are kept, and when the mirrors grow over their
+budget the least recently used ones are removed.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+import grading_staging_cache
+
+SIZE_FILE = "size.json"
+EXPORTS_DIR = "submitty_exports"
+MAX_EXPORTS = 5
+
+
+# ==================================================================================
+class VcsMirrorCache(object):
+
+    def __init__(self, cache_dir, budget_bytes):
+        """
+        :param cache_dir: directory of the mirrors (shared by the workers)
+        :param budget_bytes: maximum total size of the mirrors
+        """
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+
+    def mirror_dir(self, vcs_path):
+        return os.path.join(self.cache_dir, hashlib.sha1(vcs_path.encode('utf-8')).hexdigest())
+
+    def checkout(self, vcs_path, checkout_path, submission_string, log_file):
+        """
+        Check out the last commit to master before the submission time.
+
+        :param vcs_path: url or path of the student repository
+        :param checkout_path: directory to check the commit out in (replaced)
+        :param submission_string: the submission time of the job
+        :param log_file: open file for the output of the git commands
+        :return: the commit, or "" if there was no commit before the submission
+                 time (then there is no checkout directory)
+        :raises subprocess.CalledProcessError: if the mirror could not be made or fetched
+        """
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        mirror = self.mirror_dir(vcs_path)
+        with open(mirror + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isdir(mirror):
+                print(['git', 'fetch', '--prune', 'origin'], file=log_file)
+                log_file.flush()
+                subprocess.check_call(['git', 'fetch', '--prune', '--quiet', 'origin'], cwd=mirror,
+                                      stdout=log_file, stderr=log_file)
+            else:
+                building = tempfile.mkdtemp(prefix=".", dir=self.cache_dir)
+                print(['git', 'clone', '--mirror', vcs_path], file=log_file)
+                log_file.flush()
+                try:
+                    subprocess.check_call(['git', 'clone', '--mirror', '--quiet', vcs_path, building],
+                                          stdout=log_file, stderr=log_file)
+                except subprocess.CalledProcessError:
+                    shutil.rmtree(building, ignore_errors=True)
+                    raise
+                os.rename(building, mirror)
+            subprocess.call(['git', 'gc', '--auto', '--quiet'], cwd=mirror, stdout=log_file, stderr=log_file)
+
+            # determine which version we need to checkout
+            what_version = subprocess.check_output(['git', 'rev-list', '-n', '1',
+                                                    '--before="'+submission_string+'"', 'master'],
+                                                   cwd=mirror, stderr=log_file)
+            what_version = str(what_version.decode('utf-8')).rstrip()
+
+            # cleanup the previous checkout (if it exists)
+            shutil.rmtree(checkout_path, ignore_errors=True)
+            if what_version != "":
+                print('commit', what_version, file=log_file)
+                export = self.export(mirror, what_version, log_file)
+                os.makedirs(os.path.dirname(checkout_path), exist_ok=True)
+                # (the checkout is only read, its files keep the mode of the export)
+                shutil.copytree(export, checkout_path, symlinks=True,
+                                copy_function=lambda source, target:
+                                grading_staging_cache.stage_file(source, target, link_mode=0))
+
+            with open(os.path.join(mirror, SIZE_FILE), 'w') as outfile:
+                json.dump(grading_staging_cache.directory_size(mirror), outfile)
+        self.evict(keep=mirror)
+        return what_version
+
+    def export(self, mirror, commit, log_file):
+        """
+        :return: the read only directory with the files of a commit (made if needed)
+        """
+        exports = os.path.join(mirror, EXPORTS_DIR)
+        export = os.path.join(exports, commit)
+        if os.path.isdir(export):
+            os.utime(export)
+            return export
+        os.makedirs(exports, exist_ok=True)
+        building = tempfile.mkdtemp(prefix=".", dir=exports)
+        try:
+            # (with an index of our own, the mirror stays a bare repository)
+            git = ['git', '--git-dir=' + mirror, '--work-tree=' + building]
+            env = dict(os.environ, GIT_INDEX_FILE=building + ".index")
+            subprocess.check_call(git + ['read-tree', commit], env=env, stdout=log_file, stderr=log_file)
+            subprocess.check_call(git + ['checkout-index', '--all', '--force'], env=env,
+                                  stdout=log_file, stderr=log_file)
+            grading_staging_cache.make_read_only(building)
+            os.rename(building, export)
+        finally:
+            shutil.rmtree(building, ignore_errors=True)
+            if os.path.exists(building + ".index"):
+                os.remove(building + ".index")
+
+        # keep the most recently used exports of this mirror
+        old = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(exports)
+                     if not entry.name.startswith(".") and entry.is_dir())
+        for last_use, path in old[:-MAX_EXPORTS]:
+            shutil.rmtree(path, ignore_errors=True)
+        return export
+
+    def evict(self, keep):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith(".") or not entry.is_dir():
+                continue
+            try:
+                info = os.stat(os.path.join(entry.path, SIZE_FILE))
+                with open(os.path.join(entry.path, SIZE_FILE), 'r') as infile:
+                    size = json.load(infile)
+            except (OSError, ValueError):
+                continue
+            # (the size file is rewritten each time the mirror is used)
+            entries.append((info.st_mtime, entry.path, size))
+            total += size
+        entries.sort()
+        for last_use, path, size in entries:
+            if total <= self.budget_bytes:
+                break
+            if path == keep:
+                continue
+            with open(path + ".lock", 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # in use by another worker
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+            total -= size
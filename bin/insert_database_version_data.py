@@ -23,20 +23,74 @@ import json
 import os
 import time
 import grade_items_logging
-from submitty_utils import dateutils
+from submitty_utils import config_cache, dateutils
 
-from sqlalchemy import create_engine, Table, MetaData, bindparam, select, func
+from sqlalchemy import create_engine, exc, text
 
 DB_HOST = "__INSTALL__FILLIN__DATABASE_HOST__"
 DB_USER = "__INSTALL__FILLIN__DATABASE_USER__"
 DB_PASSWORD = "__INSTALL__FILLIN__DATABASE_PASSWORD__"
 DATA_DIR = "__INSTALL__FILLIN__SUBMITTY_DATA_DIR__"
 
+# The data row should have been inserted by PHP when the student uploads the submission, requiring
+# us to do an update here (as the PHP also deals with the active version for us), but in case
+# we're using some other method of grading, we'll insert the row and whoever called the script
+# will need to handle the active version afterwards.
+#
+# This is done in one round trip for any number of rows: update the rows, and insert the ones
+# that were not updated. (INSERT ... ON CONFLICT can't be used, the unique constraint on
+# (g_id, user_id, team_id, g_version) never conflicts as either user_id or team_id is null.)
+UPSERT_SQL = """
+WITH data (g_id, who, g_version, non_hidden_non_ec, non_hidden_ec, hidden_non_ec, hidden_ec, submission_time) AS (
+    VALUES {values}),
+updated AS (
+    UPDATE electronic_gradeable_data AS egd
+       SET autograding_non_hidden_non_extra_credit=data.non_hidden_non_ec,
+           autograding_non_hidden_extra_credit=data.non_hidden_ec,
+           autograding_hidden_non_extra_credit=data.hidden_non_ec,
+           autograding_hidden_extra_credit=data.hidden_ec,
+           autograding_complete=TRUE
+      FROM data
+     WHERE egd.g_id=data.g_id AND egd.{who_column}=data.who AND egd.g_version=data.g_version
+    RETURNING egd.g_id, egd.{who_column} AS who, egd.g_version)
+INSERT INTO electronic_gradeable_data
+    (g_id, {who_column}, g_version,
+     autograding_non_hidden_non_extra_credit, autograding_non_hidden_extra_credit,
+     autograding_hidden_non_extra_credit, autograding_hidden_extra_credit,
+     submission_time, autograding_complete)
+SELECT g_id, who, g_version, non_hidden_non_ec, non_hidden_ec, hidden_non_ec, hidden_ec, submission_time, TRUE
+  FROM data
+ WHERE NOT EXISTS (SELECT 1 FROM updated
+                    WHERE updated.g_id=data.g_id AND updated.who=data.who AND updated.g_version=data.g_version)
+"""
+UPSERT_VALUES_SQL = "(:g_id{i}, :who{i}, CAST(:g_version{i} AS integer), " \
+                    "CAST(:non_hidden_non_ec{i} AS numeric), CAST(:non_hidden_ec{i} AS numeric), " \
+                    "CAST(:hidden_non_ec{i} AS numeric), CAST(:hidden_ec{i} AS numeric), " \
+                    "CAST(:submission_time{i} AS timestamp with time zone))"
+ROW_FIELDS = ["g_id", "who", "g_version", "non_hidden_non_ec", "non_hidden_ec", "hidden_non_ec", "hidden_ec",
+              "submission_time"]
+
+# db name -> engine, see get_engine
+_engines = {}
+
+
 def str2bool(v):
   return v.lower() in ("yes", "true", "t", "1")
 
 
 def insert_to_database(semester,course,gradeable_id,user_id,team_id,who_id,is_team,version):
+    insert_rows(semester, course,
+                [get_version_row(semester,course,gradeable_id,user_id,team_id,who_id,is_team,version)])
+
+
+def get_version_row(semester,course,gradeable_id,user_id,team_id,who_id,is_team,version):
+    """
+    Get the data of a graded version (from the config/build and results/ directories) for
+    insert_rows.
+
+    :return: dictionary with the g_id, who (user or team id), is_team, g_version, the points
+             (non_hidden_non_ec, non_hidden_ec, hidden_non_ec, hidden_ec) & submission_time
+    """
 
     non_hidden_non_ec = 0
     non_hidden_ec = 0
@@ -58,110 +112,90 @@ def insert_to_database(semester,course,gradeable_id,user_id,team_id,who_id,is_te
         non_hidden_non_ec += results['testcases'][i]['points']
     submission_time = results['submission_time']
 
-    db_name = "submitty_{}_{}".format(semester, course)
+    return {"g_id": gradeable_id,
+            "who": team_id if is_team is True else user_id,
+            "is_team": is_team is True,
+            "g_version": int(version),
+            "non_hidden_non_ec": non_hidden_non_ec,
+            "non_hidden_ec": non_hidden_ec,
+            "hidden_non_ec": hidden_non_ec,
+            "hidden_ec": hidden_ec,
+            "submission_time": submission_time}
+
 
-    # If using a UNIX socket, have to specify a slightly different connection string
-    if os.path.isdir(DB_HOST):
-        conn_string = "postgresql://{}:{}@/{}?host={}".format(DB_USER, DB_PASSWORD, db_name, DB_HOST)
-    else:
-        conn_string = "postgresql://{}:{}@{}/{}".format(DB_USER, DB_PASSWORD, DB_HOST, db_name)
+def insert_rows(semester, course, rows):
+    """
+    Write the data of graded versions (see get_version_row) to the electronic_gradeable_data
+    table of a course, in one transaction.  If there are several rows for the same version,
+    the last one is written.
+
+    :param semester:
+    :param course:
+    :param rows: list of dictionaries from get_version_row
+    """
+    latest = {}
+    for row in rows:
+        latest[(row["is_team"], row["g_id"], row["who"], row["g_version"])] = row
+    statements = []
+    for is_team in (False, True):
+        these_rows = [row for key, row in latest.items() if key[0] == is_team]
+        if len(these_rows) == 0:
+            continue
+        values = ",\n           ".join(UPSERT_VALUES_SQL.format(i=i) for i in range(len(these_rows)))
+        params = {}
+        for i, row in enumerate(these_rows):
+            for field in ROW_FIELDS:
+                params[field + str(i)] = row[field]
+        statement = text(UPSERT_SQL.format(values=values, who_column="team_id" if is_team else "user_id"))
+        statements.append((statement, params))
+
+    engine = get_engine(semester, course)
+    try:
+        execute_all(engine, statements)
+    except exc.DBAPIError as e:
+        if not e.connection_invalidated:
+            raise
+        # the pooled connection was closed (e.g., the database was restarted), try a new one
+        execute_all(engine, statements)
+
+
+def execute_all(engine, statements):
+    with engine.begin() as db:
+        for statement, params in statements:
+            db.execute(statement, **params)
+
+
+def get_engine(semester, course):
+    """
+    Get the engine of a course database.  The engine (with its pool of
+    connections) is kept for the lifetime of this process, so a grading
+    scheduler worker connects to each course database once, rather than
+    once per graded submission.
+
+    :param semester:
+    :param course:
+    :return: sqlalchemy engine
+    """
+    db_name = "submitty_{}_{}".format(semester, course)
+    engine = _engines.get(db_name)
+    if engine is None:
+        # If using a UNIX socket, have to specify a slightly different connection string
+        if os.path.isdir(DB_HOST):
+            conn_string = "postgresql://{}:{}@/{}?host={}".format(DB_USER, DB_PASSWORD, db_name, DB_HOST)
+        else:
+            conn_string = "postgresql://{}:{}@{}/{}".format(DB_USER, DB_PASSWORD, DB_HOST, db_name)
+        engine = create_engine(conn_string, pool_size=1, max_overflow=1, pool_recycle=3600)
+        _engines[db_name] = engine
+    return engine
 
-    engine = create_engine(conn_string)
-    db = engine.connect()
-    metadata = MetaData(bind=db)
-    data_table = Table('electronic_gradeable_data', metadata, autoload=True)
 
+def dispose_engines():
     """
-    The data row should have been inserted by PHP when the student uploads the submission, requiring
-    us to do an update here (as the PHP also deals with the active version for us), but in case
-    we're using some other method of grading, we'll insert the row and whoever called the script
-    will need to handle the active version afterwards.
+    Close the connections to all of the course databases.
     """
-    if is_team is True:
-        result = db.execute(select([func.count()]).select_from(data_table)
-                            .where(data_table.c.g_id == bindparam('g_id'))
-                            .where(data_table.c.team_id == bindparam('team_id'))
-                            .where(data_table.c.g_version == bindparam('g_version')),
-                            g_id=gradeable_id,  team_id=team_id, g_version=version)
-        row = result.fetchone()
-        result.close()
-        query_type = data_table.insert()
-        if row[0] > 0:
-            query_type = data_table\
-                .update(
-                    values=
-                    {
-                        data_table.c.autograding_non_hidden_non_extra_credit:
-                            bindparam("autograding_non_hidden_non_extra_credit"),
-                        data_table.c.autograding_non_hidden_extra_credit:
-                            bindparam("autograding_non_hidden_extra_credit"),
-                        data_table.c.autograding_hidden_non_extra_credit:
-                            bindparam("autograding_hidden_non_extra_credit"),
-                        data_table.c.autograding_hidden_extra_credit:
-                            bindparam("autograding_hidden_extra_credit"),
-                        data_table.c.autograding_complete:
-                            bindparam("autograding_complete")
-                    })\
-                .where(data_table.c.g_id == bindparam('u_g_id'))\
-                .where(data_table.c.team_id == bindparam('u_team_id'))\
-                .where(data_table.c.g_version == bindparam('u_g_version'))
-            # we bind "u_g_id" (and others) as we cannot use "g_id" in the where clause for an
-            # update. Passing this as an argument to db.execute doesn't cause any issue when we
-            # use the insert query (that doesn't have u_g_id)
-        db.execute(query_type,
-                   g_id=gradeable_id, u_g_id=gradeable_id,
-                   team_id=team_id, u_team_id=team_id,
-                   g_version=version, u_g_version=version,
-                   autograding_non_hidden_non_extra_credit=non_hidden_non_ec,
-                   autograding_non_hidden_extra_credit=non_hidden_ec,
-                   autograding_hidden_non_extra_credit=hidden_non_ec,
-                   autograding_hidden_extra_credit=hidden_ec,
-                   submission_time=submission_time,
-                   autograding_complete=True)
-
-    else:
-        result = db.execute(select([func.count()]).select_from(data_table)
-                            .where(data_table.c.g_id == bindparam('g_id'))
-                            .where(data_table.c.user_id == bindparam('user_id'))
-                            .where(data_table.c.g_version == bindparam('g_version')),
-                            g_id=gradeable_id, user_id=user_id, g_version=version)
-        row = result.fetchone()
-        result.close()
-        query_type = data_table.insert()
-        if row[0] > 0:
-            query_type = data_table\
-                .update(
-                    values=
-                    {
-                        data_table.c.autograding_non_hidden_non_extra_credit:
-                            bindparam("autograding_non_hidden_non_extra_credit"),
-                        data_table.c.autograding_non_hidden_extra_credit:
-                            bindparam("autograding_non_hidden_extra_credit"),
-                        data_table.c.autograding_hidden_non_extra_credit:
-                            bindparam("autograding_hidden_non_extra_credit"),
-                        data_table.c.autograding_hidden_extra_credit:
-                            bindparam("autograding_hidden_extra_credit"),
-                        data_table.c.autograding_complete:
-                            bindparam("autograding_complete")
-                    })\
-                .where(data_table.c.g_id == bindparam('u_g_id'))\
-                .where(data_table.c.user_id == bindparam('u_user_id'))\
-                .where(data_table.c.g_version == bindparam('u_g_version'))
-            # we bind "u_g_id" (and others) as we cannot use "g_id" in the where clause for an
-            # update. Passing this as an argument to db.execute doesn't cause any issue when we
-            # use the insert query (that doesn't have u_g_id)
-        db.execute(query_type,
-                   g_id=gradeable_id, u_g_id=gradeable_id,
-                   user_id=user_id, u_user_id=user_id,
-                   g_version=version, u_g_version=version,
-                   autograding_non_hidden_non_extra_credit=non_hidden_non_ec,
-                   autograding_non_hidden_extra_credit=non_hidden_ec,
-                   autograding_hidden_non_extra_credit=hidden_non_ec,
-                   autograding_hidden_extra_credit=hidden_ec,
-                   submission_time=submission_time,
-                   autograding_complete=True)
-    db.close()
-    engine.dispose()
+    for engine in _engines.values():
+        engine.dispose()
+    _engines.clear()
 
 
 def get_testcases(semester, course, g_id):
@@ -178,13 +212,12 @@ def get_testcases(semester, course, g_id):
     build_file = os.path.join(DATA_DIR, "courses", semester, course, "config", "build",
                               "build_" + g_id + ".json")
     if os.path.isfile(build_file):
-        with open(build_file) as build_file:
-            build_json = json.load(build_file)
-            if 'testcases' in build_json and build_json['testcases'] is not None:
-                for testcase in build_json['testcases']:
-                    testcases.append({'hidden': testcase['hidden'],
-                                      'extra_credit': testcase['extra_credit'],
-                                      'points': testcase['points']})
+        build_json = config_cache.load_json(build_file)
+        if 'testcases' in build_json and build_json['testcases'] is not None:
+            for testcase in build_json['testcases']:
+                testcases.append({'hidden': testcase['hidden'],
+                                  'extra_credit': testcase['extra_credit'],
+                                  'points': testcase['points']})
     return testcases
 
 
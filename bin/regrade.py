@@ -10,15 +10,29 @@ pattern and add them to the grading queue.
 USAGE:
     regrade.py  <one or more (absolute or relative) PATTERN PATH>
     regrade.py  <one or more (absolute or relative) PATTERN PATH>  --interactive
+
+The matching submissions can be narrowed down with:
+    --active_only   only the active version of each student/team
+    --failed_only   only the versions that did not get full credit on some testcase
+                    (or that have no results)
+    --stale_only    only the versions graded before the gradeable was last built
 """
 
 import argparse
+import concurrent.futures
+import fnmatch
 import json
 import os
-from submitty_utils import glob, dateutils
+import stat
+import time
+from submitty_utils import dateutils
+import grading_job_index
 
 SUBMITTY_DATA_DIR = "__INSTALL__FILLIN__SUBMITTY_DATA_DIR__"
 
+# the queue files are written by this many threads
+WRITE_THREADS = 8
+
 def arg_parse():
     parser = argparse.ArgumentParser(description="Re-adds any submission folders found in the given path and adds"
                                                  "them to a queue (default batch) for regrading")
@@ -28,6 +42,14 @@ def arg_parse():
                         "is batch.")
     parser.add_argument("--no_input", dest="no_input", action='store_const', const=True, default=False,
                         help="Do not wait for confirmation input, even if many things are being added to the queue.")
+    parser.add_argument("--active_only", dest="active_only", action='store_const', const=True, default=False,
+                        help="Only regrade the active version of each student or team.")
+    parser.add_argument("--failed_only", dest="failed_only", action='store_const', const=True, default=False,
+                        help="Only regrade the versions that lost points on a testcase (e.g., a compile error) "
+                        "or have no results.")
+    parser.add_argument("--stale_only", dest="stale_only", action='store_const', const=True, default=False,
+                        help="Only regrade the versions whose results are older than the gradeable's "
+                        "compile.out, run.out or validate.out.")
     return parser.parse_args()
 
 
@@ -36,6 +58,15 @@ def main():
     data_dir = os.path.join(SUBMITTY_DATA_DIR, "courses")
     data_dirs = data_dir.split(os.sep)
     grade_queue = []
+    # (semester, course, gradeable) -> build json of the gradeable
+    build_configs = {}
+    # caches of the filters: (semester, course, gradeable, who) -> active version,
+    # (semester, course, gradeable) -> time of the last build
+    active_versions = {}
+    build_times = {}
+    num_filtered = 0
+    #get the current time
+    queue_time = dateutils.write_submitty_date()
 
     for input_path in args.path:
         # handle relative path
@@ -74,48 +105,59 @@ def main():
             pattern_version=dirs[len(data_dirs)+5]
 
         # full pattern may include wildcards!
-        pattern = os.path.join(data_dir,pattern_semester,pattern_course,"submissions",pattern_gradeable,pattern_who,pattern_version)
+        patterns = [pattern_semester,pattern_course,"submissions",pattern_gradeable,pattern_who,pattern_version]
 
-        print("pattern: ",pattern)
+        print("pattern: ",os.path.join(data_dir,*patterns))
 
         # Find all matching submissions
-        for d in glob.glob(pattern):
-            if os.path.isdir(d):
-                print("match: ",d)
-                my_dirs = d.split(os.sep)
-                if len(my_dirs) != len(data_dirs)+6:
-                    raise SystemExit("ERROR: directory length not as expected")
-                my_semester=my_dirs[len(data_dirs)]
-                my_course=my_dirs[len(data_dirs)+1]
-                my_gradeable=my_dirs[len(data_dirs)+3]
+        for my_semester, my_course, submissions, my_gradeable, my_who, my_version in find_submissions(data_dir,patterns):
+            my_path=os.path.join(data_dir,my_semester,my_course,"submissions",my_gradeable,my_who,my_version)
+            print("match: ",my_path)
+            if (my_semester,my_course,my_gradeable) not in build_configs:
                 gradeable_config = os.path.join(data_dir,my_semester,my_course,"config/build/"+"build_"+my_gradeable+".json")
-                with open(gradeable_config, 'r') as build_configuration:
-                    datastore = json.load(build_configuration)
-                    required_capabilities = datastore.get('required_capabilities', 'default')
-                    max_grading_time = datastore.get('max_possible_grading_time', -1)
-
-                #get the current time
-                queue_time = dateutils.write_submitty_date()
-                my_who=my_dirs[len(data_dirs)+4]
-                my_version=my_dirs[len(data_dirs)+5]
-                my_path=os.path.join(data_dir,my_semester,my_course,"submissions",my_gradeable,my_who,my_version)
-                if my_path != d:
-                    raise SystemExit("ERROR: path reconstruction failed")
-                # add them to the queue
-
-                if '_' not in my_who:
-                    my_user = my_who
-                    my_team = ""
-                    my_is_team = False
-                else:
-                    my_user = ""
-                    my_team = my_who
-                    my_is_team = True
-
-                grade_queue.append({"semester": my_semester, "course": my_course, "gradeable": my_gradeable,
-                                    "user": my_user, "team": my_team, "who": my_who, "is_team": my_is_team,
-                                    "version": my_version, "required_capabilities" : required_capabilities,
-                                    "queue_time":queue_time, "max_possible_grading_time" : max_grading_time})
+                with open(gradeable_config, 'r') as infile:
+                    build_configs[(my_semester,my_course,my_gradeable)] = json.load(infile)
+            datastore = build_configs[(my_semester,my_course,my_gradeable)]
+
+            results_path = os.path.join(data_dir,my_semester,my_course,"results",my_gradeable,my_who,my_version)
+            if args.active_only:
+                key = (my_semester,my_course,my_gradeable,my_who)
+                if key not in active_versions:
+                    active_versions[key] = get_active_version(os.path.dirname(my_path))
+                if str(active_versions[key]) != my_version:
+                    num_filtered += 1
+                    continue
+            if args.stale_only:
+                key = (my_semester,my_course,my_gradeable)
+                if key not in build_times:
+                    build_times[key] = get_build_time(os.path.join(data_dir,my_semester,my_course,"bin",my_gradeable))
+                if not is_stale(results_path,build_times[key]):
+                    num_filtered += 1
+                    continue
+            if args.failed_only and not has_failed(results_path,datastore):
+                num_filtered += 1
+                continue
+            required_capabilities = datastore.get('required_capabilities', 'default')
+            max_grading_time = datastore.get('max_possible_grading_time', -1)
+
+            # add them to the queue
+
+            if '_' not in my_who:
+                my_user = my_who
+                my_team = ""
+                my_is_team = False
+            else:
+                my_user = ""
+                my_team = my_who
+                my_is_team = True
+
+            grade_queue.append({"semester": my_semester, "course": my_course, "gradeable": my_gradeable,
+                                "user": my_user, "team": my_team, "who": my_who, "is_team": my_is_team,
+                                "version": my_version, "required_capabilities" : required_capabilities,
+                                "queue_time":queue_time, "max_possible_grading_time" : max_grading_time})
+
+    if num_filtered > 0:
+        print("Filtered out {:d} matching submissions.".format(num_filtered))
 
     # Check before adding a very large number of systems to the queue
     if len(grade_queue) > 50 and not args.no_input:
@@ -127,14 +169,149 @@ def main():
     if args.interactive:
         which_queue="interactive"
 
+    # skip the submissions that are already waiting in the queue (if the
+    # scheduler's job index is available, we don't need to list the queue)
+    already_queued = set()
+    index = grading_job_index.open_index_if_available()
+    if index is not None:
+        already_queued = set(row["path"] for row in index.jobs(which_queue))
+
+    queue_dir = os.path.join(SUBMITTY_DATA_DIR, "to_be_graded_"+which_queue)
+    to_write = []
     for item in grade_queue:
-        file_name = "__".join([item['semester'], item['course'], item['gradeable'], item['who'], item['version']])
-        file_name = os.path.join(SUBMITTY_DATA_DIR, "to_be_graded_"+which_queue, file_name)
-        with open(file_name, "w") as open_file:
-            json.dump(item, open_file)
-        os.system("chmod o+rw {}".format(file_name))
+        if queue_file_path(queue_dir, item) not in already_queued:
+            to_write.append(item)
+    num_skipped = len(grade_queue) - len(to_write)
+
+    # let the job index know about all of them at once (the scheduler also
+    # records each one when it sees the new queue file), before any of them
+    # is in the queue: once it is, a worker may already be grading it
+    if index is not None and os.access(grading_job_index.JOB_INDEX_FILE, os.W_OK):
+        now = time.time()
+        index.add_rows(grading_job_index.make_job_row(which_queue, queue_file_path(queue_dir, item), now, item)
+                       for item in to_write)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=WRITE_THREADS) as executor:
+        list(executor.map(lambda item: write_queue_file(queue_dir, item), to_write))
+
+    if num_skipped > 0:
+        print("Skipped {:d} already waiting in the {} queue.".format(num_skipped, which_queue.upper()))
+    print("Added {:d} to the {} queue for regrading.".format(len(grade_queue)-num_skipped, which_queue.upper()))
+
+
+def find_submissions(data_dir, patterns):
+    """
+    Walk the courses directory once, only going into the directories that
+    match the pattern of their level (like glob, a * does not match a name
+    that starts with a ".").
+
+    :param data_dir: the courses directory
+    :param patterns: the patterns of the semester, course, "submissions", gradeable, who &
+                     version directories
+    :return: sorted list of the matching (semester, course, "submissions", gradeable, who,
+             version) tuples
+    """
+    found = []
+    todo = [(data_dir, ())]
+    while todo:
+        directory, names = todo.pop()
+        pattern = patterns[len(names)]
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            # e.g., a course we can't read
+            continue
+        for entry in entries:
+            if entry.name.startswith(".") and not pattern.startswith("."):
+                continue
+            if not fnmatch.fnmatchcase(entry.name, pattern) or not entry.is_dir():
+                continue
+            if len(names)+1 == len(patterns):
+                found.append(names + (entry.name,))
+            else:
+                todo.append((entry.path, names + (entry.name,)))
+    found.sort()
+    return found
+
+
+def get_active_version(who_path):
+    """
+    :param who_path: the submissions directory of a student/team for a gradeable
+    :return: the active version (0 if the submission was cancelled or if unknown)
+    """
+    try:
+        with open(os.path.join(who_path, "user_assignment_settings.json"), 'r') as infile:
+            return json.load(infile).get("active_version", 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def get_build_time(bin_path):
+    """
+    :param bin_path: the bin directory of a gradeable
+    :return: the latest mtime of its compile.out, run.out & validate.out (0 if there are none)
+    """
+    build_time = 0
+    for executable in ["compile.out", "run.out", "validate.out"]:
+        try:
+            build_time = max(build_time, os.stat(os.path.join(bin_path, executable)).st_mtime)
+        except OSError:
+            pass
+    return build_time
+
+
+def is_stale(results_path, build_time):
+    """
+    The results are stale if they are missing or older than the last build of the gradeable.
+    """
+    try:
+        return os.stat(os.path.join(results_path, "grade.txt")).st_mtime < build_time
+    except OSError:
+        return True
+
+
+def has_failed(results_path, build_config):
+    """
+    A version failed if it has no (readable) results, a testcase had a compilation error, or
+    it got less than full credit on a (non extra credit) testcase.
+
+    :param results_path: the results directory of the version
+    :param build_config: the build json of the gradeable
+    """
+    try:
+        with open(os.path.join(results_path, "results.json"), 'r') as infile:
+            results = json.load(infile)
+    except (OSError, ValueError):
+        return True
+    testcases = build_config.get("testcases") or []
+    for i, result in enumerate(results.get("testcases") or []):
+        if "Compilation Error" in result.get("testcase_message", ""):
+            return True
+        if i < len(testcases) and not testcases[i].get("extra_credit", False) and \
+           result.get("points_awarded", 0) < testcases[i].get("points", 0):
+            return True
+    return False
+
+
+def queue_file_path(queue_dir, item):
+    file_name = "__".join([item['semester'], item['course'], item['gradeable'], item['who'], item['version']])
+    return os.path.join(queue_dir, file_name)
+
+
+def write_queue_file(queue_dir, item):
+    """
+    Write a queue file under a hidden name & rename it, so the scheduler
+    never reads a partially written queue file.
 
-    print("Added {:d} to the {} queue for regrading.".format(len(grade_queue), which_queue.upper()))
+    :return: path to the queue file
+    """
+    path = queue_file_path(queue_dir, item)
+    tmp_path = os.path.join(queue_dir, "." + os.path.basename(path))
+    with open(tmp_path, "w") as open_file:
+        json.dump(item, open_file)
+    os.chmod(tmp_path, stat.S_IMODE(os.stat(tmp_path).st_mode) | stat.S_IROTH | stat.S_IWOTH)
+    os.rename(tmp_path, path)
+    return path
 
 
 if __name__ == "__main__":
@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
 
+import json
 import os
 import sys
 import time
 import signal
+import sqlite3
+import threading
 import grade_items_logging
 import grade_item
+import grade_time_estimates
+import grading_dispatcher
+import grading_job_index
+import grading_result_cache
+import grading_result_sink
+import grading_staging_cache
+import grading_trash
+import grading_vcs_cache
 from submitty_utils import glob
 import multiprocessing
 from watchdog.observers import Observer
-from watchdog.events import FileCreatedEvent, FileSystemEventHandler
+from watchdog.events import FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent, FileSystemEventHandler
 
 
 # ==================================================================================
@@ -18,11 +29,65 @@ NUM_GRADING_SCHEDULER_WORKERS_string = "__INSTALL__FILLIN__NUM_GRADING_SCHEDULER
 NUM_GRADING_SCHEDULER_WORKERS_int    = int(NUM_GRADING_SCHEDULER_WORKERS_string)
 
 AUTOGRADING_LOG_PATH="__INSTALL__FILLIN__AUTOGRADING_LOG_PATH__"
+SUBMITTY_INSTALL_DIR = "__INSTALL__FILLIN__SUBMITTY_INSTALL_DIR__"
 SUBMITTY_DATA_DIR = "__INSTALL__FILLIN__SUBMITTY_DATA_DIR__"
 HWCRON_UID = "__INSTALL__FILLIN__HWCRON_UID__"
 INTERACTIVE_QUEUE = os.path.join(SUBMITTY_DATA_DIR, "to_be_graded_interactive")
 BATCH_QUEUE = os.path.join(SUBMITTY_DATA_DIR, "to_be_graded_batch")
 
+# optional tuning of the scheduling policy (see load_scheduler_config)
+SCHEDULER_CONFIG_JSON = os.path.join(SUBMITTY_INSTALL_DIR, ".setup", "grading_scheduler.json")
+DEFAULT_SCHEDULER_CONFIG = {
+    # max # of interactive jobs graded in a row while batch jobs wait (0 = no limit)
+    "batch_starvation_limit" : 0,
+    # "fifo", or "fair_share" to share the batch workers between courses, e.g.:
+    #   "fair_share" : { "key" : "course",
+    #                    "weights" : { "f18/csci1200" : 2 },
+    #                    "max_running" : { "f18/csci1100" : 10 },
+    #                    "default_weight" : 1, "default_max_running" : 0 }
+    "batch_policy" : "fifo",
+    "fair_share" : {},
+    # "fifo", or "shortest_expected_first" to grade the batch jobs expected to
+    # finish soonest first (a batch job waiting more than max_batch_wait seconds
+    # is graded next regardless, 0 = no limit)
+    "batch_order" : "fifo",
+    "max_batch_wait" : 0,
+    # expected grading time (in seconds) of a gradeable we know nothing about
+    "default_grading_time" : 60,
+    # how often (in seconds) to write the per course wait time metrics
+    "metrics_interval" : 60,
+    # disk budget (in MB) of the cache of instructor files of each worker (0 = no cache)
+    "staging_cache_mb" : 512,
+    # disk budget (in MB) of the results kept to skip grading identical jobs, shared
+    # by the workers (0 = grade every job, see grading_result_cache.py)
+    "result_cache_mb" : 1024,
+    # disk budget (in MB) of the local mirrors of the student repositories, shared by
+    # the workers (0 = clone the repository for every job, see grading_vcs_cache.py)
+    "vcs_mirror_cache_mb" : 2048,
+    # the tmp directory of a job is made on the tmpfs of its untrusted user, if one is
+    # mounted (see INSTALL_SUBMITTY_HELPER.sh), when the job is expected to use at most
+    # this fraction of its free space, otherwise on disk (0 = always on disk)
+    "scratch_fill" : 0.5,
+    # # of spare untrusted users (after those of the workers of this machine) given to
+    # each worker of this machine, to run the testcases of the gradeables that have
+    # "parallel_testcases" : true in their autograding config in parallel (0 = never)
+    "testcase_shard_users" : 0,
+    # archive the results of each job (results directory, history, database, logs) in
+    # a thread of the worker while it grades its next job (see ArchivePipeline)
+    "pipelined_archiving" : True,
+    # the grades of the batch jobs are written to the course databases together, when
+    # there are this many rows or every this many seconds (see grading_result_sink.py)
+    "result_batch_size" : 100,
+    "result_flush_interval" : 5
+}
+SCHEDULER_METRICS_JSON = os.path.join(AUTOGRADING_LOG_PATH, "scheduler_metrics.json")
+
+# the capabilities of the workers of each grading machine (see load_workers)
+WORKERS_JSON = os.path.join(SUBMITTY_INSTALL_DIR, ".setup", "autograding_workers.json")
+
+# persistent record of the pending, in-flight & finished jobs
+JOB_INDEX = grading_job_index.JobIndex()
+
 
 # ==================================================================================
 class NewFileHandler(FileSystemEventHandler):
@@ -30,24 +95,60 @@ class NewFileHandler(FileSystemEventHandler):
     Simple handler for watchdog that watches for new files
     """
 
-    def __init__(self, queue,new_job_event,overall_lock):
+    def __init__(self, queue_name,dispatcher):
         super(FileSystemEventHandler, self).__init__()
-        self.queue = queue
-        self.new_job_event = new_job_event
-        self.overall_lock = overall_lock
+        self.queue_name = queue_name
+        self.dispatcher = dispatcher
+
+    def new_queue_file(self, queue_file):
+        # record the job in the index before anyone can pick it up
+        # (the queue file may not be completely written yet, the
+        # dispatcher holds the job until it can read it)
+        obj = grading_job_index.read_queue_file(queue_file)
+        update_job_index(lambda path: JOB_INDEX.add_job(self.queue_name,path,obj=obj),queue_file)
+        # When a new queue file is created, hand that job to
+        # the dispatcher, which wakes up immediately and gives
+        # it to an idle worker (if there is one).
+        self.dispatcher.submit(queue_file,self.queue_name == "batch",obj)
 
     def on_created(self, event):
         if isinstance(event, FileCreatedEvent):
-            if os.path.basename(event.src_path).startswith("GRADING_") is False:
-                # When a new queue file is created, add that job to
-                # the queue and set the event that wakes up any
-                # processes waiting on this event.
-                self.overall_lock.acquire()
-                self.queue.put(event.src_path)
-                self.new_job_event.set()
-                self.overall_lock.release()
+            if grading_job_index.is_queue_file_name(os.path.basename(event.src_path)):
+                self.new_queue_file(event.src_path)
+
+    def on_modified(self, event):
+        # the web site writes the queue files in place, so the file reported
+        # by on_created may only be readable now
+        if isinstance(event, FileModifiedEvent):
+            if grading_job_index.is_queue_file_name(os.path.basename(event.src_path)):
+                self.dispatcher.wake()
+
+    def on_moved(self, event):
+        # regrade.py writes each queue file under a hidden name & renames it
+        if isinstance(event, FileMovedEvent):
+            if grading_job_index.is_queue_file_name(os.path.basename(event.dest_path)):
+                self.new_queue_file(event.dest_path)
+
+    def on_deleted(self, event):
+        if isinstance(event, FileDeletedEvent):
+            if grading_job_index.is_queue_file_name(os.path.basename(event.src_path)):
+                # the workers mark their jobs done before removing the
+                # queue file, so this only drops jobs removed by hand
+                update_job_index(JOB_INDEX.forget_pending,event.src_path)
 
 # ==================================================================================
+def load_scheduler_config():
+    """
+    Read the scheduler configuration file (if it exists), using the
+    default value for any setting that is not specified.
+    """
+    config = dict(DEFAULT_SCHEDULER_CONFIG)
+    if os.path.isfile(SCHEDULER_CONFIG_JSON):
+        with open(SCHEDULER_CONFIG_JSON, 'r') as infile:
+            config.update(json.load(infile))
+    return config
+
+
 def initialize(untrusted_queue):
     """
     Initializer function for all our processes. We get one untrusted user off our queue which
@@ -60,11 +161,33 @@ def initialize(untrusted_queue):
     multiprocessing.current_process().untrusted = untrusted_queue.get()
 
 
-def grade_queue_file(queue_file,which_untrusted):
+def update_job_index(update,queue_file):
+    """
+    Apply an update to the job index.  A problem with the index should
+    never stop a job from being graded, so errors are only logged.
+    """
+    try:
+        update(queue_file)
+    except Exception as e:
+        print ("ERROR updating job index: ", queue_file, " exception=",e)
+        grade_items_logging.log_message(False,"","","","","ERROR updating job index: " + queue_file + " exception " + repr(e))
+
+
+def grade_queue_file(queue_file,which_untrusted,host=None,staging_cache=None,result_cache=None,
+                     shard_untrusted=None,pipeline=None,vcs_mirrors=None,scratch_fill=0):
     """
     Grades a single item in one of the queues.
 
     :param queue_file: file path pointing to the file we want to operate one.
+    :param which_untrusted: the untrusted user that runs the student code
+    :param host: None, or the grading machine (see load_workers)
+    :param staging_cache: grading_staging_cache.StagingCache of the worker (optional)
+    :param result_cache: grading_result_cache.ResultCache (optional)
+    :param shard_untrusted: more untrusted users of the worker to run testcases in parallel (optional)
+    :param pipeline: ArchivePipeline of the worker (optional), if given the job is archived
+                     (and its queue file removed) in the background after this returns
+    :param vcs_mirrors: grading_vcs_cache.VcsMirrorCache (optional)
+    :param scratch_fill: see grade_item.choose_scratch
     """
 
     my_dir,my_file=os.path.split(queue_file)
@@ -74,34 +197,104 @@ def grade_queue_file(queue_file,which_untrusted):
     grading_file = os.path.join(directory, "GRADING_" + name)
 
     open(os.path.join(grading_file), "w").close()
+    update_job_index(JOB_INDEX.mark_grading,queue_file)
     #untrusted = multiprocessing.current_process().untrusted
-    try:
-        grade_item.just_grade_item(my_dir, queue_file, which_untrusted)
-    except Exception as e:
+
+    def finish():
+        # mark the job done before the queue file disappears (see NewFileHandler.on_deleted)
+        update_job_index(JOB_INDEX.mark_done,queue_file)
+
+        # note: not necessary to acquire lock for these statements, but
+        # make sure you remove the queue file, then the grading file
+        try:
+            os.remove(queue_file)
+        except:
+            print ("ERROR attempting to remove queue file: ", queue_file)
+            grade_items_logging.log_message(False,"","","","","ERROR attempting to remove queue file: " + queue_file)
+        try:
+            os.remove(grading_file)
+        except:
+            print ("ERROR attempting to remove grading file: ", grading_file)
+            grade_items_logging.log_message(False,"","","","","ERROR attempting to remove grading file: " + grading_file)
+
+    def log_error(e):
         print ("ERROR attempting to grade item: ", queue_file, " exception=",e)
         grade_items_logging.log_message(False,"","","","","ERROR attempting to grade item: " + queue_file + " exception " + repr(e))
 
-    # note: not necessary to acquire lock for these statements, but
-    # make sure you remove the queue file, then the grading file
-    try:
-        os.remove(queue_file)
-    except:
-        print ("ERROR attempting to remove queue file: ", queue_file)
-        grade_items_logging.log_message(False,"","","","","ERROR attempting to remove queue file: " + queue_file)
+    archive = None
+    archiving = []
+    if pipeline is not None:
+        def archive(archive_job):
+            def archive_and_finish():
+                # (even if the archiving raised SystemExit, the queue file must go)
+                try:
+                    archive_job()
+                except Exception as e:
+                    log_error(e)
+                finally:
+                    finish()
+            pipeline.start(archive_and_finish)
+            archiving.append(True)
+
     try:
-        os.remove(grading_file)
-    except:
-        print ("ERROR attempting to remove grading file: ", grading_file)
-        grade_items_logging.log_message(False,"","","","","ERROR attempting to remove grading file: " + grading_file)
+        grade_item.just_grade_item(my_dir, queue_file, which_untrusted, host, staging_cache, result_cache,
+                                   shard_untrusted, "" if pipeline is None else pipeline.tmp_suffix(), archive,
+                                   vcs_mirrors, scratch_fill)
+    except Exception as e:
+        log_error(e)
 
+    if not archiving:
+        finish()
 
-def populate_queue(queue, folder):
+
+class ArchivePipeline(object):
+    """
+    Lets a worker archive the results of a job in a thread while it grades
+    its next job.  The jobs use two tmp directories in turn, only one job
+    is archived at a time, and a job does not start in the tmp directory
+    of the job being archived.
     """
-    Populate a queue with all files in folder. We first scan the folder to check for any
-    "GRADING_*" and clean them up, and then add the remaining files to the queue, sorted
-    by creation time.
 
-    :param queue: multiprocessing.queues.Queue
+    def __init__(self):
+        self.thread = None
+        self.thread_suffix = None
+        self.suffix = "_b"
+
+    def tmp_suffix(self):
+        """
+        :return: the suffix of the tmp directory of the next job (free by then)
+        """
+        self.suffix = "" if self.suffix == "_b" else "_b"
+        if self.thread_suffix == self.suffix:
+            self.wait()
+        return self.suffix
+
+    def start(self, function):
+        """
+        Archive the current job (the one given the last tmp_suffix) in a thread.
+        """
+        self.wait()
+        self.thread = threading.Thread(target=function)
+        self.thread_suffix = self.suffix
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            self.thread_suffix = None
+
+
+def populate_queue(dispatcher, queue_name, folder):
+    """
+    Populate a queue with all pending jobs in folder. We first scan the folder to check for any
+    "GRADING_*" and clean them up, and then bring the job index up to date with the remaining
+    files and give them to the dispatcher.  Only queue files the index has not seen before are
+    stat-ed & parsed.  If the job index can't be used, the queue files are given to the
+    dispatcher straight from the folder.
+
+    :param dispatcher: grading_dispatcher.Dispatcher
+    :param queue_name: "interactive" or "batch"
     :param folder: string representing the path to the folder to add files from
     """
 
@@ -109,12 +302,37 @@ def populate_queue(queue, folder):
         grade_items_logging.log_message(False,"","","","","Remove old queue file: " + file_path)
         os.remove(file_path)
 
-    # Grab all the files currently in the folder, sorted by creation
-    # time, and put them in the queue to be graded
-    files = glob.glob(os.path.join(folder, "*"))
-    files.sort(key=os.path.getctime)
-    for f in files:
-        queue.put(os.path.join(folder, f))
+    # Grab all the pending jobs and give them to the dispatcher (which
+    # orders them by creation time)
+    try:
+        jobs = JOB_INDEX.recover(queue_name, folder)
+    except sqlite3.Error as e:
+        grade_items_logging.log_message(False,"","","","","ERROR recovering the job index: " + folder +
+                                        " exception " + repr(e) + ", queueing the files of the folder")
+        for queue_time, path in scan_queue_folder(folder):
+            dispatcher.add_job(path, queue_name == "batch", queue_time)
+        return
+    for job in jobs:
+        obj = dict((field, job[field]) for field in ["semester","course","gradeable","who","version",
+                                                     "required_capabilities","max_possible_grading_time"])
+        dispatcher.add_job(job["path"], queue_name == "batch", job["queue_time"], obj)
+
+
+def scan_queue_folder(folder):
+    """
+    :return: sorted list of (creation time, path) of the queue files in folder
+    """
+    answer = []
+    for entry in os.scandir(folder):
+        if not grading_job_index.is_queue_file_name(entry.name) or not entry.is_file():
+            continue
+        try:
+            answer.append((entry.stat().st_ctime, entry.path))
+        except OSError:
+            # removed while we were looking
+            continue
+    answer.sort()
+    return answer
 
 
 def exit_gracefully(signum,frame):
@@ -124,38 +342,97 @@ def exit_gracefully(signum,frame):
 
 # ==================================================================================
 # ==================================================================================
-def worker_process(interactive_queue,batch_queue,new_job_event,overall_lock,which_untrusted):
+def worker_process(connection,which_untrusted,host,staging_cache_mb,result_cache_mb,shard_untrusted,
+                   pipelined_archiving,vcs_mirror_cache_mb,scratch_fill):
     """
-    Each worker process spins in a loop, acquiring the overall lock to
-    check the queues, prioritizing interactive jobs over batch jobs.
-    If no jobs are available, the worker waits on an event editing one
-    of the queues.
+    Each worker process blocks on its pipe from the dispatcher until it
+    is handed a job, grades it, and then sends the job back on the pipe
+    to let the dispatcher know it is ready for another one.  With
+    pipelined archiving, it is ready as soon as the untrusted user is
+    done with the job, & archives that job while it grades the next one.
     """
 
     # ignore keyboard interrupts in the worker processes
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+    # keep the instructor files of the recent gradeables between jobs
+    # (not in the directory of the untrusted user, who could replace them)
+    staging_cache = None
+    if host is None and staging_cache_mb > 0:
+        staging_cache = grading_staging_cache.StagingCache(
+            os.path.join(grade_item.AUTOGRADING_TMP_DIR,"staging_cache",which_untrusted),staging_cache_mb*1024*1024)
+
+    # the results of the jobs graded by any of the workers, by the digest of their inputs
+    result_cache = None
+    if result_cache_mb > 0:
+        result_cache = grading_result_cache.ResultCache(
+            os.path.join(grade_item.AUTOGRADING_TMP_DIR,"result_cache"),result_cache_mb*1024*1024)
+
+    # the local mirrors of the student repositories, shared by the workers
+    vcs_mirrors = None
+    if vcs_mirror_cache_mb > 0:
+        vcs_mirrors = grading_vcs_cache.VcsMirrorCache(
+            os.path.join(grade_item.AUTOGRADING_TMP_DIR,"vcs_mirrors"),vcs_mirror_cache_mb*1024*1024)
+
+    pipeline = ArchivePipeline() if pipelined_archiving else None
+
     try:
         while True:
-            overall_lock.acquire()
-            if not interactive_queue.empty():
-                job = interactive_queue.get()
-                overall_lock.release()
-                grade_queue_file(job,which_untrusted)
-                continue
-            elif not batch_queue.empty():
-                job = batch_queue.get()
-                overall_lock.release()
-                grade_queue_file(job,which_untrusted)
-                continue
-            else:
-                new_job_event.clear()
-                overall_lock.release()
-                pid = os.getpid()
-                print ("pid ",pid,": no job for now, going to wait 10 seconds")
-                new_job_event.wait(10)
+            job = connection.recv()
+            grade_queue_file(job,which_untrusted,host,staging_cache,result_cache,shard_untrusted,pipeline,
+                             vcs_mirrors,scratch_fill)
+            connection.send(job)
     except:
         print ("exiting worker")
+        if pipeline is not None:
+            pipeline.wait()
+
+# ==================================================================================
+def load_workers(num_workers):
+    """
+    Read the capabilities of the workers from autograding_workers.json, e.g.:
+
+        { "primary" : { "capabilities" : ["default","cpp"], "address" : "", "username" : "",
+                        "num_autograding_workers" : 5 },
+          "bigmem"  : { "capabilities" : ["java","drmemory"], "address" : "grader2.example.edu",
+                        "username" : "hwcron", "num_autograding_workers" : 8 } }
+
+    Each entry for this machine (empty address or localhost) provides that
+    many workers with those capabilities, using the next untrusted users
+    of this machine.  Each entry for another machine provides that many
+    workers that send their jobs to that machine (see grading_hosts.py),
+    using its own untrusted users.  An entry with "transport" : "subprocess"
+    sends its jobs to a grader process on this machine.
+
+    :param num_workers: # of "default" workers if there is no autograding_workers.json
+    :return: list of (worker name, untrusted user, list of capabilities, host), the host
+             is None for the workers that grade on this machine
+    """
+    try:
+        with open(WORKERS_JSON, 'r') as infile:
+            machines = json.load(infile)
+    except FileNotFoundError:
+        machines = {"primary" : {"capabilities" : ["default"], "address" : "",
+                                 "num_autograding_workers" : num_workers}}
+    workers = list()
+    num_local = 0
+    for name in sorted(machines):
+        machine = machines[name]
+        capabilities = machine.get("capabilities", ["default"])
+        is_local = machine.get("address", "") in ["", "localhost"]
+        host = None
+        if "transport" in machine or not is_local:
+            host = dict(machine, name=name)
+        for i in range(int(machine.get("num_autograding_workers", 0))):
+            if is_local:
+                u = "untrusted" + str(num_local).zfill(2)
+                num_local += 1
+            else:
+                u = "untrusted" + str(i).zfill(2)
+            worker_name = u if host is None else name + "/" + u
+            workers.append((worker_name, u, capabilities, host))
+    return workers
+
 
 # ==================================================================================
 # ==================================================================================
@@ -165,41 +442,73 @@ def launch_workers(num_workers):
     if not int(os.getuid()) == int(HWCRON_UID):
         raise SystemExit("ERROR: the grade_item.py script must be run by the hwcron user")
 
+    # from now on, this process & the workers send their log messages to the log writer process
+    grade_items_logging.start_log_writer()
     grade_items_logging.log_message(False,"","","","","grade_scheduler.py launched")
 
-    # prepare a list of untrusted users to be used by the workers
-    untrusted_users = multiprocessing.Queue()
-    for i in range(num_workers):
-        untrusted_users.put("untrusted" + str(i).zfill(2))
+    # prepare a list of untrusted users (& their capabilities) to be used by the workers
+    workers = load_workers(num_workers)
+    num_workers = len(workers)
 
-    # Set up our queues that we're going to monitor for new jobs to run on
-    interactive_queue = multiprocessing.Queue()
-    batch_queue = multiprocessing.Queue()
-    populate_queue(interactive_queue, INTERACTIVE_QUEUE)
-    populate_queue(batch_queue, BATCH_QUEUE)
+    config = load_scheduler_config()
 
-    # the workers will wait on event if the queues are exhausted
-    new_job_event = multiprocessing.Event()
+    # the workers send the grades to the result sink process
+    grading_result_sink.start_result_sink(config["result_batch_size"],config["result_flush_interval"])
 
-    # this lock will be used to edit the queue or new job event
-    overall_lock = multiprocessing.Lock()
+    # the workers move the old tmp directories & results into their trash directories,
+    # the reaper process removes them in the background
+    grading_trash.start_reaper()
+
+    # learn the expected grading time of each gradeable from the recent logs
+    estimator = grade_time_estimates.GradeTimeEstimator(default_time=config["default_grading_time"])
+    if config["batch_order"] == "shortest_expected_first":
+        estimator.load_logs()
+
+    # Set up the dispatcher that owns the queues & hands the jobs to the workers
+    dispatcher = grading_dispatcher.Dispatcher(
+        batch_starvation_limit=config["batch_starvation_limit"],
+        make_batch_queue=grading_dispatcher.batch_queue_factory(config,estimator),
+        metrics=grading_dispatcher.WaitTimeMetrics(SCHEDULER_METRICS_JSON,config["metrics_interval"]),
+        estimator=estimator,
+        log_function=lambda message: grade_items_logging.log_message(False,"","","","",message))
+    try:
+        JOB_INDEX.prune_done()
+    except sqlite3.Error as e:
+        grade_items_logging.log_message(False,"","","","","ERROR pruning the job index: exception " + repr(e))
+    populate_queue(dispatcher, "interactive", INTERACTIVE_QUEUE)
+    populate_queue(dispatcher, "batch", BATCH_QUEUE)
 
     # Setup watchdog observer that will watch the folders and run the handler on any
     # FileSystemEvents. This runs in a thread automatically.
-    interactive_handler = NewFileHandler(interactive_queue,new_job_event,overall_lock)
-    batch_handler = NewFileHandler(batch_queue,new_job_event,overall_lock)
+    interactive_handler = NewFileHandler("interactive",dispatcher)
+    batch_handler = NewFileHandler("batch",dispatcher)
     observer = Observer()
     observer.schedule(event_handler=interactive_handler, path=INTERACTIVE_QUEUE, recursive=False)
     observer.schedule(event_handler=batch_handler, path=BATCH_QUEUE, recursive=False)
     observer.start()
 
-    # launch the worker threads
+    # the spare untrusted users of this machine come after those of its workers
+    next_untrusted = len(set(u for name, u, capabilities, host in workers
+                             if host is None or host.get("address","") in ["","localhost"]))
+
+    # launch the worker processes, each with its own pipe to the dispatcher
     processes = list()
-    for i in range(0,num_workers):
-        u = "untrusted" + str(i).zfill(2)
-        p = multiprocessing.Process(target=worker_process,args=(interactive_queue,batch_queue,new_job_event,overall_lock,u))
+    for name, u, capabilities, host in workers:
+        shard_untrusted = list()
+        if host is None:
+            for i in range(config["testcase_shard_users"]):
+                shard_untrusted.append("untrusted" + str(next_untrusted).zfill(2))
+                next_untrusted += 1
+        dispatcher_end, worker_end = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=worker_process,args=(worker_end,u,host,config["staging_cache_mb"],
+                                                                   config["result_cache_mb"],shard_untrusted,
+                                                                   config["pipelined_archiving"],
+                                                                   config["vcs_mirror_cache_mb"],
+                                                                   config["scratch_fill"]))
         p.start()
         processes.append(p)
+        dispatcher.add_worker(name,dispatcher_end,capabilities)
+    dispatcher.start()
 
     # main monitoring loop
     try:
@@ -212,12 +521,19 @@ def launch_workers(num_workers):
                     grade_items_logging.log_message(False,"","","","","ERROR: process "+str(i)+" is not alive")
             if alive != num_workers:
                 grade_items_logging.log_message(False,"","","","","ERROR: #workers="+str(num_workers)+" != #alive="+str(alive))
+            if not dispatcher.is_alive():
+                # (no job would be handed out any more)
+                grade_items_logging.log_message(False,"","","","","ERROR: the dispatcher thread stopped, restarting it")
+                dispatcher.start()
             #print ("workers= ",num_workers,"  alive=",alive)
             time.sleep(1)
 
     except KeyboardInterrupt:
         grade_items_logging.log_message(False,"","","","","grade_scheduler.py keyboard interrupt")
-
+        # write out the grades & the logs before everything is killed
+        grading_result_sink.stop_result_sink()
+        grading_trash.stop_reaper()
+        grade_items_logging.stop_log_writer()
 
 
         # just kill everything in this group id right now
@@ -236,8 +552,6 @@ def launch_workers(num_workers):
         # terminate the jobs
         for i in range(0,num_workers):
             processes[i].terminate()
-        # wake up sleeping jobs
-        new_job_event.set()
         # wait for them to join
         for i in range(0,num_workers):
             processes[i].join()
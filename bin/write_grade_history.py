@@ -45,7 +45,8 @@ def parse_arguments():
 
 def just_write_grade_history(json_file,assignment_deadline,submission_time,
                              seconds_late,queue_time,batch_regrade,grading_began,
-                             wait_time,grading_finished,grade_time,autograde_total):
+                             wait_time,grading_finished,grade_time,autograde_total,
+                             result_cache_hit=False,vcs_commit=None):
 
     #####################################
     # LOAD THE PREVIOUS HISTORY
@@ -78,6 +79,12 @@ def just_write_grade_history(json_file,assignment_deadline,submission_time,
         blob["autograde_total"] = int(autograde_array[3])
         if len(autograde_array) == 6:
             blob["autograde_max_possible"] = int(autograde_array[5])
+    if vcs_commit is not None:
+        # the commit of the student repository that was graded
+        blob["vcs_commit"] = vcs_commit
+    if result_cache_hit:
+        # the results were copied from an earlier grading of identical inputs
+        blob["result_cache_hit"] = True
 
 
     #####################################
@@ -0,0 +1,68 @@
+"""
+Memoized loading of the configuration files that the grading scripts read
+for every submission (form_*.json, build_*.json, complete_config_*.json and
+the config.ini of the course). A file is only parsed again when its mtime,
+size or inode changes, so a long running process (like the grading
+scheduler's workers) parses each config once per change instead of once
+per job.
+
+The same parsed object is handed to every caller, so callers must not
+modify it (make a copy first if needed).
+"""
+
+import configparser
+import json
+import os
+import threading
+
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def _load(path, kind, parse):
+    info = os.stat(path)
+    signature = (info.st_mtime_ns, info.st_size, info.st_ino)
+    with _lock:
+        cached = _cache.get((kind, path))
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with open(path, 'r') as open_file:
+        parsed = parse(open_file)
+    with _lock:
+        _cache[(kind, path)] = (signature, parsed)
+    return parsed
+
+
+def _parse_ini(open_file):
+    config = configparser.ConfigParser()
+    config.read_file(open_file)
+    return config
+
+
+def load_json(path):
+    """
+    Get the parsed contents of a json config file.
+
+    :param path: path to the json file
+    :return: the parsed json (shared, do not modify)
+    """
+    return _load(path, "json", json.load)
+
+
+def load_ini(path):
+    """
+    Get the parsed contents of an ini config file (e.g., the config.ini of a course).
+
+    :param path: path to the ini file
+    :return: configparser.ConfigParser (shared, do not modify)
+    """
+    return _load(path, "ini", _parse_ini)
+
+
+def clear():
+    """
+    Forget everything that was loaded.
+    """
+    with _lock:
+        _cache.clear()
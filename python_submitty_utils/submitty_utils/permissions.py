@@ -0,0 +1,72 @@
+"""
+Adding permission bits to the files & directories of a whole tree with as
+few system calls as possible: one lstat per entry (the directory listing
+comes from os.scandir, which also tells us which entries are
+directories), and a chmod only for the entries that are owned by us and
+are missing some of the bits.  Symbolic links are never followed.
+
+Pass a dictionary as counts to find out how much work was done, e.g.
+{"entries": 120, "chmod": 3}.
+"""
+
+import os
+import stat
+
+
+def _count(counts, what, n=1):
+    if counts is not None:
+        counts[what] = counts.get(what, 0) + n
+
+
+def _add(path, info, perms, uid, protect_links, counts):
+    if info.st_uid != uid:
+        # can't change permissions on this file/directory!
+        return
+    if protect_links and info.st_nlink > 1 and not stat.S_ISDIR(info.st_mode):
+        # hard linked (e.g., shared with a cache), changing its mode would change the original
+        return
+    mode = stat.S_IMODE(info.st_mode)
+    if mode | perms != mode:
+        os.chmod(path, mode | perms)
+        _count(counts, "chmod")
+
+
+def add_permissions(item, perms, protect_links=False, counts=None):
+    """
+    Add permission bits to one file or directory (if we own it).
+
+    :param item: path to the file or directory
+    :param perms: the bits to add (e.g., stat.S_IRGRP | stat.S_IXGRP)
+    :param protect_links: never change the mode of a file with several hard links
+    :param counts: dictionary to add the # of entries checked & chmod calls to
+    """
+    _count(counts, "entries")
+    _add(item, os.stat(item), perms, os.getuid(), protect_links, counts)
+
+
+def add_permissions_recursive(top_dir, root_perms, dir_perms, file_perms, protect_links=False, counts=None):
+    """
+    Add permission bits to a directory and everything in it (that we own).
+
+    :param top_dir: the directory
+    :param root_perms: the bits to add to top_dir itself
+    :param dir_perms: the bits to add to the directories inside top_dir
+    :param file_perms: the bits to add to the other files inside top_dir
+    :param protect_links: never change the mode of a file with several hard links
+    :param counts: dictionary to add the # of entries checked & chmod calls to
+    """
+    uid = os.getuid()
+    add_permissions(top_dir, root_perms, protect_links, counts)
+    todo = [top_dir]
+    while todo:
+        directory = todo.pop()
+        for entry in os.scandir(directory):
+            _count(counts, "entries")
+            if entry.is_symlink():
+                continue
+            info = entry.stat(follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                _add(entry.path, info, dir_perms, uid, protect_links, counts)
+                todo.append(entry.path)
+            else:
+                _add(entry.path, info, file_perms, uid, protect_links, counts)
@@ -18,18 +18,7 @@ import subprocess
 import shutil
 import stat
 
-# from grade_item.py
-def add_permissions(item,perms):
-    if os.getuid() == os.stat(item).st_uid:
-        os.chmod(item,os.stat(item).st_mode | perms)
-
-def add_permissions_recursive(top_dir,root_perms,dir_perms,file_perms):
-    for root, dirs, files in os.walk(top_dir):
-        add_permissions(root,root_perms)
-        for d in dirs:
-            add_permissions(os.path.join(root, d),dir_perms)
-        for f in files:
-            add_permissions(os.path.join(root, f),file_perms)
+from submitty_utils.permissions import add_permissions_recursive
 
 print("Content-type: text/html")
 print()
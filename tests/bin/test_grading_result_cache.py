@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Tests of the digests & storage of bin/grading_result_cache.py, which let
+the scheduler skip grading a job whose inputs match an already graded one.
+
+Run from the repository with:  python3 -m unittest discover tests/bin
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repository_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(repository_path, "bin"))
+sys.path.insert(0, os.path.join(repository_path, "python_submitty_utils"))
+
+import grading_result_cache
+
+# the testcases of a complete config with the submission limit testcase
+# every gradeable gets (see AddSubmissionLimitTestCase in grading/TestCase.cpp)
+DEFAULT_TESTCASES = [
+    {"title": "Compilation", "type": "Compilation", "points": 2},
+    {"title": "Output", "type": "Execution", "points": 8},
+    {"title": "Submission Limit", "type": "FileCheck", "max_submissions": 20, "points": -5, "penalty": -0.1}
+]
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.inputs = {"checkout": None}
+        for name in ["provided_code", "test_input", "test_output", "custom_validation_code", "bin"]:
+            self.inputs[name] = os.path.join(self.tmp, name)
+            os.mkdir(self.inputs[name])
+        self.write(os.path.join(self.inputs["test_output"], "expected.txt"), "42\n")
+        self.write(os.path.join(self.inputs["bin"], "validate.out"), "validator")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, contents):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as outfile:
+            outfile.write(contents)
+
+    def submit(self, version, contents, timestamp):
+        """
+        :return: the job & inputs of a submission of one file, as given to grade_item.grade_staged_job
+        """
+        submission = os.path.join(self.tmp, "submissions", str(version))
+        self.write(os.path.join(submission, "main.cpp"), contents)
+        self.write(os.path.join(submission, ".submit.timestamp"), timestamp)
+        job = {"gradeable": "hw01", "who": "student", "version": version, "submission_string": timestamp,
+               "autograding": {"submission_to_runner": ["*.cpp"], "work_to_details": ["*.txt"]}}
+        return job, dict(self.inputs, submission=submission)
+
+    def test_resubmission_hits(self):
+        cache = grading_result_cache.ResultCache(os.path.join(self.tmp, "cache"), 1024*1024)
+        job, inputs = self.submit(1, "int main() {}\n", "2018-02-01 10:00:00-0500")
+        digest = grading_result_cache.job_digest(job, inputs, DEFAULT_TESTCASES)
+        work = os.path.join(self.tmp, "work")
+        self.write(os.path.join(work, "grade.txt"), "Automatic grading total: 10 / 10\n")
+        self.write(os.path.join(work, "results.json"), "{}")
+        self.write(os.path.join(work, "test01_STDOUT.txt"), "42\n")
+        cache.store(digest, work, job["autograding"]["work_to_details"])
+
+        # the same files, submitted again later
+        job, inputs = self.submit(2, "int main() {}\n", "2018-02-01 10:05:00-0500")
+        digest = grading_result_cache.job_digest(job, inputs, DEFAULT_TESTCASES)
+        restored = os.path.join(self.tmp, "restored")
+        self.assertTrue(cache.restore(digest, restored))
+        self.assertEqual(sorted(os.listdir(restored)), ["grade.txt", "results.json", "test01_STDOUT.txt"])
+
+    def test_changed_submission_misses(self):
+        job, inputs = self.submit(1, "int main() {}\n", "2018-02-01 10:00:00-0500")
+        first = grading_result_cache.job_digest(job, inputs, DEFAULT_TESTCASES)
+        job, inputs = self.submit(2, "int main() { return 1; }\n", "2018-02-01 10:00:00-0500")
+        self.assertNotEqual(first, grading_result_cache.job_digest(job, inputs, DEFAULT_TESTCASES))
+
+    def test_excessive_submissions(self):
+        digests = []
+        for version in [1, 20, 21, 22]:
+            job, inputs = self.submit(version, "int main() {}\n", "2018-02-01 10:00:00-0500")
+            digests.append(grading_result_cache.job_digest(job, inputs, DEFAULT_TESTCASES))
+        # the versions under the limit have the same grade, each version over it loses more points
+        self.assertEqual(digests[0], digests[1])
+        self.assertEqual(len(set(digests)), 3)
+
+    def test_no_penalty(self):
+        testcases = [dict(testcase, points=0, penalty=0) if "max_submissions" in testcase else testcase
+                     for testcase in DEFAULT_TESTCASES]
+        job, inputs = self.submit(1, "int main() {}\n", "2018-02-01 10:00:00-0500")
+        first = grading_result_cache.job_digest(job, inputs, testcases)
+        job, inputs = self.submit(30, "int main() {}\n", "2018-02-01 10:00:00-0500")
+        self.assertEqual(first, grading_result_cache.job_digest(job, inputs, testcases))
+
+    def test_same_commit_hits(self):
+        job, inputs = self.submit(1, "", "2018-02-01 10:00:00-0500")
+        first = grading_result_cache.commit_digest(job, inputs, "0123abcd", DEFAULT_TESTCASES)
+        job, inputs = self.submit(3, "", "2018-02-02 10:00:00-0500")
+        self.assertEqual(first, grading_result_cache.commit_digest(job, inputs, "0123abcd", DEFAULT_TESTCASES))
+        self.assertNotEqual(first, grading_result_cache.commit_digest(job, inputs, "4567cdef", DEFAULT_TESTCASES))
+
+
+if __name__ == '__main__':
+    unittest.main()